@@ -0,0 +1,61 @@
+""" Commit latency with and without a commit thread pool, against the
+in-process fake database (see fakemongo.py) with a simulated network
+round trip on every call
+
+Each transaction updates a few documents in each of a number of
+collections. Sequentially, every commit phase costs one round trip per
+collection; with the pool the collections are handled concurrently, so
+a phase costs about one round trip however many collections take part.
+Run from the repository root:
+
+	PYTHONPATH=. python benchmarks/commit_benchmark.py
+"""
+
+import timeit
+import threadpools
+import transaction
+from bson.objectid import ObjectId
+from datamanager import MongoDocument
+import fakemongo
+
+LATENCY = 0.005 # seconds per round trip
+DOCS_PER_COLLECTION = 5
+COLLECTIONS = (1, 2, 4, 8)
+THREADS = (None, 4, 8)
+REPEAT = 5
+
+def make_session(ncollections, threads):
+	session = fakemongo.make_session(commit_threads=threads)
+	for i in range(ncollections):
+		fakemongo.store(session, 'collection%d' % i,
+		                [{'_id': ObjectId(), 'count': 0}
+		                 for j in range(DOCS_PER_COLLECTION)])
+	return session
+
+def bench(ncollections, threads):
+	session = make_session(ncollections, threads)
+	docs = []
+	for name, collection in session.db.collections.items():
+		for _id in collection.order:
+			docs.append(MongoDocument(session, name, retrieve={'_id': _id}))
+	times = []
+	for i in range(REPEAT):
+		for doc in docs:
+			doc['count'] = i + 1
+		start = timeit.default_timer()
+		transaction.commit()
+		times.append(timeit.default_timer() - start)
+	session.close()
+	return min(times)
+
+if __name__ == '__main__':
+	fakemongo.install(LATENCY)
+	print 'simulated latency: %.1f ms per round trip' % (LATENCY * 1e3)
+	print '%12s' % 'collections' + ''.join(
+	    ['%14s' % ('%s threads' % (threads or 'no')) for threads in THREADS])
+	for ncollections in COLLECTIONS:
+		row = '%12d' % ncollections
+		for threads in THREADS:
+			row += '%11.1f ms' % (bench(ncollections, threads) * 1e3)
+		print row
+	threadpools.shutdown()
@@ -0,0 +1,61 @@
+""" Read-heavy access to documents mixing native and serialized values
+
+Compares reading keys through MongoDocument.__getitem__ against trying
+to jsonpickle-decode every value on every read (which is what reads used
+to do), for documents as freshly loaded from the database.
+Run from the repository root:
+
+	PYTHONPATH=. python benchmarks/decode_benchmark.py
+"""
+
+import timeit
+import jsonpickle
+from datamanager import MongoDocument
+import fakemongo
+
+colname = 'bench_collection'
+NREADS = 20 # reads of every key
+
+class Wizard(object):
+	def __init__(self, name, spells):
+		self.name = name
+		self.spells = spells
+
+def make_document():
+	""" 60 native values (strings, numbers, lists) and 10 serialized
+	objects, as stored in the db
+	"""
+	stored = {'_id': 1}
+	for i in range(20):
+		stored['name%d' % i] = 'Saruman the %d' % i
+		stored['age%d' % i] = i
+		stored['list%d' % i] = range(10)
+	for i in range(10):
+		stored['wizard%d' % i] = jsonpickle.encode(
+		    Wizard('Saruman', ['fireball'] * 10))
+	session = fakemongo.make_session(transactional=False)
+	return MongoDocument._from_document(session, colname, stored)
+
+def decode_every_read(doc, name):
+	try:
+		value = jsonpickle.decode(doc.uncommitted[name])
+	except:
+		value = doc.uncommitted[name]
+	return value
+
+def bench(read):
+	doc = make_document()
+	keys = doc.keys()
+	start = timeit.default_timer()
+	for i in range(NREADS):
+		for key in keys:
+			read(doc, key)
+	return (timeit.default_timer() - start) / (NREADS * len(keys))
+
+if __name__ == '__main__':
+	print '%d reads of each key of a document with 60 native and 10' \
+	      ' serialized values' % NREADS
+	print '%-18s %8.2f us/read' % ('decode every read',
+	                               bench(decode_every_read) * 1e6)
+	print '%-18s %8.2f us/read' % ('__getitem__',
+	                               bench(MongoDocument.__getitem__) * 1e6)
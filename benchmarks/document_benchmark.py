@@ -0,0 +1,74 @@
+""" Per-instance memory and construction time of documents
+
+Creates 100k new documents, and wraps 100k documents as already fetched
+from the database, as MongoDocuments and as instances of a MongoObject
+subclass, in a fresh process for each, and reports the growth of the
+process's peak memory per document (less that of the fetched documents
+themselves) and the time taken to construct each one.
+Run from the repository root:
+
+	PYTHONPATH=. python benchmarks/document_benchmark.py
+"""
+
+import multiprocessing
+import resource
+import timeit
+from bson.objectid import ObjectId
+from datamanager import MongoDocument
+from orm import MongoObject
+import fakemongo
+
+colname = 'bench_collection'
+NDOCS = 100000
+
+class Wizard(MongoObject):
+	__collection__ = colname
+
+def fetched(i):
+	return {'_id': ObjectId(), 'name': 'Saruman %d' % i, 'age': i,
+	        'profession': 'wizard', 'tags': ['istar', 'white']}
+
+def measure(construct, results):
+	session = fakemongo.make_session()
+	fetched_docs = [fetched(i) for i in range(NDOCS)]
+	start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	docs = []
+	start = timeit.default_timer()
+	for doc in fetched_docs:
+		docs.append(construct(session, doc))
+	elapsed = timeit.default_timer() - start
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_memory
+	results.put((peak * 1024.0, elapsed))
+
+def run(construct):
+	results = multiprocessing.Queue()
+	process = multiprocessing.Process(target=measure,
+	                                  args=(construct, results))
+	process.start()
+	result = results.get()
+	process.join()
+	return result
+
+def new_document(session, doc):
+	return MongoDocument(session, colname)
+
+def loaded_document(session, doc):
+	return MongoDocument._from_document(session, colname, doc)
+
+def new_object(session, doc):
+	return Wizard(session)
+
+def loaded_object(session, doc):
+	return Wizard._from_document(session, colname, doc)
+
+if __name__ == '__main__':
+	print '%d documents of 5 keys' % NDOCS
+	print '%-22s %12s %8s' % ('', 'bytes/doc', 'us/doc')
+	for name, construct in (
+	        ('new MongoDocument', new_document),
+	        ('loaded MongoDocument', loaded_document),
+	        ('new MongoObject', new_object),
+	        ('loaded MongoObject', loaded_object)):
+		peak, elapsed = run(construct)
+		print '%-22s %12.0f %8.2f' % (name, peak / NDOCS,
+		                             elapsed / NDOCS * 1e6)
@@ -0,0 +1,297 @@
+""" An in-process stand-in for a MongoDB server, for benchmarking offline
+
+Implements just enough of pymongo's (legacy) collection API for the
+data manager, the commit protocol and the transaction hooks, keeps
+documents in dicts, and simulates the network: every round trip sleeps
+for the configured latency and is counted. Install it as the client
+class of the connection registry to have sessions use it, or create the
+benchmark's sessions with make_session(), which does so:
+
+	connection.registry = connection.ClientRegistry(fakemongo.FakeClient)
+"""
+
+import copy
+import threading
+import time
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import DuplicateKeyError
+import connection
+from config import Session
+
+LATENCY = 0.0005 # seconds per round trip, see set_latency()
+
+
+def set_latency(seconds):
+	global LATENCY
+	LATENCY = seconds
+
+def _plain(document):
+	if isinstance(document, RawBSONDocument):
+		return BSON(document.raw).decode()
+	return copy.deepcopy(document)
+
+def _matches(doc, spec):
+	for key, condition in spec.items():
+		if key == '$or':
+			if not filter(lambda f: _matches(doc, f), condition):
+				return False
+			continue
+		value = doc.get(key)
+		if isinstance(condition, dict) and filter(lambda f: f.startswith('$'),
+		                                          condition.keys()):
+			for operator, argument in condition.items():
+				if operator == '$in':
+					if value not in argument:
+						return False
+				elif operator == '$lt':
+					if value is None or not value < argument:
+						return False
+				elif operator == '$size':
+					if len(value or []) != argument:
+						return False
+				elif operator == '$exists':
+					if doc.has_key(key) != bool(argument):
+						return False
+				else:
+					raise NotImplementedError(operator)
+		elif value != condition and not (isinstance(value, list) and
+		                                 condition in value):
+			return False
+	return True
+
+def _project(doc, projection):
+	if projection is None:
+		return doc
+	if filter(None, [value for key, value in projection.items()
+	                 if key != '_id']):
+		return dict((key, value) for key, value in doc.items()
+		            if key == '_id' or projection.get(key))
+	return dict((key, value) for key, value in doc.items()
+	            if projection.get(key, 1))
+
+def _modify(doc, update):
+	if not filter(lambda f: f.startswith('$'), update.keys()):
+		_id = doc['_id']
+		doc.clear()
+		doc.update(_plain(update))
+		doc['_id'] = _id
+		return
+	for operator, changes in update.items():
+		for key, argument in changes.items():
+			argument = copy.deepcopy(argument)
+			if operator == '$set':
+				doc[key] = argument
+			elif operator == '$unset':
+				doc.pop(key, None)
+			elif operator == '$inc':
+				doc[key] = doc.get(key, 0) + argument
+			elif operator in ('$push', '$addToSet'):
+				values = (argument['$each'] if isinstance(argument, dict)
+				          else [argument])
+				current = doc.setdefault(key, [])
+				for value in values:
+					if operator == '$push' or value not in current:
+						current.append(value)
+			elif operator == '$pull':
+				doc[key] = [value for value in doc.get(key, [])
+				            if value != argument]
+			else:
+				raise NotImplementedError(operator)
+
+
+class FakeCursor(object):
+	def __init__(self, collection, spec, projection):
+		self.collection = collection
+		self.spec = spec or {}
+		self.projection = projection
+		self.n = None
+
+	def limit(self, n):
+		self.n = n
+		return self
+
+	def batch_size(self, n):
+		return self
+
+	def __iter__(self):
+		# all of the results come back in one round trip
+		docs = self.collection._find(self.spec, self.projection)
+		return iter(docs[:self.n] if self.n else docs)
+
+class FakeBulk(object):
+	def __init__(self, collection):
+		self.collection = collection
+		self.operations = []
+
+	def find(self, spec):
+		bulk = self
+		class Selector(object):
+			def update_one(self, update):
+				bulk.operations.append((spec, update))
+			def replace_one(self, document):
+				bulk.operations.append((spec, document))
+			def remove_one(self):
+				bulk.operations.append((spec, None))
+		return Selector()
+
+	def insert(self, document):
+		self.operations.append((None, document))
+
+	def execute(self):
+		database = self.collection.database
+		database._round_trip()
+		matched = 0
+		with database.lock:
+			for spec, document in self.operations:
+				if spec is None:
+					self.collection._insert(document)
+				elif document is None:
+					self.collection._remove(spec)
+				else:
+					matched += self.collection._update(spec, document,
+					                                   False)['n']
+		return {'nMatched': matched}
+
+class FakeCollection(object):
+	def __init__(self, database, name):
+		self.database = database
+		self.name = name
+		self.docs = {} # _id -> document, in insertion order of _id's
+		self.order = []
+
+	def _find(self, spec, projection=None):
+		self.database._round_trip()
+		with self.database.lock:
+			return [_project(copy.deepcopy(self.docs[_id]), projection)
+			        for _id in self.order if _matches(self.docs[_id], spec)]
+
+	def find(self, spec=None, projection=None):
+		return FakeCursor(self, spec, projection)
+
+	def find_one(self, spec=None, projection=None):
+		docs = self._find(spec or {}, projection)
+		return docs[0] if docs else None
+
+	def _insert(self, document):
+		document = _plain(document)
+		if self.docs.has_key(document['_id']):
+			raise DuplicateKeyError('duplicate _id')
+		self.docs[document['_id']] = document
+		self.order.append(document['_id'])
+
+	def insert(self, document):
+		self.database._round_trip()
+		with self.database.lock:
+			if not document.has_key('_id'):
+				document['_id'] = self.database.next_id()
+			self._insert(document)
+		return document['_id']
+
+	def _update(self, spec, document, multi):
+		n = 0
+		for _id in self.order:
+			if _matches(self.docs[_id], spec):
+				_modify(self.docs[_id], document)
+				n += 1
+				if not multi:
+					break
+		return {'n': n}
+
+	def update(self, spec, document, multi=False):
+		self.database._round_trip()
+		with self.database.lock:
+			return self._update(spec, document, multi)
+
+	def _remove(self, spec):
+		removed = [_id for _id in self.order
+		           if _matches(self.docs[_id], spec)]
+		for _id in removed:
+			del self.docs[_id]
+			self.order.remove(_id)
+		return {'n': len(removed)}
+
+	def remove(self, spec):
+		self.database._round_trip()
+		with self.database.lock:
+			return self._remove(spec)
+
+	def create_index(self, keys, **options):
+		self.database._round_trip()
+
+	def initialize_ordered_bulk_op(self):
+		return FakeBulk(self)
+
+class FakeDatabase(object):
+	def __init__(self, name):
+		self.name = name
+		self.collections = {}
+		self.lock = threading.RLock()
+		self.round_trips = 0
+		self.ids = 0
+
+	def _round_trip(self):
+		self.round_trips += 1
+		if LATENCY:
+			time.sleep(LATENCY)
+
+	def next_id(self):
+		self.ids += 1
+		return self.ids
+
+	def __getitem__(self, name):
+		with self.lock:
+			collection = self.collections.get(name)
+			if collection is None:
+				collection = self.collections[name] = \
+				    FakeCollection(self, name)
+			return collection
+
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		return self[name]
+
+class FakeClient(object):
+	def __init__(self, host=None, port=None, **options):
+		self.databases = {}
+
+	def __getitem__(self, name):
+		database = self.databases.get(name)
+		if database is None:
+			database = self.databases[name] = FakeDatabase(name)
+		return database
+
+	def drop_database(self, name):
+		self.databases.pop(name, None)
+
+	def close(self):
+		pass
+
+
+def install(latency=None):
+	""" Have sessions created from now on use fake clients, with the given
+	latency (in seconds per round trip) if any
+	"""
+	if connection.registry.client_class is not FakeClient:
+		connection.registry = connection.ClientRegistry(FakeClient)
+	if latency is not None:
+		set_latency(latency)
+
+def make_session(dbname='bench', **options):
+	""" A session on a fresh (empty) fake database; options are passed
+	on to the session, e.g. transactional=False or commit_threads=4
+	"""
+	install()
+	connection.get_client().drop_database(dbname)
+	options.setdefault('transaction_ttl', None)
+	return Session(dbname, **options)
+
+def store(session, colname, documents):
+	""" Put documents in the session's fake database directly, without
+	round trips
+	"""
+	collection = session.db[colname]
+	with collection.database.lock:
+		for document in documents:
+			collection._insert(document)
@@ -0,0 +1,89 @@
+""" Savepoint/rollback/abort cost over large documents
+
+Compares the copy-on-write document state against taking full copies of
+the document (which is what savepoints, abort and rollback used to do).
+Run from the repository root:
+
+	PYTHONPATH=. python benchmarks/overlay_benchmark.py
+"""
+
+import sys
+import timeit
+import transaction
+from datamanager import MongoDocument
+import fakemongo
+
+colname = 'bench_collection'
+NKEYS = 10000
+NSAVEPOINTS = 100
+NCHANGES = 10 # keys changed between savepoints
+
+def make_document(nkeys):
+	""" A document of nkeys keys as loaded from the db """
+	stored = dict(('key%d' % i, 'value%d' % i) for i in range(nkeys))
+	stored['_id'] = 1
+	return MongoDocument._from_document(fakemongo.make_session(), colname,
+	                                    stored)
+
+def savepoint_size(savepoint):
+	""" Bytes of container memory retained by a savepoint, not counting
+	the (shared) values themselves.
+	"""
+	overlay = savepoint.saved_changes
+	if overlay is None:
+		return sys.getsizeof(savepoint)
+	return (sys.getsizeof(savepoint) + sys.getsizeof(overlay) +
+	        sys.getsizeof(overlay.changes) + sys.getsizeof(overlay.deleted))
+
+def bench_overlay(nkeys):
+	doc = make_document(nkeys)
+	savepoints = []
+	start = timeit.default_timer()
+	for i in range(NSAVEPOINTS):
+		for j in range(NCHANGES):
+			doc['key%d' % (i * NCHANGES + j)] = i
+		savepoints.append(doc.savepoint())
+	savepoint_time = timeit.default_timer() - start
+	retained = sum(savepoint_size(sp) for sp in savepoints)
+	start = timeit.default_timer()
+	for savepoint in reversed(savepoints):
+		savepoint.rollback()
+	rollback_time = timeit.default_timer() - start
+	start = timeit.default_timer()
+	doc.abort(transaction.get())
+	abort_time = timeit.default_timer() - start
+	transaction.abort()
+	return savepoint_time, rollback_time, abort_time, retained
+
+def bench_full_copy(nkeys):
+	doc = make_document(nkeys).copy()
+	copies = []
+	start = timeit.default_timer()
+	for i in range(NSAVEPOINTS):
+		for j in range(NCHANGES):
+			doc['key%d' % (i * NCHANGES + j)] = i
+		copies.append(doc.copy())
+	savepoint_time = timeit.default_timer() - start
+	retained = sum(sys.getsizeof(c) for c in copies)
+	start = timeit.default_timer()
+	for saved in reversed(copies):
+		doc = saved.copy()
+	rollback_time = timeit.default_timer() - start
+	start = timeit.default_timer()
+	doc = doc.copy()
+	abort_time = timeit.default_timer() - start
+	return savepoint_time, rollback_time, abort_time, retained
+
+def report(name, results):
+	savepoint_time, rollback_time, abort_time, retained = results
+	print '%-12s savepoint: %8.3f ms  rollback: %8.3f ms  abort: %8.3f ms' \
+	      '  retained by savepoints: %10d bytes' % (
+	      name, savepoint_time * 1000 / NSAVEPOINTS,
+	      rollback_time * 1000 / NSAVEPOINTS, abort_time * 1000,
+	      retained)
+
+if __name__ == '__main__':
+	print '%d savepoints over a %d-key document, %d keys changed between' \
+	      ' savepoints' % (NSAVEPOINTS, NKEYS, NCHANGES)
+	report('full copy', bench_full_copy(NKEYS))
+	report('overlay', bench_overlay(NKEYS))
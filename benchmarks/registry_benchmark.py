@@ -0,0 +1,54 @@
+""" Cost of joining a transaction and dereferencing live documents as the
+number of documents in the transaction grows
+
+Both should stay flat now that they use the per-transaction registry
+rather than scanning the transaction's resources. For reference, the
+cost of the list scan that was previously done is shown as well.
+Run from the repository root:
+
+	PYTHONPATH=. python benchmarks/registry_benchmark.py
+"""
+
+import timeit
+import transaction
+from datamanager import MongoDocument
+import fakemongo
+
+colname = 'bench_collection'
+SIZES = (100, 1000, 5000)
+
+def make_docs(n):
+	""" n documents as loaded from the db """
+	session = fakemongo.make_session()
+	return [MongoDocument._from_document(session, colname, {'_id': i})
+	        for i in range(n)]
+
+def bench(n):
+	docs = make_docs(n)
+	start = timeit.default_timer()
+	for doc in docs:
+		doc['name'] = 'Saruman' # joins the transaction
+	join_time = timeit.default_timer() - start
+	for i, doc in enumerate(docs):
+		doc['friend'] = docs[(i + 1) % n]
+	start = timeit.default_timer()
+	for doc in docs:
+		doc['friend'] # live document in the transaction
+	deref_time = timeit.default_timer() - start
+	resources = transaction.get()._resources
+	last = docs[-1]
+	start = timeit.default_timer()
+	for doc in docs[:100]:
+		last in resources
+	scan_time = timeit.default_timer() - start
+	transaction.abort()
+	return join_time / n, deref_time / n, scan_time / 100
+
+if __name__ == '__main__':
+	print '%8s %16s %16s %22s' % ('docs', 'join (us/doc)', 'deref (us/doc)',
+	                              'list scan (us/check)')
+	for n in SIZES:
+		join_time, deref_time, scan_time = bench(n)
+		print '%8d %16.2f %16.2f %22.2f' % (n, join_time * 1e6,
+		                                     deref_time * 1e6,
+		                                     scan_time * 1e6)
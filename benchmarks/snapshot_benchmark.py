@@ -0,0 +1,63 @@
+""" Memory held by loaded documents: MongoDocument vs MongoSnapshot
+
+Loads 100k documents (as already fetched from the database) into a list,
+in a fresh process for each kind of document, and reports the growth of
+the process's peak memory, including the fetched documents themselves
+(shown on their own as plain dicts), and the time taken to wrap them.
+Run from the repository root:
+
+	PYTHONPATH=. python benchmarks/snapshot_benchmark.py
+"""
+
+import multiprocessing
+import resource
+import timeit
+from bson.objectid import ObjectId
+from datamanager import MongoDocument
+from snapshot import MongoSnapshot
+import fakemongo
+
+colname = 'bench_collection'
+NDOCS = 100000
+
+def fetched(i):
+	return {'_id': ObjectId(), 'name': 'Saruman %d' % i, 'age': i,
+	        'profession': 'wizard', 'tags': ['istar', 'white']}
+
+def plain(session, doc):
+	return doc
+
+def measure(wrap, results):
+	session = fakemongo.make_session()
+	start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	elapsed = 0
+	docs = []
+	for i in range(NDOCS):
+		doc = fetched(i)
+		start = timeit.default_timer()
+		docs.append(wrap(session, doc))
+		elapsed += timeit.default_timer() - start
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_memory
+	results.put((peak / 1024.0, elapsed))
+
+def run(wrap):
+	results = multiprocessing.Queue()
+	process = multiprocessing.Process(target=measure, args=(wrap, results))
+	process.start()
+	result = results.get()
+	process.join()
+	return result
+
+def document(session, doc):
+	return MongoDocument._from_document(session, colname, doc)
+
+def snapshot(session, doc):
+	return MongoSnapshot._from_document(session, colname, doc)
+
+if __name__ == '__main__':
+	print '%d loaded documents of 5 keys' % NDOCS
+	print '%-14s %10s %14s' % ('', 'peak MB', 'wrap (us/doc)')
+	for name, wrap in (('dicts', plain), ('MongoDocument', document),
+	                   ('MongoSnapshot', snapshot)):
+		peak, elapsed = run(wrap)
+		print '%-14s %10.1f %14.2f' % (name, peak, elapsed / NDOCS * 1e6)
@@ -0,0 +1,263 @@
+""" Benchmark suite for the transactional data manager, run offline against
+an in-process fake of MongoDB with simulated latency (see fakemongo.py)
+
+Each benchmark runs in a fresh process, and reports operations per
+second, round trips to the (fake) database per operation, and how much
+the peak memory (RSS) of the process grew while it ran. Results are
+compared with the baseline saved in benchmarks/baseline.json, and
+changes beyond the noise are flagged; --save replaces the baseline with
+the results of the run, so that the baseline changes along with the
+code and regressions show up in its diff.
+Run from the repository root:
+
+	PYTHONPATH=. python benchmarks/suite.py [--latency MS] [--save] [name ...]
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import resource
+import sys
+import timeit
+import transaction
+import connection
+import fakemongo
+from datamanager import MongoDocument
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+LATENCY_MS = 0.5
+DURATION = 1.0 # seconds to run each benchmark for, at least
+SPEED_TOLERANCE = 0.25 # relative change in ops/sec that is flagged
+MEMORY_TOLERANCE = 1.0 # MB of peak memory growth that is flagged
+
+class Wizard(object):
+	def __init__(self, name, spells):
+		self.name = name
+		self.spells = spells
+
+
+def make_session():
+	# a fresh database for each benchmark
+	return fakemongo.make_session('bench_%d' % os.getpid())
+
+def make_docs(session, n, colname='wizards', **values):
+	docs = []
+	for i in range(n):
+		doc = MongoDocument(session, colname)
+		doc['name'] = 'Saruman %d' % i
+		doc['count'] = 0
+		for key, value in values.items():
+			doc[key] = value
+		docs.append(doc)
+	transaction.commit()
+	return docs
+
+#
+# benchmarks: each sets up, then returns a function carrying out one
+# operation
+#
+
+def commit_one(session):
+	""" change one document and commit """
+	doc = make_docs(session, 1)[0]
+	def operation():
+		doc['count'] += 1
+		transaction.commit()
+	return operation
+
+def commit_many(session):
+	""" change 50 documents in two collections and commit """
+	docs = make_docs(session, 25, 'wizards') + make_docs(session, 25, 'hobbits')
+	def operation():
+		for doc in docs:
+			doc['count'] += 1
+		transaction.commit()
+	return operation
+
+def retrieve(session):
+	""" retrieve a document by _id """
+	_id = make_docs(session, 1)[0]['_id']
+	def operation():
+		MongoDocument(session, 'wizards', retrieve={'_id': _id})
+		transaction.abort()
+	return operation
+
+def dbref_walk(session):
+	""" follow a chain of 20 references """
+	docs = make_docs(session, 20)
+	for doc, successor in zip(docs, docs[1:]):
+		doc['next'] = successor
+	transaction.commit()
+	_id = docs[0]['_id']
+	def operation():
+		doc = MongoDocument(session, 'wizards', retrieve={'_id': _id})
+		while doc.has_key('next'):
+			doc = doc['next']
+			doc['name']
+		transaction.abort()
+	return operation
+
+def savepoint_rollback(session):
+	""" savepoint and roll back changes to a 10000 key document """
+	values = dict(('key%d' % i, 'value%d' % i) for i in range(10000))
+	doc = make_docs(session, 1, **values)[0]
+	def operation():
+		for i in range(10):
+			doc['key%d' % i] = 'changed'
+		savepoint = transaction.savepoint()
+		for i in range(10, 20):
+			doc['key%d' % i] = 'changed'
+		savepoint.rollback()
+		transaction.abort()
+	return operation
+
+def jsonpickle_reads(session):
+	""" read every key of a document holding 20 serialized objects """
+	values = {}
+	for i in range(20):
+		values['wizard%d' % i] = Wizard('Saruman', ['fireball'] * 10)
+		values['name%d' % i] = 'Saruman the %d' % i
+	_id = make_docs(session, 1, **values)[0]['_id']
+	doc = MongoDocument(session, 'wizards', retrieve={'_id': _id})
+	keys = doc.keys()
+	def operation():
+		for key in keys:
+			doc[key]
+	return operation
+
+def _contended(session, increment):
+	""" a unit of work updating a hot counter, which another client also
+	updates half of the time in the meantime; conflicts are retried
+	"""
+	_id = make_docs(session, 1)[0]['_id']
+	rival = connection.get_client()[session.db.name]['wizards']
+	random.seed(0)
+	def work():
+		doc = MongoDocument(session, 'wizards', retrieve={'_id': _id})
+		increment(doc)
+		if random.random() < 0.5:
+			rival.update({'_id': _id}, {'$inc': {'count': 1}})
+	def operation():
+		session.run(work, attempts=100, backoff=0)
+	return operation
+
+def conflicts_assign(session):
+	""" contended counter updated by assignment """
+	def increment(doc):
+		doc['count'] = doc['count'] + 1
+	return _contended(session, increment)
+
+def conflicts_inc(session):
+	""" contended counter updated with inc() """
+	def increment(doc):
+		doc.inc('count')
+	return _contended(session, increment)
+
+BENCHMARKS = [commit_one, commit_many, retrieve, dbref_walk,
+              savepoint_rollback, jsonpickle_reads, conflicts_assign,
+              conflicts_inc]
+
+#
+# running and reporting
+#
+
+def measure(benchmark, latency, results):
+	""" Run the benchmark (in a process of its own) and put its results
+	in the queue
+	"""
+	fakemongo.install(latency)
+	session = make_session()
+	operation = benchmark(session)
+	operation() # warm up
+	database = session.db
+	start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	start_trips = database.round_trips
+	start = timeit.default_timer()
+	ops = 0
+	while timeit.default_timer() - start < DURATION:
+		operation()
+		ops += 1
+	elapsed = timeit.default_timer() - start
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_memory
+	results.put({'ops_per_sec': round(ops / elapsed, 1),
+	             'round_trips_per_op': round(float(database.round_trips -
+	                                               start_trips) / ops, 2),
+	             'peak_mb': round(peak / 1024.0, 1)})
+
+def run(benchmark, latency):
+	results = multiprocessing.Queue()
+	process = multiprocessing.Process(target=measure,
+	                                  args=(benchmark, latency, results))
+	process.start()
+	result = results.get()
+	process.join()
+	return result
+
+def regressions(result, baseline):
+	""" The metrics of the result that are worse than the baseline """
+	worse = []
+	if result['ops_per_sec'] < baseline['ops_per_sec'] * (1 - SPEED_TOLERANCE):
+		worse.append('ops_per_sec')
+	if result['round_trips_per_op'] > baseline['round_trips_per_op'] * 1.05:
+		worse.append('round_trips_per_op')
+	if result['peak_mb'] > baseline['peak_mb'] + MEMORY_TOLERANCE:
+		worse.append('peak_mb')
+	return worse
+
+def load_baseline(latency_ms):
+	if not os.path.exists(BASELINE):
+		return {}
+	with open(BASELINE) as f:
+		saved = json.load(f)
+	if saved.get('latency_ms') != latency_ms:
+		print 'baseline was saved with %s ms latency, not comparing' % \
+		      saved.get('latency_ms')
+		return {}
+	return saved['results']
+
+def main(argv):
+	parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+	parser.add_option('--latency', type='float', default=LATENCY_MS,
+	                  help='simulated round trip latency in ms')
+	parser.add_option('--save', action='store_true',
+	                  help='save the results as the new baseline')
+	options, names = parser.parse_args(argv)
+	latency = options.latency / 1e3
+	benchmarks = [benchmark for benchmark in BENCHMARKS
+	              if not names or benchmark.__name__ in names]
+	baseline = load_baseline(options.latency)
+	print 'simulated latency: %.2f ms per round trip' % options.latency
+	print '%-20s %12s %12s %9s   %s' % ('benchmark', 'ops/sec', 'trips/op',
+	                                    'peak MB', 'vs baseline')
+	results = {}
+	flagged = 0
+	for benchmark in benchmarks:
+		name = benchmark.__name__
+		result = results[name] = run(benchmark, latency)
+		comparison = ''
+		if baseline.has_key(name):
+			previous = baseline[name]
+			worse = regressions(result, previous)
+			flagged += len(worse)
+			comparison = '%+.0f%% ops/sec' % (
+			    100.0 * (result['ops_per_sec'] / previous['ops_per_sec'] - 1))
+			if worse:
+				comparison += '  REGRESSION: ' + ', '.join(worse)
+		print '%-20s %12.1f %12.2f %9.1f   %s' % (
+		    name, result['ops_per_sec'], result['round_trips_per_op'],
+		    result['peak_mb'], comparison)
+	if options.save:
+		saved = {'latency_ms': options.latency, 'results': baseline}
+		saved['results'].update(results)
+		with open(BASELINE, 'w') as f:
+			json.dump(saved, f, indent=1, sort_keys=True,
+			          separators=(',', ': '))
+			f.write('\n')
+		print 'saved baseline to ' + BASELINE
+	return 1 if flagged else 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,89 @@
+""" Vote-time validation of MongoObjects with declared fields
+
+Compares the validator compiled from a class's schema (one pass over the
+changed keys checking required fields, keys and value types) against
+separate passes like those tpc_vote used to make: a loop over the
+required fields, a filter over all the keys, and a BSON check of each
+value. Documents written as a whole (new ones) are encoded either way.
+Run from the repository root:
+
+	PYTHONPATH=. python benchmarks/validation_benchmark.py
+"""
+
+import timeit
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+from orm import MongoObject
+from validation import bson_compatible, valid_key
+import fakemongo
+
+colname = 'bench_collection'
+SIZES = (10, 100, 1000)
+CHANGED = 5 # keys changed by an update
+REPEAT = 200
+
+def make_class(size):
+	fields = {}
+	for i in range(size):
+		fields['name%d' % i] = basestring
+		fields['age%d' % i] = (int, long)
+		fields['weight%d' % i] = float
+	class Wizard(MongoObject):
+		__collection__ = colname
+		__requiredfields__ = tuple(sorted(fields)[:10])
+		__fields__ = fields
+	return Wizard
+
+def make_document(cls, size, new):
+	stored = {'_id': 1}
+	for i in range(size):
+		stored['name%d' % i] = 'Saruman the %d' % i
+		stored['age%d' % i] = i
+		stored['weight%d' % i] = i / 3.0
+	obj = cls(fakemongo.make_session(transactional=False))
+	if new:
+		obj.uncommitted.update(stored)
+	else:
+		obj._load(stored)
+		for i in range(CHANGED):
+			obj['age%d' % i] = i + 1
+	return obj
+
+def separate_passes(obj):
+	for field in obj.__requiredfields__:
+		if not obj.has_key(field):
+			raise Exception('Required field missing: ' + field)
+	overlay = obj.uncommitted
+	whole = overlay.replaced or not obj.committed
+	keys = overlay.keys() if whole else overlay.changes.keys()
+	if filter(lambda f: not valid_key(f), keys):
+		raise Exception('Invalid key')
+	if whole:
+		RawBSONDocument(BSON.encode(overlay.copy()))
+	else:
+		for key, value in overlay.changes.items():
+			if not bson_compatible(value):
+				BSON.encode({key: value})
+
+def compiled(obj):
+	obj._validate()
+
+def bench(validate, obj):
+	start = timeit.default_timer()
+	for i in range(REPEAT):
+		validate(obj)
+	return (timeit.default_timer() - start) / REPEAT
+
+if __name__ == '__main__':
+	print 'validation per vote, documents with 3 * size declared fields' \
+	      ' (%d changed by updates)' % CHANGED
+	print '%-8s %-7s %14s %14s' % ('size', 'write', 'separate (us)',
+	                               'compiled (us)')
+	for size in SIZES:
+		cls = make_class(size)
+		for new in (True, False):
+			obj = make_document(cls, size, new)
+			print '%-8d %-7s %14.1f %14.1f' % (
+			    size, 'insert' if new else 'update',
+			    bench(separate_passes, obj) * 1e6,
+			    bench(compiled, obj) * 1e6)
@@ -1,40 +1,110 @@
-from pymongo import MongoClient
 import transaction
 import hooks
+import connection
+import retry
+import threadpools
+from identitymap import IdentityMap
 
 class Session(object):
 	""" Holds database info, and whether the session is to be
 	transactional or not (default yes). A single session object
 	can be shared by multiple participants in a transaction.
+	If identity_map is true, documents loaded by _id (including
+	dereferenced documents) are cached per session, so that repeated loads
+	of a document in a unit of work return the same instance without a
+	query. The cache holds at most identity_map_size documents (None for
+	no bound) and only holds documents loaded in the current transaction.
+	Sessions with the same host, port and client options share a pooled
+	client (see connection.ClientRegistry); client options are passed on
+	to MongoClient, e.g. maxPoolSize=50, connectTimeoutMS=2000 or
+	connect=False.
+	If commit_threads is set, the database operations of each commit
+	phase are carried out concurrently for the different collections
+	taking part in a transaction, on a pool of that many threads, shared
+	by the sessions with the same commit_threads (see
+	threadpools.ThreadPoolRegistry). The outcome of the transaction is
+	the same either way.
+	If versioned is true, concurrent modifications are detected using a
+	version number kept in each document (the '_v' key) rather than by
+	marking documents as pending and reading them back: each document is
+	written with a single update that only applies if its version is
+	still the one that was loaded, and writes are undone if the
+	transaction fails. Writes are then visible to other readers from the
+	vote until the transaction finishes or aborts.
+	If merge is true, several data managers (e.g. loaded independently by
+	different components) can change the same document in a transaction:
+	their changes are merged key by key when it is committed, and the
+	document is locked, checked for concurrent modifications and written
+	once. Keys changed differently by more than one of them (and deleting
+	or replacing a document another one changed) abort the commit with
+	MergeConflictError. Otherwise such a transaction fails with
+	DuplicateDataManagersError.
+	Each committed transaction is recorded in the database's
+	'transactions' collection; records of finished transactions expire
+	after transaction_ttl seconds (None to keep them). The collection is
+	indexed as the first transaction commits (see txnlog.ensure_indexes),
+	so creating a session doesn't talk to the database.
+	Latencies, round trips and other counts are reported to
+	instrumentation, if given (see instrumentation.Instrumentation and
+	instrumentation.Metrics).
 	"""
-	def __init__(self, dbname, host=None, port=None, transactional=True):
-		self.connection = MongoClient(host, port)
+	def __init__(self, dbname, host=None, port=None, transactional=True,
+	             identity_map=False, identity_map_size=1000,
+	             commit_threads=None, versioned=False, merge=False,
+	             transaction_ttl=86400, instrumentation=None,
+	             **client_options):
+		self.connection = connection.get_client(host, port, **client_options)
 		self.db = self.connection[dbname]
 		self.transactional = transactional
+		self.versioned = versioned
+		self.merge = merge
+		self.transaction_ttl = transaction_ttl
+		self.instrumentation = instrumentation
+		if identity_map:
+			self.identity_map = IdentityMap(identity_map_size)
+		else:
+			self.identity_map = None
 		self.active = False
-		self.queue = []
+		self.coordinator = None # batches commit operations, per transaction
+		self.conflict_stats = retry.ConflictStats()
+		self.commit_threads = commit_threads
 		self.begin()
 
+	@property
+	def commit_pool(self):
+		""" The shared pool commits are carried out on, if the session
+		has commit_threads (fetched on each use, so that sessions get a new
+		pool after threadpools.shutdown())
+		"""
+		if not self.commit_threads:
+			return None
+		return threadpools.get_pool(self.commit_threads)
+
 	def begin(self):
 		""" On subsequent transactions after the initial one,
 		a session can simply be begun again instead of a
-		new instance being created.
+		new instance being created. The mongo-specific hooks are added to
+		each transaction as the session's documents join it.
 		"""
 		if self.transactional and not self.active:
-			txn = transaction.get()
-			txn.addBeforeCommitHook(hooks.mongo_listener_prehook,
-			                        args=(), kws={})
-			txn.addAfterCommitHook(hooks.mongo_listener_posthook,
-			                       args=(), kws={'session':self})
 			self.active = True
 
+	def run(self, work, attempts=5, backoff=0.01, max_backoff=1.0):
+		""" Run the unit of work (a callable) in a transaction and commit
+		it, retrying with jittered exponential backoff if it conflicts with
+		another transaction (see retry.run). Conflicts and retries are
+		counted per collection in self.conflict_stats.
+		"""
+		return retry.run(work, attempts, backoff, max_backoff,
+		                 self.conflict_stats)
+
 	def close(self):
 		""" End a session. This should be called at the end of interaction
-		with the db, to remove mongo-specific hooks from the transaction.
-		The session can be begun again by calling begin().
+		with the db; documents can no longer be changed transactionally
+		using the session. The session can be begun again by calling
+		begin().
 		Note: If there are changes already queued in the current
 		transaction, these will give an error if a commit is attempted;
 		they should be aborted by using transaction.abort().
 		"""
 		self.active = False
-
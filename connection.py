@@ -0,0 +1,70 @@
+""" Process-wide registry of pooled mongodb clients """
+
+import os
+import threading
+from pymongo import MongoClient
+
+
+class ClientRegistry(object):
+	""" Hands out one MongoClient per distinct set of connection parameters
+	(host, port and client options such as maxPoolSize, connectTimeoutMS,
+	socketTimeoutMS, serverSelectionTimeoutMS, waitQueueTimeoutMS or
+	connect=False for lazy connection), so that sessions connecting to the
+	same server share a connection pool instead of each opening its own.
+	Clients are not carried over into a forked process: the first request
+	for a client after a fork discards the parent's clients (without
+	closing them, since their sockets belong to the parent) and starts
+	afresh.
+	"""
+
+	def __init__(self, client_class=MongoClient):
+		self.client_class = client_class
+		self.clients = {}
+		self.lock = threading.Lock()
+		self.pid = os.getpid()
+
+	def _key(self, host, port, options):
+		return (host, port, tuple(sorted(options.items())))
+
+	def _check_fork(self):
+		if self.pid != os.getpid():
+			self.clients = {}
+			self.lock = threading.Lock()
+			self.pid = os.getpid()
+
+	def get(self, host=None, port=None, **options):
+		""" The shared client for the given connection parameters, created
+		on first use.
+		"""
+		self._check_fork()
+		key = self._key(host, port, options)
+		with self.lock:
+			client = self.clients.get(key)
+			if client is None:
+				client = self.client_class(host, port, **options)
+				self.clients[key] = client
+			return client
+
+	def __len__(self):
+		return len(self.clients)
+
+	def shutdown(self):
+		""" Close all clients. Clients requested afterwards are created
+		anew.
+		"""
+		self._check_fork()
+		with self.lock:
+			clients = self.clients.values()
+			self.clients = {}
+		for client in clients:
+			client.close()
+
+
+registry = ClientRegistry()
+
+def get_client(host=None, port=None, **options):
+	return registry.get(host, port, **options)
+
+def shutdown():
+	""" Close all shared clients, e.g. when the process exits """
+	registry.shutdown()
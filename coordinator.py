@@ -0,0 +1,415 @@
+""" Transaction coordinator: batches the mongodb side of the two-phase
+commit across all participating data managers """
+
+import logging
+import sys
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+import instrumentation
+import support
+from mongomorphism.exceptions import (
+		ConcurrentModificationError,
+		PartialCommitError,
+		)
+
+
+logger = logging.getLogger(__name__)
+
+
+class TransactionCoordinator(object):
+	""" Performs the database operations of the two-phase commit on behalf
+	of all of a session's data managers participating in a transaction.
+	Data managers are grouped by collection, and each phase is carried out
+	once for the whole group (on the first call from any member) as a
+	single bulk operation per collection, instead of one or more round
+	trips per document. If the session has a commit pool (see
+	config.Session), the operations on different collections are carried
+	out concurrently on it.
+	In a versioned session (see config.Session) documents aren't marked
+	as pending and read back; instead each document is written in the
+	vote with a single update conditional on the version it was loaded
+	at, and the writes are undone if the transaction aborts.
+	In a merging session (see config.Session) the changes of the data
+	managers for the same document are folded into the first of them to
+	join the transaction, which is locked, checked and written on behalf
+	of all of them.
+	"""
+
+	def __init__(self, session, datamanagers, txn=None):
+		self.session = session
+		self.transaction = txn
+		self.groups = {} # collection name -> (collection, [dm, ...])
+		self.members = set([id(dm) for dm in datamanagers])
+		self.merged = {} # id of dm -> [dm's whose changes it writes]
+		if getattr(session, 'merge', False):
+			datamanagers = self._merge(datamanagers)
+		for dm in datamanagers:
+			collection = dm.collection
+			if not self.groups.has_key(collection.name):
+				self.groups[collection.name] = (collection, [])
+			self.groups[collection.name][1].append(dm)
+		self.versioned = getattr(session, 'versioned', False)
+		self.instrumentation = instrumentation.get(session)
+		self.begun = False
+		self.fetched = None # collection name -> {doc_id: db document}
+		self.locks = None # collection name -> set of doc_id's locked by
+		                  # other transactions
+		self.voted = set()
+		self.written = None # (collection, operation, args) to undo writes
+		self.finished = False
+		self.aborted = False
+		self.released = False # whether the abort released all locks
+
+	def _merge(self, datamanagers):
+		""" Merge the changes of the data managers for the same document
+		(see MongoDocument._merge()), returning the data managers that
+		write them
+		"""
+		writers = []
+		documents = {} # (collection name, doc_id) -> writing dm
+		for dm in datamanagers:
+			key = (dm.collection.name, dm.doc_id)
+			writer = documents.get(key) if dm.doc_id else None
+			if writer is None:
+				documents[key] = dm
+				writers.append(dm)
+			else:
+				writer._merge(dm)
+				self.merged.setdefault(id(writer), []).append(dm)
+		return writers
+
+	def manages(self, dm, txn):
+		""" Whether this coordinator is responsible for the given data
+		manager in the given transaction.
+		"""
+		return self.transaction is txn and id(dm) in self.members
+
+	def _existing(self, dms):
+		""" _id's of the documents that already exist in the database, and
+		are to be locked (see MongoDocument._commutative())
+		"""
+		return [dm.committed['_id'] for dm in dms
+		        if dm.committed and not dm._commutative()]
+
+	def _round_trips(self, collection, count=1):
+		self.instrumentation.count('round_trips', count, collection.name)
+
+	def _map(self, phase, function):
+		""" Apply the function to each (collection, data managers) group,
+		concurrently on the session's commit pool if it has one, timing
+		it as the given phase. All of the groups are processed even if
+		some fail, and then the first error (in group order) is raised.
+		"""
+		groups = self.groups.values()
+		def timed(group):
+			with self.instrumentation.timed(phase, group[0].name):
+				return function(group)
+		pool = getattr(self.session, 'commit_pool', None)
+		if pool is None or len(groups) < 2:
+			return map(timed, groups)
+		def call(group):
+			try:
+				return (timed(group), None)
+			except:
+				return (None, sys.exc_info())
+		outcomes = pool.map(call, groups)
+		for result, error in outcomes:
+			if error is not None:
+				raise error[0], error[1], error[2]
+		return [result for result, error in outcomes]
+
+	def tpc_begin(self):
+		""" Mark all existing documents as pending in this transaction """
+		if self.begun or self.versioned:
+			return
+		self.begun = True
+		self._map('tpc_begin', self._begin)
+
+	def _begin(self, group):
+		collection, dms = group
+		ids = self._existing(dms)
+		if ids:
+			collection.update({'_id': {'$in': ids}},
+			                  {'$push':
+			                  {'pending_transactions':
+			                  support.ActiveTransaction.transaction_id}},
+			                  multi=True)
+			self._round_trips(collection)
+
+	def fetch(self, dm):
+		""" Return the current database version of the data manager's
+		document (or None if it no longer exists). All the documents in
+		the transaction are read back together on the first call.
+		"""
+		if self.fetched is None:
+			self.fetched = dict(self._map('tpc_vote', self._fetch))
+		doc = self.fetched[dm.collection.name].get(str(dm.committed['_id']))
+		if doc is not None and self.merged:
+			doc = dict(doc) # checked by each of the merged data managers
+		return doc
+
+	def locked(self, dm):
+		""" Whether the document of a data manager that is only updated
+		with operators (and so isn't locked by this transaction) is
+		locked by another transaction. All such documents in the
+		transaction are checked together on the first call.
+		"""
+		if self.locks is None:
+			self.locks = dict(self._map('tpc_vote', self._locks))
+		return str(dm.committed['_id']) in self.locks[dm.collection.name]
+
+	def _locks(self, group):
+		collection, dms = group
+		ids = [dm.committed['_id'] for dm in dms
+		       if dm.committed and dm._commutative()]
+		locked = set()
+		if ids:
+			for doc in collection.find({'_id': {'$in': ids},
+			                            'pending_transactions':
+			                            {'$exists': True}}, {'_id': 1}):
+				locked.add(str(doc['_id']))
+			self._round_trips(collection)
+		return (collection.name, locked)
+
+	def _fetch(self, group):
+		collection, dms = group
+		# partially loaded documents are only read back in part, with one
+		# query per distinct projection
+		projections = {}
+		for dm in dms:
+			fields = dm._readback_fields()
+			for merged in self.merged.get(id(dm), ()):
+				if merged._readback_fields() != fields:
+					fields = None # read back whole, for all of them
+			key = fields and tuple(sorted(fields.items()))
+			projections.setdefault(key, (fields, []))[1].append(dm)
+		found = {}
+		for fields, members in projections.values():
+			ids = self._existing(members)
+			if ids:
+				for doc in collection.find({'_id': {'$in': ids}}, fields):
+					found[str(doc['_id'])] = doc
+				self._round_trips(collection)
+		return (collection.name, found)
+
+	def vote(self, dm):
+		""" In a versioned session, record that the data manager is ready
+		to be written, and once all are, write all documents, each
+		conditional on its version being the one the document was loaded
+		at. Raises ConcurrentModificationError if any was modified
+		concurrently.
+		"""
+		self.voted.add(id(dm))
+		if self.written is not None or len(self.voted) < len(self.members):
+			return
+		self.written = []
+		self._map('tpc_vote', self._write)
+
+	def _write(self, group):
+		collection, dms = group
+		for dm in dms:
+			if dm.uncommitted == None: # document should be deleted
+				if not dm.committed:
+					continue
+				undo = ('insert', (self._stored(collection, dm),))
+				result = collection.remove(self._selector(dm))
+			elif dm.committed:
+				version = {'_id': dm.committed['_id'],
+				           support.VERSION_KEY:
+				           dm.uncommitted[support.VERSION_KEY]}
+				if dm.uncommitted.replaced:
+					update = self._document(dm)
+					# only whole documents can be replaced
+					undo = ('update', (version, dict(dm.committed)))
+				else:
+					update = dm.diff()
+					undo = ('update', (version, self._restore(collection, dm)))
+				result = collection.update(self._selector(dm), update)
+			else:
+				if not dm.uncommitted.has_key('_id'):
+					dm.uncommitted['_id'] = ObjectId()
+				try:
+					collection.insert(self._document(dm))
+				except DuplicateKeyError:
+					raise ConcurrentModificationError(
+					    'Concurrent modification! Transaction aborting...',
+					    collection.name)
+				result = {'n': 1}
+				undo = ('remove',
+				        ({'_id': dm.uncommitted['_id'],
+				          support.VERSION_KEY:
+				          dm.uncommitted[support.VERSION_KEY]},))
+			self._round_trips(collection)
+			if not result['n']:
+				raise ConcurrentModificationError(
+				    'Concurrent modification! Transaction aborting...',
+				    collection.name)
+			self.written.append((collection, undo[0], undo[1]))
+
+	def _stored(self, collection, dm):
+		""" The whole document as loaded, to insert it again if its
+		removal is undone (a partially loaded document is read whole)
+		"""
+		if dm.fields is None:
+			return dict(dm.committed)
+		stored = collection.find_one(self._selector(dm))
+		self._round_trips(collection)
+		if stored is None:
+			raise ConcurrentModificationError(
+			    'Concurrent modification! Transaction aborting...',
+			    collection.name)
+		return stored
+
+	def _restore(self, collection, dm):
+		""" The update undoing the update of the changed keys: they are
+		set back to their loaded values, or unset if the document didn't
+		have them. The values of changed keys that weren't loaded (of a
+		partially loaded document) are read first.
+		"""
+		overlay = dm.uncommitted
+		keys = [key for key in overlay.changes.keys() + list(overlay.deleted)
+		        if key != '_id']
+		loaded = dm.committed
+		missing = [key for key in keys if not dm._loaded(key)]
+		if missing:
+			stored = collection.find_one(self._selector(dm),
+			                             dict.fromkeys(missing, 1))
+			self._round_trips(collection)
+			if stored is None:
+				raise ConcurrentModificationError(
+				    'Concurrent modification! Transaction aborting...',
+				    collection.name)
+			loaded = dict(dm.committed)
+			loaded.update(stored)
+		update = {}
+		for key in keys:
+			if loaded.has_key(key):
+				update.setdefault('$set', {})[key] = loaded[key]
+			else:
+				update.setdefault('$unset', {})[key] = 1
+		return update
+
+	def _selector(self, dm):
+		""" Matches the document only at the version it was loaded at (a
+		document that was never written in a versioned session has no
+		version, which matches null).
+		"""
+		return {'_id': dm.committed['_id'],
+		        support.VERSION_KEY: dm.committed.get(support.VERSION_KEY)}
+
+	def _document(self, dm):
+		""" The document to write as a whole: the one already encoded
+		when the data manager voted, if any.
+		"""
+		if getattr(dm, '_encoded', None) is not None:
+			return dm._encoded
+		return dm.uncommitted.copy()
+
+	def tpc_finish(self):
+		""" Write all documents: removals, updates and inserts for each
+		collection are sent as one ordered bulk operation.
+		"""
+		if self.finished:
+			return
+		self.finished = True
+		self._map('tpc_finish', self._finish)
+
+	def _finish(self, group):
+		collection, dms = group
+		missed = 0
+		if not self.versioned: # otherwise already written in the vote
+			missed = self._write_bulk(collection, dms)
+		for dm in dms:
+			if dm.uncommitted == None:
+				dm.uncommitted = {}
+			dm._saved()
+			for merged in self.merged.get(id(dm), ()):
+				merged._saved_as(dm)
+		if missed:
+			# the rest has been written: retrying would write it twice
+			raise PartialCommitError(
+			    '%d document(s) locked by another transaction since the'
+			    ' vote were not written' % missed, collection.name)
+
+	def _write_bulk(self, collection, dms):
+		""" Write the group's documents, returning the number of updates
+		that didn't apply """
+		bulk = collection.initialize_ordered_bulk_op()
+		operations = 0
+		updates = 0
+		for dm in dms:
+			if dm.uncommitted == None: # document should be deleted
+				if dm.committed:
+					bulk.find({'_id': dm.committed['_id']}).remove_one()
+					operations += 1
+			elif dm.committed:
+				spec = {'_id': dm.committed['_id']}
+				if dm.uncommitted.replaced:
+					bulk.find(spec).replace_one(self._document(dm))
+				else:
+					# also release the pending transaction, which
+					# a replacement does implicitly. Documents only
+					# updated with operators weren't locked, and must not
+					# have been locked by another transaction since
+					update = dm.diff()
+					if dm._commutative():
+						spec['pending_transactions'] = {'$exists': False}
+					else:
+						update.setdefault('$unset', {})[
+						    'pending_transactions'] = 1
+					bulk.find(spec).update_one(update)
+				operations += 1
+				updates += 1
+			else:
+				if not dm.uncommitted.has_key('_id'):
+					dm.uncommitted['_id'] = ObjectId()
+				bulk.insert(self._document(dm))
+				operations += 1
+		if not operations:
+			return 0
+		result = bulk.execute()
+		self._round_trips(collection)
+		# (unacknowledged writes aren't reported)
+		if result is None:
+			return 0
+		return updates - result['nMatched']
+
+	def tpc_abort(self):
+		""" Release the pending transaction on all existing documents (or
+		in a versioned session, undo the writes made in the vote)
+		"""
+		if self.aborted:
+			return
+		self.aborted = True
+		if self.versioned:
+			# undo whatever was written in the vote, as long as the
+			# document is still at the version written
+			for collection, operation, args in reversed(self.written or []):
+				with self.instrumentation.timed('tpc_abort', collection.name):
+					getattr(collection, operation)(*args)
+				self._round_trips(collection)
+		else:
+			self._map('tpc_abort', self._abort)
+		self.released = True
+
+	def holds_locks(self):
+		""" Whether documents may still be marked as pending in this
+		transaction: it marked them, and hasn't finished or released them
+		"""
+		return self.begun and not (self.finished or self.released)
+
+	def _abort(self, group):
+		collection, dms = group
+		ids = self._existing(dms)
+		if not ids:
+			return
+		collection.update(
+		    {'_id': {'$in': ids}},
+		    {'$pull': {'pending_transactions':
+		    support.ActiveTransaction.transaction_id}},
+		    multi=True)
+		collection.update({'_id': {'$in': ids},
+		                   'pending_transactions': {'$size': 0}},
+		                  {'$unset': {'pending_transactions': 1}},
+		                  multi=True)
+		self._round_trips(collection, 2)
@@ -1,28 +1,275 @@
 import logging
+import re
 from bson.dbref import DBRef
+from bson.objectid import ObjectId
 from bson import BSON
+from bson.raw_bson import RawBSONDocument
+from bson.regex import Regex
 import jsonpickle
 import transaction
-from transaction.interfaces import TransientError
 import support
+import hooks
+import instrumentation
 from support import mutative_operation
+from coordinator import TransactionCoordinator
+from overlay import DocumentOverlay
+from validation import bson_compatible, valid_key
 from mongomorphism.exceptions import (
+		ConcurrentModificationError,
 		DocumentNotFoundError,
 		DocumentMatchNotUniqueError,
+		MergeConflictError,
+		PartialDocumentError,
 		SessionNotInitializedError,
 		)
 
 
 logger = logging.getLogger(__name__)
 
+_PICKLED = object() # marks values known to be jsonpickle-encoded
+_INTEGER = re.compile(r'-?[0-9]+\Z')
+_PATTERN_TYPES = (type(_INTEGER), Regex) # matched by mongodb, not compared
+
+
+def _decode(raw):
+	""" The value a string loaded from the db stands for. Values that
+	can't be stored as BSON are stored jsonpickle-encoded (see
+	MongoDocument.__setitem__), which gives a JSON object or array, or a
+	bare number for integers too large for BSON; any other string was
+	stored as it is.
+	"""
+	first = raw[:1]
+	if first == '{' or first == '[':
+		try:
+			return jsonpickle.decode(raw)
+		except Exception:
+			return raw
+	if (first == '-' or first.isdigit()) and _INTEGER.match(raw):
+		value = long(raw)
+		if not bson_compatible(value):
+			return value
+	return raw
+
+
+def _is_id_spec(spec):
+	""" Whether the retrieve spec selects a single document by its _id """
+	return (spec.keys() == ['_id'] and
+	        not isinstance(spec['_id'], dict))
+
+def _is_equality_spec(spec):
+	""" Whether the retrieve spec only matches top-level keys by equality,
+	so that documents can be matched against it without a query.
+	"""
+	for key, value in spec.items():
+		if key.startswith('$') or '.' in key:
+			return False
+		if isinstance(value, _PATTERN_TYPES):
+			return False
+		if isinstance(value, dict) and filter(lambda f: f.startswith('$'),
+		                                      value.keys()):
+			return False
+	return True
+
+def _matches(doc, spec):
+	for key, value in spec.items():
+		dbvalue = doc.get(key)
+		if dbvalue != value and not (isinstance(dbvalue, list) and
+		                             value in dbvalue):
+			return False
+	return True
+
+def _single_match(matches, retrieve):
+	""" The one document matching the retrieve spec; if provided keys are
+	not sufficient to retrieve unique document or if no document matched,
+	throw an exception here
+	"""
+	if not matches:
+		raise DocumentNotFoundError('Document not found!'
+		                            + str(retrieve))
+	if len(matches) > 1:
+		raise DocumentMatchNotUniqueError(
+		    'Multiple matches for document, should be unique:'
+		    + str(retrieve))
+	return matches[0]
+
+def _retrieve(collection, retrieve, fields=None):
+	""" Fetch the one document matching the retrieve spec (only the part
+	of it selected by the projection, if one is given)
+	"""
+	if _is_id_spec(retrieve):
+		# _id is unique, no need to check for further matches
+		doc = collection.find_one(retrieve, fields)
+		matches = [doc] if doc is not None else []
+	else:
+		# a second match, if any, is enough to tell that the document
+		# isn't unique
+		matches = list(collection.find(retrieve, fields).limit(2))
+	return _single_match(matches, retrieve)
+
+
+def _projection(fields):
+	""" The projection selecting the given fields (a list of keys, or a
+	dict of keys to include or exclude), for loading a partial document.
+	Only top-level keys can be selected, and the _id is always loaded.
+	"""
+	if not fields: # selects the whole document
+		return None
+	if not isinstance(fields, dict):
+		fields = dict([(key, 1) for key in fields])
+	for key, value in fields.items():
+		if '.' in key or key.startswith('$'):
+			raise PartialDocumentError('Only top-level keys can be'
+			                           ' selected: ' + key)
+		if key == '_id' and not value:
+			raise PartialDocumentError('Documents must be loaded with'
+			                           ' their _id')
+	return fields
+
+def _load_projection(session, fields):
+	""" The projection to load documents with in the session, for the
+	fields (see _projection)
+	"""
+	fields = _projection(fields)
+	if fields is not None and getattr(session, 'versioned', False):
+		# writes are conditional on the version
+		fields = _include(fields, [support.VERSION_KEY])
+	return fields
+
+def _inclusive(fields):
+	""" Whether the projection lists the keys to include (rather than the
+	keys to exclude)
+	"""
+	others = [fields[key] for key in fields.keys() if key != '_id']
+	return not others or bool(filter(None, others))
+
+def _included(fields, key):
+	""" Whether the key is part of documents loaded with the projection """
+	if fields is None or key == '_id':
+		return True
+	if _inclusive(fields):
+		return bool(fields.get(key))
+	return fields.get(key, 1) != 0
+
+def _project(doc, fields):
+	""" The part of the whole document selected by the projection """
+	if fields is None:
+		return doc
+	return dict([(key, value) for key, value in doc.items()
+	             if _included(fields, key)])
+
+def _include(fields, keys):
+	""" The projection extended to include the given keys (None if that
+	leaves nothing excluded)
+	"""
+	fields = dict(fields)
+	if _inclusive(fields):
+		for key in keys:
+			fields[key] = 1
+		return fields
+	for key in keys:
+		fields.pop(key, None)
+	if not filter(lambda f: f != '_id', fields.keys()):
+		return None
+	return fields
+
+def _unchanged(overlay):
+	return not (overlay.changes or overlay.deleted or overlay.replaced)
+
+def _identity_map(session):
+	""" The session's identity map, if it has one, holding only documents
+	loaded in the current transaction (unit of work).
+	"""
+	identity_map = getattr(session, 'identity_map', None)
+	if identity_map is not None:
+		identity_map.scope(transaction.get())
+	return identity_map
+
+def prefetch(docs, name):
+	""" Load the documents referenced (as DBRefs) by the given key of each
+	of the documents, using one $in query per referenced collection
+	instead of one query per reference. Subsequently accessing the key on
+	any of the documents in the current transaction returns the loaded
+	document without querying the database.
+	"""
+	txn = transaction.get()
+	registry = support.get_registry(txn)
+	pending = [] # (referring doc, reference)
+	ids = {} # (session, referenced collection) -> {doc_id: _id}
+	for doc in docs:
+		ref = doc.uncommitted.get(name)
+		if (not isinstance(ref, DBRef) or
+		        registry.lookup(ref.collection, ref.id) is not None or
+		        doc._cached_reference(name, ref) is not None):
+			continue
+		pending.append((doc, ref))
+		key = (doc.session, ref.collection)
+		ids.setdefault(key, {})[str(ref.id)] = ref.id
+	loaded = {} # (session, collection, doc_id) -> document
+	for (session, colname), colids in ids.items():
+		for committed in session.db[colname].find(
+		        {'_id': {'$in': colids.values()}}):
+			doc_id = str(committed['_id'])
+			loaded[(session, colname, doc_id)] = \
+			    MongoDocument._from_document(session, colname, committed)
+	for doc, ref in pending:
+		target = loaded.get((doc.session, ref.collection, str(ref.id)))
+		if target is not None: # dangling references are left unresolved
+			doc._cache_reference(name, ref, target)
+
+
+class DocumentReference(object):
+	""" Stands in for a document referenced by another document, and only
+	loads it when it is first used, at which point everything is delegated
+	to the loaded MongoDocument.
+	"""
+
+	def __init__(self, dm, name, ref):
+		self._dm = dm
+		self._name = name
+		self._ref = ref
+		self._doc = None
+
+	def _resolve(self):
+		if self._doc is None:
+			self._doc = self._dm._dereference(self._name, self._ref)
+		return self._doc
+
+	def __getattr__(self, attr):
+		if attr.startswith('__'):
+			raise AttributeError(attr)
+		return getattr(self._resolve(), attr)
+
+	def __getitem__(self, name):
+		return self._resolve()[name]
+
+	def __setitem__(self, name, value):
+		self._resolve()[name] = value
+
+	def __delitem__(self, name):
+		del self._resolve()[name]
+
+	def __len__(self):
+		return len(self._resolve())
+
+	def __repr__(self):
+		return repr(self._resolve())
+
 
 class MongoSavepoint(object):
+	""" Savepoints only hold on to the layer of uncommitted changes, not
+	to a copy of the document.
+	"""
 	def __init__(self, dm):
 		self.dm = dm
-		self.saved_committed = self.dm.uncommitted.copy()
+		self.saved_changes = self._snapshot(self.dm._overlay)
 	
 	def rollback(self):
-		self.dm.uncommitted = self.saved_committed.copy()
+		self.dm._overlay = self._snapshot(self.saved_changes)
+
+	def _snapshot(self, overlay):
+		if overlay is None: # document is to be deleted
+			return None
+		return overlay.snapshot()
 
 class MongoDocument(object):
 	""" A Mongodb data manager. A MongoDocument represents a document in mongo
@@ -31,89 +278,276 @@ class MongoDocument(object):
 	mongodb by interfacing with the python 'transaction' package. Changes will
 	be persisted only if the transaction succeeds. If non-transactional,
 	then save() and delete() methods may be used.
+	Instances have no __dict__, to keep the overhead of holding many
+	documents low: subclasses adding no attributes of their own can declare
+	an empty __slots__ to stay as compact.
 	"""
 
+	__slots__ = ('session', 'collection', 'committed', 'fields', '_stale',
+	             '_overlay', '_references', '_references_txn', '_decoded',
+	             '_encoded', '_own_coordinator', '__weakref__')
+
 	transaction_manager = transaction.manager
 	mongo_data_manager = True # internal: for transaction hook injection
 
-	def __init__(self, session, colname, retrieve=None):
+	def __new__(cls, session, colname, retrieve=None, fields=None):
+		# documents retrieved by _id may already be loaded in the session
+		identity_map = _identity_map(session)
+		if (identity_map is not None and retrieve is not None and
+		        _is_id_spec(retrieve)):
+			doc = identity_map.get(colname, retrieve['_id'], cls)
+			if doc is not None:
+				return doc
+		return super(MongoDocument, cls).__new__(cls)
+
+	def __init__(self, session, colname, retrieve=None, fields=None):
 		""" Note, if using this as a data manager for the python transaction
 		package, by default this will automatically join the current
 		transaction. If you'd like to do it manually,
-		set transactional=False here
+		set transactional=False here.
+		If fields (a list of keys, or a dict of keys to include or exclude)
+		is given with retrieve, only those keys are loaded; see
+		_fault().
 		"""
-		try:
-			self.session = session
-			self.collection = self.session.db[colname]
-		except:
-			logger.error('Cannot connect to Mongo server!')
-			raise
+		if hasattr(self, 'committed'):
+			return # already loaded instance from the session's identity map
+		self.session = session
+		self.collection = session.db[colname]
 
 		committed = {}
 		if retrieve is not None:
-			# if provided keys are not sufficient to retrieve unique document
-			# or if no document returned, throw an exception here
-			matchingdocs = self.collection.find(retrieve)
-			if matchingdocs.count() == 0:
-				raise DocumentNotFoundError('Document not found!'
-				                            + str(retrieve))
-			if matchingdocs.count() > 1:
-				raise DocumentMatchNotUniqueError(
-				    'Multiple matches for document, should be unique:'
-				    + str(retrieve))
-			committed = matchingdocs.next()
+			fields = _load_projection(session, fields)
+			measure = instrumentation.get(session)
+			with measure.timed('retrieve', colname, type(self).__name__):
+				committed = _retrieve(self.collection, retrieve, fields)
+			measure.count('round_trips', 1, colname, type(self).__name__)
+		else:
+			fields = None # a new document is whole
+		self._load(committed, fields)
 
+	def _load(self, committed, fields=None):
 		self.committed = committed
-		self.uncommitted = self.committed.copy()
-		self.queued = {}
+		self.fields = fields # projection, if only partially loaded
+		self._stale = None # keys to load again, see _saved()
+		self._overlay = DocumentOverlay(committed)
+		# caches, allocated when first needed
+		self._references = None # key -> (DBRef, referenced document)
+		self._references_txn = None # transaction they were loaded in
+		self._decoded = None # key -> (stored value, decoded value)
+		self._encoded = None # the document as encoded by tpc_vote
 
+		if fields is None and committed.has_key('_id'):
+			identity_map = _identity_map(self.session)
+			if identity_map is not None:
+				identity_map.add(self)
+
+	def _get_doc_id(self):
 		# is _id unique across the entire database? If not, then use a SHA hash
 		# of this concatenated with db id, to make sure there are no
 		# false positives for duplicated dm's for same doc
-		if self.uncommitted.has_key('_id'):
-			self.doc_id = str(self.uncommitted['_id'])
+		if self.committed.has_key('_id'):
+			return str(self.committed['_id'])
+		overlay = self._overlay
+		if overlay is not None and overlay.has_key('_id'):
+			return str(overlay['_id']) # given ahead of insertion
+		return None
+
+	# the _id of the document as a string, to key it by (None if it doesn't
+	# have one yet); computed when needed rather than for every document
+	doc_id = property(_get_doc_id)
+
+	@classmethod
+	def _from_document(cls, session, colname, committed, fields=None):
+		""" Instance for a document that has already been fetched from the
+		database (or the instance already loaded for it in the session),
+		using the given projection, if any.
+		"""
+		identity_map = _identity_map(session)
+		if identity_map is not None:
+			doc = identity_map.get(colname, committed['_id'], cls)
+			if doc is not None:
+				return doc
+		doc = object.__new__(cls)
+		doc.session = session
+		doc.collection = session.db[colname]
+		doc._load(committed, fields)
+		return doc
+
+	@classmethod
+	def find(cls, session, colname, spec=None, projection=None,
+	         batch_size=None):
+		""" Iterate over the documents matching the spec (all documents by
+		default), as they are read from the cursor. Like any other document,
+		they only join the transaction if they are changed. If a projection
+		is given (a list of keys, or a dict of keys to include or exclude),
+		documents are only partially loaded: the other keys can't be read,
+		and the documents can't be replaced as a whole with set(), but
+		otherwise they can be changed as usual.
+		"""
+		fields = _load_projection(session, projection)
+		cursor = session.db[colname].find(spec, fields)
+		if batch_size is not None:
+			cursor = cursor.batch_size(batch_size)
+		for committed in cursor:
+			yield cls._from_document(session, colname, committed, fields)
+
+	@classmethod
+	def load_many(cls, session, colname, specs, fields=None):
+		""" Retrieve the documents matching each of a list of retrieve specs,
+		like MongoDocument(session, colname, retrieve=spec, fields=fields)
+		would, but with a single query: an $in on _id if all the specs
+		select documents by _id, and an $or of the specs otherwise. Specs
+		using operators, regular expressions or dotted keys are retrieved
+		individually since they can't be matched to the fetched documents.
+		Returns the documents in the order of the specs.
+		"""
+		collection = session.db[colname]
+		fields = _load_projection(session, fields)
+		measure = instrumentation.get(session)
+		batch = filter(_is_equality_spec, specs)
+		fetched = []
+		if batch:
+			if len(filter(_is_id_spec, batch)) == len(batch):
+				query = {'_id': {'$in': [spec['_id'] for spec in batch]}}
+			else:
+				query = {'$or': batch}
+			if fields is not None:
+				# the keys of the specs are needed to match documents
+				keys = reduce(lambda keys, spec: keys + spec.keys(), batch, [])
+				fields = _include(fields, keys)
+			with measure.timed('load_many', colname, cls.__name__):
+				fetched = list(collection.find(query, fields))
+			measure.count('round_trips', 1, colname, cls.__name__)
+		loaded = {} # doc_id -> instance, so a document is loaded only once
+		docs = []
+		for spec in specs:
+			if _is_equality_spec(spec):
+				committed = _single_match(
+				    filter(lambda f: _matches(f, spec), fetched), spec)
+			else:
+				with measure.timed('retrieve', colname, cls.__name__):
+					committed = _retrieve(collection, spec, fields)
+				measure.count('round_trips', 1, colname, cls.__name__)
+			doc_id = str(committed['_id'])
+			if not loaded.has_key(doc_id):
+				loaded[doc_id] = cls._from_document(session, colname,
+				                                    committed, fields)
+			docs.append(loaded[doc_id])
+		return docs
+
+	def _get_uncommitted(self):
+		return self._overlay
+
+	def _set_uncommitted(self, document):
+		if document is None:
+			self._overlay = None
 		else:
-			self.doc_id = None
+			self._overlay = DocumentOverlay(document)
+
+	# the document including uncommitted changes, as a copy-on-write overlay
+	# over the committed document (None if the document is to be deleted)
+	uncommitted = property(_get_uncommitted, _set_uncommitted)
 	
 	#
 	# it's going to act like a dictionary so implement basic dictionary methods
 	#
 
 	def __getitem__(self, name):
+		self._fault(name)
 		if isinstance(self.uncommitted[name], DBRef):
 			# if referenced doc is part of current transaction return
 			# that instance otherwise create a new MongoDocument instance
 			# and return that
-			txn = transaction.get()
-			doc = self.session.db.dereference(self.uncommitted[name])
-			livedocs = filter(lambda f:
-			                  f.has_key('_id') and
-			                  f['_id'] == doc['_id'], txn._resources)
-			if livedocs:
-				return livedocs[0]
-			return MongoDocument(self.session,
-			                     self.collection.name,
-			                     retrieve=doc)
+			# (loaded lazily, when the document is first used)
+			ref = self.uncommitted[name]
+			registry = support.get_registry(transaction.get())
+			livedoc = registry.lookup(ref.collection, ref.id)
+			if livedoc is not None:
+				return livedoc
+			doc = self._cached_reference(name, ref)
+			if doc is not None:
+				return doc
+			return DocumentReference(self, name, ref)
 		else:
-			try:
-				value = jsonpickle.decode(self.uncommitted[name])
-			except:
-				value = self.uncommitted[name]
+			# values that were serialized are decoded once and cached, for
+			# as long as the stored value doesn't change. Values assigned in
+			# this session are known to be native or serialized; values
+			# loaded from the db are decoded if they are in a form only
+			# serialization produces (see _decode)
+			raw = self.uncommitted[name]
+			cached = self._decoded.get(name) if self._decoded else None
+			if cached is not None and cached[0] is raw:
+				if cached[1] is not _PICKLED:
+					return cached[1]
+				value = jsonpickle.decode(raw)
+			elif isinstance(raw, basestring):
+				value = _decode(raw)
+				if value is raw:
+					return raw
+			else:
+				return raw
+			self._cache_decoded(name, raw, value)
 			return value
 
+	def _cache_decoded(self, name, raw, value):
+		if self._decoded is None:
+			self._decoded = {}
+		self._decoded[name] = (raw, value)
+
+	def _forget_decoded(self, name):
+		if self._decoded:
+			self._decoded.pop(name, None)
+
+	def _cached_reference(self, name, ref):
+		""" The document referenced by the key, if it has already been
+		loaded in the current transaction.
+		"""
+		if self._references_txn is not transaction.get():
+			return None
+		cached = self._references.get(name)
+		if cached is not None and cached[0] == ref:
+			return cached[1]
+		return None
+
+	def _cache_reference(self, name, ref, doc):
+		txn = transaction.get()
+		if self._references_txn is not txn:
+			self._references = {}
+			self._references_txn = txn
+		self._references[name] = (ref, doc)
+
+	def _dereference(self, name, ref):
+		""" Load the document referenced by the key """
+		registry = support.get_registry(transaction.get())
+		doc = registry.lookup(ref.collection, ref.id)
+		if doc is None:
+			doc = self._cached_reference(name, ref)
+		if doc is None:
+			doc = MongoDocument(self.session,
+			                    ref.collection,
+			                    retrieve={'_id': ref.id})
+			self._cache_reference(name, ref, doc)
+		return doc
+
 	@mutative_operation
 	def __setitem__(self, name, value):
-		if hasattr(value, 'mongo_data_manager'):
+		if isinstance(value, DocumentReference):
+			# no need to load the document just to refer to it
+			self.uncommitted[name] = value._ref
+		elif hasattr(value, 'mongo_data_manager'):
 			if value.has_key('_id'):
 				self.uncommitted[name] = DBRef(value.collection.name,
 				                               value['_id'])
 			else:
-				txn = transaction.get()
-				if value in txn._resources:
+				if value in support.get_registry(transaction.get()):
 					# this document is part of the current transaction and
-					# doesn't have a mongo _id yet queue it and trigger adding
-					# the reference at the end of the transaction
-					self.queued[name] = value
+					# doesn't have a mongo _id yet: give it one now, so
+					# that the reference is written along with this
+					# document and both are inserted in the same bulk
+					# operation
+					value._generate_id()
+					self.uncommitted[name] = DBRef(value.collection.name,
+					                               value['_id'])
 				else:
 					# this document is not part of the current transaction,
 					# so treat it as a regular python dict and make it an
@@ -123,15 +557,19 @@ class MongoDocument(object):
 								' as embedded instead of a reference')
 					self.uncommitted[name] = value.copy()
 		else:
-			try:
-				BSON.encode({name:value})
+			if bson_compatible(value):
 				self.uncommitted[name] = value
-			except:
-				self.uncommitted[name] = jsonpickle.encode(value)
+				self._cache_decoded(name, value, value)
+			else:
+				encoded = jsonpickle.encode(value)
+				self.uncommitted[name] = encoded
+				self._cache_decoded(name, encoded, _PICKLED)
 
 	@mutative_operation
 	def __delitem__(self, name):
+		self._fault(name)
 		del(self.uncommitted[name])
+		self._forget_decoded(name)
 
 	def keys(self):
 		return self.uncommitted.keys()
@@ -149,10 +587,16 @@ class MongoDocument(object):
 	def set(self, somedict):
 		""" Set the document to be equal to the provided dict """
 
-		self.uncommitted = somedict # if somedict = None, this will delete the
-		                            # doc when the transaction is committed.
-		                            # alternatively, delete() can be called
-		                            # which does the same thing.
+		if somedict is None:
+			self._overlay = None # this will delete the doc when the
+			                     # transaction is committed. alternatively,
+			                     # delete() can be called which does the
+			                     # same thing.
+		elif self.fields is not None:
+			raise PartialDocumentError('Partially loaded documents cannot'
+			                           ' be replaced as a whole')
+		else:
+			self._overlay = DocumentOverlay(somedict, replaced=True)
 
 	def __repr__(self):
 		return repr(self.uncommitted)
@@ -161,26 +605,211 @@ class MongoDocument(object):
 		return len(self.uncommitted)
 
 	def has_key(self, key):
+		self._fault(key)
 		return self.uncommitted.has_key(key)
 
+	def _loaded(self, key):
+		""" Whether the key (if the document has it) has been loaded, which
+		is only not the case for keys left out of a partial document and
+		keys last updated with operators
+		"""
+		return (_included(self.fields, key) and
+		        not (self._stale and key in self._stale))
+
+	#
+	# atomic update operators: unlike assignments, these are sent to the
+	# database as operators, so concurrent ones don't conflict
+	#
+
+	@mutative_operation
+	def inc(self, key, amount=1):
+		""" Increment the number under the key (0 if missing) """
+		self._apply('$inc', key, amount)
+
+	@mutative_operation
+	def push(self, key, value):
+		""" Append the value to the list under the key """
+		self._apply('$push', key, value)
+
+	@mutative_operation
+	def add_to_set(self, key, value):
+		""" Append the value to the list under the key, unless it's in it """
+		self._apply('$addToSet', key, value)
+
+	def _apply(self, operator, key, value):
+		if key == '_id':
+			raise ValueError('The _id of a document cannot be updated')
+		# versioned writes are conditional on the version anyway
+		record = not getattr(self.session, 'versioned', False)
+		self._fault(key)
+		self.uncommitted.apply(operator, key, value,
+		                       record and bool(self.committed))
+		self._forget_decoded(key)
+
+	def _tags(self):
+		""" Collection and class of the document, to tag measurements """
+		return (getattr(self.collection, 'name', None), type(self).__name__)
+
+	def _readback_fields(self):
+		""" The projection to read the document back with in tpc_vote """
+		if self.fields is None:
+			return None
+		return _include(self.fields, ['pending_transactions'])
+
+	def _fault(self, key):
+		""" Load a key that was left out of a partially loaded document,
+		when it is first used. Keys that are set before they are read
+		don't need to be loaded, since writes only touch the changed keys.
+		Note that keys(), items() etc. only cover the keys loaded so far.
+		"""
+		if (self._loaded(key) or self.uncommitted is None or
+		        key in self.uncommitted.changes):
+			return
+		measure = instrumentation.get(self.session)
+		with measure.timed('fault', *self._tags()):
+			doc = self.collection.find_one({'_id': self.committed['_id']},
+			                               {key: 1})
+		measure.count('round_trips', 1, *self._tags())
+		if doc is None:
+			raise DocumentNotFoundError('Document not found!'
+			                            + str({'_id': self.committed['_id']}))
+		if doc.has_key(key):
+			self.committed[key] = doc[key]
+		if self._stale:
+			self._stale.discard(key)
+		if self.fields is not None:
+			self.fields = _include(self.fields, [key])
+
+	def diff(self):
+		""" The update to send to mongodb to bring the stored document in
+		line with this one. If the whole document was replaced using set(),
+		this is the replacement document. Otherwise it is a modifier
+		document that $set's/$unset's only the keys changed since the last
+		commit (empty if there are none), and applies the update operators
+		used on keys that weren't otherwise changed. None if the document
+		is to be deleted.
+		"""
+		overlay = self._overlay
+		if overlay is None:
+			return None
+		if overlay.replaced or not self.committed:
+			return overlay.copy()
+		modifiers = {}
+		for key, value in overlay.changes.items():
+			if key != '_id' and not overlay.operators.has_key(key):
+				modifiers.setdefault('$set', {})[key] = value
+		for key in overlay.deleted:
+			modifiers.setdefault('$unset', {})[key] = 1
+		for key, (operator, value) in overlay.operators.items():
+			if operator != '$inc':
+				value = {'$each': value}
+			modifiers.setdefault(operator, {})[key] = value
+		return modifiers
+
+	def _commutative(self):
+		""" Whether the only changes to the stored document are update
+		operators, which don't depend on its current state: such a document
+		is neither locked nor checked for concurrent modifications, since
+		the operators can be applied on top of them. It is only checked
+		for, and written conditionally on, not being locked by another
+		transaction.
+		"""
+		overlay = self._overlay
+		return bool(overlay is not None and self.committed and
+		            overlay.operators and not overlay.replaced and
+		            not overlay.deleted and
+		            len(overlay.changes) == len(overlay.operators))
+
 	def _save(self):
-		# commit new doc (replace existing doc) -- can be called
+		# commit new doc (update existing doc) -- can be called
 		# manually, outside of transactions
 		if self.uncommitted == None: # document should be deleted
 			self._delete()
 		else:
+			if getattr(self.session, 'versioned', False):
+				self._next_version()
 			if self.committed:
-				self.collection.update({'_id':self.committed['_id']},
-				                       self.uncommitted)
+				update = self.diff()
+				if update or self.uncommitted.replaced:
+					self.collection.update({'_id':self.committed['_id']},
+					                       update)
 			else:
-				self.collection.insert(self.uncommitted)
-		# if there are queued changes that cannot be completed
-		# in this transaction add them to the session queue
-		# to be performed after the transaction
-		if self.queued:
-			self.session.queue.append(self)
+				if not self.uncommitted.has_key('_id'):
+					self.uncommitted['_id'] = ObjectId()
+				self.collection.insert(self.uncommitted.copy())
+		self._saved()
 
-		self.committed = self.uncommitted.copy()
+	def _saved(self):
+		overlay = self._overlay
+		if overlay.base is self.committed and not overlay.replaced:
+			self.committed = overlay.commit()
+		else:
+			self.committed = overlay.copy()
+		self._overlay = DocumentOverlay(self.committed)
+		if self.fields is not None:
+			# the keys written are now loaded too
+			self.fields = _include(self.fields, overlay.changes.keys())
+		if overlay.replaced:
+			self._stale = None
+		elif self._stale:
+			self._stale.difference_update(overlay.changes.keys())
+			self._stale.difference_update(overlay.deleted)
+		if overlay.operators:
+			# the values of keys updated with operators are only known
+			# locally to include this transaction's changes, and are loaded
+			# again when next read
+			for key in overlay.operators.keys():
+				self.committed.pop(key, None)
+			if self._stale is None:
+				self._stale = set()
+			self._stale.update(overlay.operators.keys())
+		self._encoded = None
+
+	def _merge(self, other):
+		""" Fold the uncommitted changes of another data manager for the
+		same document (see config.Session) into this one's, which then
+		writes them for both. Raises MergeConflictError if they changed
+		the same key differently, and ConcurrentModificationError if they
+		were loaded from different versions of the document.
+		"""
+		if not self.committed or not other.committed:
+			raise MergeConflictError('Documents being inserted cannot be'
+			                         ' merged')
+		for key, value in other.committed.items():
+			if self.committed.get(key, value) != value:
+				raise ConcurrentModificationError(
+				    'Concurrent modification! Transaction aborting...',
+				    self.collection.name)
+		mine, theirs = self._overlay, other._overlay
+		if theirs is not None and _unchanged(theirs):
+			return
+		if theirs is None and mine is not None and _unchanged(mine):
+			self._overlay = None # deleted
+		elif (theirs is not None and theirs.replaced and mine is not None and
+		        _unchanged(mine) and self.fields is None):
+			self._overlay = theirs.snapshot()
+		elif mine is None or theirs is None or mine.replaced or \
+		        theirs.replaced:
+			if mine != theirs:
+				raise MergeConflictError('Conflicting changes to document'
+				                         ' (deleted or replaced)')
+		else:
+			mine.merge(theirs)
+
+	def _saved_as(self, dm):
+		""" Take on the committed state of the data manager that wrote the
+		changes merged from this one
+		"""
+		self.committed = dict(dm.committed)
+		self.fields = dm.fields
+		self._stale = dm._stale and set(dm._stale)
+		self._overlay = DocumentOverlay(self.committed)
+		self._encoded = None
+
+	def _generate_id(self):
+		""" Give a new document its _id ahead of being inserted """
+		self.uncommitted['_id'] = ObjectId()
+		support.get_registry(transaction.get()).index(self)
 
 	def _delete(self):
 		if self.committed:
@@ -195,7 +824,10 @@ class MongoDocument(object):
 		if self.session.transactional:
 			logger.warn('save() called on transactional document. ignoring...')
 		else:
-			self._save()
+			measure = instrumentation.get(self.session)
+			with measure.timed('save', *self._tags()):
+				self._save()
+			measure.count('round_trips', 1, *self._tags())
 
 	@mutative_operation
 	def delete(self):
@@ -213,23 +845,56 @@ class MongoDocument(object):
 		""" Join current transaction if document is not already part of it.
 		"""
 		txn = transaction.get()
-		if not self in txn._resources:
+		registry = support.get_registry(txn)
+		if not self in registry:
 			txn.join(self)
+			registry.add(self)
+			hooks.listen(self.session, txn)
+
+	def _coordinator(self, txn):
+		""" The coordinator performing the database side of the two-phase
+		commit for this document. Normally this is shared by all of the
+		session's documents in the transaction (see
+		hooks.mongo_transaction_prehook), but a document that isn't
+		managed by it falls back to a coordinator of its own.
+		"""
+		coordinator = getattr(self.session, 'coordinator', None)
+		if coordinator is not None and coordinator.manages(self, txn):
+			return coordinator
+		coordinator = getattr(self, '_own_coordinator', None)
+		if coordinator is None or not coordinator.manages(self, txn):
+			coordinator = TransactionCoordinator(self.session, [self], txn)
+			self._own_coordinator = coordinator
+		return coordinator
+
+	def _forget(self):
+		""" Drop the document from the session's identity map, since the
+		committed state may no longer match the database.
+		"""
+		identity_map = _identity_map(self.session)
+		if identity_map is not None and self.doc_id:
+			identity_map.discard(self)
 
 	def abort(self, txn):
-		self.uncommitted = self.committed.copy()
+		self._overlay = DocumentOverlay(self.committed)
+		self._encoded = None
+		self._forget()
 	
 	def tpc_begin(self, txn):
-		if self.committed:
-			self.collection.update({'_id':self.committed['_id']},
-			                       {'$push':
-			                       {'pending_transactions':
-			                       support.ActiveTransaction.transaction_id}})
+		self._coordinator(txn).tpc_begin()
 
 	def commit(self, txn):
 		pass
 
 	def tpc_vote(self, txn):
+		try:
+			self._vote(txn)
+		except ConcurrentModificationError, e:
+			instrumentation.get(self.session).count(
+			    'conflicts', 1, e.collection, type(self).__name__)
+			raise
+
+	def _vote(self, txn):
 		# check self.committed = current state
 		# or there's a pending txn that's not this one
 		if not self.session.active:
@@ -237,59 +902,107 @@ class MongoDocument(object):
 			    'MongoDB session not initialized correctly! Be sure to'
 			    ' create a new session instance or call session.begin()'
 			    ' once at the start of each transaction.')
+		versioned = getattr(self.session, 'versioned', False)
+		if versioned and self.uncommitted is not None:
+			self._next_version()
 		if self.uncommitted:
-			# validate new data
-			keytypes = map(lambda f:type(f), self.uncommitted.keys())
-			invalidkeys = filter(lambda f: f != str and f != unicode, keytypes)
-			if invalidkeys:
-				raise Exception('Invalid key: Documents must'
-				                ' have only string or unicode keys!')
-			try:
-				BSON.encode(self.uncommitted) # final check that document
-				                              # is BSON-compatible
-			except:
-				raise
+			measure = instrumentation.get(self.session)
+			with measure.timed('validate', *self._tags()):
+				self._validate()
+			if self._encoded is not None:
+				measure.count('bytes_encoded', len(self._encoded.raw),
+				              *self._tags())
 
-		if self.committed:
+		if versioned:
+			# written once all documents have voted, conditionally on the
+			# version, which detects concurrent modifications without
+			# locking and reading back
+			self._coordinator(txn).vote(self)
+		elif self.committed and not self._commutative():
 			if not self.committed.has_key('_id'):
 				# this should never happen
 				# (if it does then we're in trouble - tpc_abort will fail)
 				raise Exception(
 				    'Committed document does not have an _id field!') 
-			dbcommitted = self.collection.find_one(
-			    {'_id': self.committed['_id']})
+			dbcommitted = self._coordinator(txn).fetch(self)
 			if not dbcommitted:
-				raise TransientError(
-				    'Document to be updated does not exist in database!')
+				raise ConcurrentModificationError(
+				    'Document to be updated does not exist in database!',
+				    self.collection.name)
 			pending_transactions = dbcommitted.pop('pending_transactions')
 			if self.committed.has_key('pending_transactions'):
-				raise TransientError(
-				    'Concurrent modification! Transaction aborting...')
+				raise ConcurrentModificationError(
+				    'Concurrent modification! Transaction aborting...',
+				    self.collection.name)
 			if (len(pending_transactions) > 1 or
 			        pending_transactions[0] !=
 			        support.ActiveTransaction.transaction_id):
-				raise TransientError(
-				    'Concurrent modification! Transaction aborting...')
+				raise ConcurrentModificationError(
+				    'Concurrent modification! Transaction aborting...',
+				    self.collection.name)
+			dbcommitted = _project(dbcommitted, self.fields)
+			if self._stale:
+				dbcommitted = dict([(key, value)
+				                    for key, value in dbcommitted.items()
+				                    if key not in self._stale])
 			if dbcommitted != self.committed:
-				raise TransientError(
-				    'Concurrent modification! Transaction aborting...')
+				raise ConcurrentModificationError(
+				    'Concurrent modification! Transaction aborting...',
+				    self.collection.name)
+		elif self.committed:
+			# operators can be applied on top of concurrent changes, but
+			# not while another transaction holds the document locked
+			# (it would overwrite them)
+			if self._coordinator(txn).locked(self):
+				raise ConcurrentModificationError(
+				    'Concurrent modification! Transaction aborting...',
+				    self.collection.name)
+
+	def _next_version(self):
+		self.uncommitted[support.VERSION_KEY] = \
+		    self.committed.get(support.VERSION_KEY, 0) + 1
+
+	def _validate(self):
+		""" Check that the new data can be stored. A document that is
+		written as a whole (new or replaced) is encoded here once, and the
+		encoded document is what gets written. For an update
+		only the changed keys and values need to be checked.
+		"""
+		overlay = self.uncommitted
+		whole = overlay.replaced or not self.committed
+		if whole:
+			if not overlay.has_key('_id'):
+				overlay['_id'] = ObjectId()
+			values = overlay.copy()
+		else:
+			values = overlay.changes
+		self._check(values, whole)
+		if whole:
+			# final check that document is BSON-compatible
+			self._encoded = RawBSONDocument(BSON.encode(values))
+
+	def _check(self, values, whole):
+		""" Check the keys and values to be written: the whole document,
+		or the changed keys of an update (a document written as a whole
+		is checked for BSON compatibility by encoding it).
+		"""
+		if filter(lambda f: not valid_key(f), values.keys()):
+			raise Exception('Invalid key: Documents must have only string'
+			                ' or unicode keys, without \'.\' or a'
+			                ' leading \'$\'!')
+		if not whole:
+			for key, value in values.items():
+				if not bson_compatible(value):
+					BSON.encode({key: value}) # raises the reason why not
 
 	def tpc_abort(self, txn):
-		self.uncommitted = self.committed.copy()
-		if self.committed:
-			self.collection.update(
-			    {'_id': self.committed['_id']},
-			    {'$pull': {'pending_transactions':
-			    support.ActiveTransaction.transaction_id}})
-			dbcommitted = self.collection.find_one(
-			    {'_id':self.committed['_id']})
-			if (dbcommitted.has_key('pending_transactions') and
-			        not dbcommitted['pending_transactions']):
-				self.collection.update({'_id':self.committed['_id']},
-				                       {'$unset':{'pending_transactions':1}})
+		self._overlay = DocumentOverlay(self.committed)
+		self._encoded = None
+		self._forget()
+		self._coordinator(txn).tpc_abort()
 	
 	def tpc_finish(self, txn):
-		self._save()
+		self._coordinator(txn).tpc_finish()
 
 	def savepoint(self):
 		return MongoSavepoint(self)
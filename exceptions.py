@@ -1,3 +1,6 @@
+from transaction.interfaces import TransientError
+
+
 
 # Data manager errors
 
@@ -10,6 +13,18 @@ class DocumentMatchNotUniqueError(Exception):
 class DuplicateDataManagersError(Exception):
 	pass
 
+class MergeConflictError(Exception):
+	""" Data managers for the same document changed it in ways that can't
+	be merged (see config.Session)
+	"""
+	pass
+
+class PartialDocumentError(Exception):
+	pass
+
+class ReadOnlyDocumentError(Exception):
+	pass
+
 
 # ORM errors
 
@@ -21,3 +36,22 @@ class ORMValidationError(Exception):
 class SessionNotInitializedError(Exception):
 	pass
 
+class PartialCommitError(Exception):
+	""" Some of the documents in the named collection couldn't be written
+	when the transaction finished, after others had been: documents only
+	updated with operators (see MongoDocument.inc()) that another
+	transaction locked after the vote. Unlike a concurrent modification,
+	the transaction can't simply be retried, since its other writes have
+	been made.
+	"""
+	def __init__(self, message, collection=None):
+		Exception.__init__(self, message)
+		self.collection = collection
+
+class ConcurrentModificationError(TransientError):
+	""" A document in the transaction was modified concurrently, in the
+	named collection. The transaction can be retried.
+	"""
+	def __init__(self, message, collection=None):
+		TransientError.__init__(self, message)
+		self.collection = collection
@@ -1,9 +1,11 @@
 """ Transaction hooks """
 
 import datetime
-from bson.dbref import DBRef
+import instrumentation
 import support
+import txnlog
 from mongomorphism.exceptions import DuplicateDataManagersError
+from coordinator import TransactionCoordinator
 import logging
 import transaction
 
@@ -11,94 +13,99 @@ import transaction
 logger = logging.getLogger(__name__)
 
 
-def mongo_listener_prehook(*args, **kws):
-	""" Examine each transaction before it is committed, and if there are any
-	mongodb data managers participating, add the needed commit hooks to support
-	transactions correctly on those objects.
+def listen(session, txn):
+	""" Add the hooks that carry out the mongodb side of committing the
+	session's documents to the transaction, once per transaction. This is
+	done as the session's documents join the transaction, so the hooks
+	are always added to the transaction the documents are actually in
+	(and never to a transaction that has already failed).
 	"""
-	txn = transaction.get()
-	mongodms = filter(lambda f:
-	                  hasattr(f, 'mongo_data_manager'),
-	                  txn._resources)
-	sessions = set(map(lambda f: f.session, mongodms))
-	for session in iter(sessions):
-		txn.addBeforeCommitHook(mongo_transaction_prehook, args=(),
-		                        kws={'session':session})
-		txn.addAfterCommitHook(mongo_transaction_posthook,
-		                       args=(), kws={'session':session})
-
-def mongo_listener_posthook(*args, **kws):
-	""" Reinitialize session (i.e. add mongo listener to transaction) for
-	subsequent transaction.
-	"""
-	session = kws['session']
-	# if session is not active, then assume it has been closed
-	# and don't reinitialize (i.e. add hooks) for subsequent transactions
-	if session.active:
-		session.close()
-		# so that document can continue being used transactionally
-		# without manual reinitialization:
-		session.begin()
+	registry = support.get_registry(txn)
+	if session in registry.sessions:
+		return
+	registry.sessions.add(session)
+	txn.addBeforeCommitHook(mongo_transaction_prehook, args=(),
+	                        kws={'session':session})
+	txn.addAfterCommitHook(mongo_transaction_posthook,
+	                       args=(), kws={'session':session})
 
 def mongo_transaction_prehook(*args, **kws):
 	""" Initialize transaction. Called just before transaction is committed.
-	Register transaction in db's 'transaction' collection. Ensure that any
+	Register transaction in db's 'transaction' collection (indexing it
+	the first time, see txnlog.ensure_indexes). Ensure that any
 	documents that are part of the current transaction are only associated
-	with one data manager.
+	with one data manager (unless the session merges their changes), and
+	set up the coordinator that will batch the database operations of the
+	session's data managers during the commit.
 	"""
-	db = kws['session'].db
+	session = kws['session']
+	db = session.db
 	txn = transaction.get()
+	# participating dm's are indexed by document as they join; if not
+	# injective: dms->docs then abort here (only for this session's
+	# documents: another session may merge its own duplicates)
+	registry = support.get_registry(txn)
+	if (registry.duplicated(session)
+	    and not getattr(session, 'merge', False)):
+		raise DuplicateDataManagersError('Aborting transaction:'
+		    ' duplicate data managers for same document'
+			' in single transaction!')
+	datamanagers = filter(lambda f: f.session is session,
+	                      registry.datamanagers)
+	measure = instrumentation.get(session)
+	measure.count('documents', len(datamanagers))
+	coordinator = TransactionCoordinator(session, datamanagers, txn)
 	support.ActiveTransaction.transaction_id = support.gen_transaction_id(txn)
 	timestamp = datetime.datetime.utcnow()
-	db.transactions.insert({'tid': support.ActiveTransaction.transaction_id,
-	                        'state': 'pending',
-	                        'date_created': timestamp,
-	                        'date_modified': timestamp})
-	# list participating dm's, if not injective: dms->docs
-	# then call abort() here
-	mongodms = filter(lambda f:
-	                  hasattr(f, 'mongo_data_manager'),
-	                  txn._resources)
-	txn_doc_ids = {}
-	for dm in mongodms:
-		if dm.doc_id:
-			if txn_doc_ids.has_key(dm.doc_id):
-				raise DuplicateDataManagersError('Aborting transaction:'
-				    ' duplicate data managers for same document'
-					' in single transaction!')
-			txn_doc_ids[dm.doc_id] = 1
+	# the collections are recorded so that the transaction's locks can be
+	# found and released if it is abandoned (see txnlog.sweep)
+	with measure.timed('prehook'):
+		txnlog.ensure_indexes(session.connection, db,
+		                      getattr(session, 'transaction_ttl', None))
+		db.transactions.insert({'tid': support.ActiveTransaction.transaction_id,
+		                        'state': 'pending',
+		                        'collections': sorted(set(
+		                            [dm.collection.name for dm in datamanagers])),
+		                        'date_created': timestamp,
+		                        'date_modified': timestamp})
+	measure.count('round_trips', 1, 'transactions')
+	session.coordinator = coordinator
 
 def mongo_transaction_posthook(success, *args, **kws):
 	""" Conclude transaction. Called immediately after a transaction is
-	committed. If transaction succeeded, perform any pending queued operations.
-	Seal transaction state at 'done'/'failed'.
+	committed. Seal transaction state at 'done'/'failed' ('failed' only
+	once the documents it marked as pending have been released).
 	"""
 	session = kws['session']
 	db = session.db
+	measure = instrumentation.get(session)
 	timestamp = datetime.datetime.utcnow()
 	if success:
-		# perform queued operations
-		if session.queue:
-			logger.debug('performing queued operations')
-			def update_refs(doc):
-				col = doc.collection
-				queued = doc.queued
-				for key,doc_ref in queued.items():
-					ref = DBRef(doc_ref.collection.name, doc_ref['_id'])
-					col.update({'_id':doc['_id']}, {'$set':{key:ref}})
-				doc.queued = {}
-			for doc in session.queue:
-				update_refs(doc)
-			session.queue = []
-		db.transactions.update(
-		    {'tid': support.ActiveTransaction.transaction_id},
-		    {'$set': {'state': 'done',
-		             'date_modified': timestamp}})
+		state = 'done'
+	elif (session.coordinator is not None and
+	      session.coordinator.holds_locks()):
+		# releasing the documents failed: the record is left pending so
+		# that txnlog.sweep() releases them
+		logger.warning('transaction %s failed without releasing its'
+		               ' documents', support.ActiveTransaction.transaction_id)
+		state = None
 	else:
-		db.transactions.update(
-		    {'tid': support.ActiveTransaction.transaction_id},
-		    {'$set': {'state': 'failed',
-		              'date_modified': timestamp}})
+		state = 'failed'
+	if state is not None:
+		with measure.timed('posthook'):
+			db.transactions.update(
+			    {'tid': support.ActiveTransaction.transaction_id},
+			    {'$set': {'state': state,
+			              'date_modified': timestamp,
+			              'date_finished': timestamp}})
+		measure.count('round_trips', 1, 'transactions')
+	if not success:
+		if session.coordinator is not None:
+			for colname in session.coordinator.groups.keys():
+				measure.count('aborts', 1, colname)
+		else:
+			measure.count('aborts')
+	session.coordinator = None
 	# shouldn't matter, but just in case:
 	support.ActiveTransaction.transaction_id = None
 
@@ -0,0 +1,64 @@
+""" Identity map: a first-level cache of loaded documents """
+
+import weakref
+from collections import OrderedDict
+
+
+class IdentityMap(object):
+	""" Maps (collection name, _id, class) to the MongoDocument instance
+	loaded for that document in a session, so that loading the same
+	document again (as the same class, e.g. a MongoObject subclass, whose
+	behaviour an instance of another class would lack) returns the same
+	instance without querying the database. Holds at most
+	`size` documents (None for no bound), evicting the least recently used
+	ones first. The documents are only held for the duration of a
+	transaction (see scope()).
+	"""
+
+	def __init__(self, size=None):
+		self.size = size
+		self.documents = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.transaction = None # weak reference
+
+	def scope(self, txn):
+		""" Start afresh if the documents were loaded in another transaction
+		than the given one, since the unit of work they belong to is over.
+		"""
+		if self.transaction is None or self.transaction() is not txn:
+			self.documents.clear()
+			self.transaction = weakref.ref(txn)
+
+	def __len__(self):
+		return len(self.documents)
+
+	def get(self, colname, _id, cls):
+		""" The loaded document with the given _id and class, or None """
+		key = (colname, str(_id), cls)
+		doc = self.documents.pop(key, None)
+		if doc is None:
+			self.misses += 1
+			return None
+		self.documents[key] = doc # most recently used
+		self.hits += 1
+		return doc
+
+	def add(self, doc):
+		key = (doc.collection.name, doc.doc_id, type(doc))
+		self.documents.pop(key, None)
+		self.documents[key] = doc
+		if self.size is not None:
+			while len(self.documents) > self.size:
+				self.documents.popitem(last=False)
+				self.evictions += 1
+
+	def discard(self, doc):
+		""" Remove the document from the map, if it is the instance held """
+		key = (doc.collection.name, doc.doc_id, type(doc))
+		if self.documents.get(key) is doc:
+			del self.documents[key]
+
+	def clear(self):
+		self.documents.clear()
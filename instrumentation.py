@@ -0,0 +1,183 @@
+""" Instrumentation of the commit protocol: latencies, round trips and
+counts, tagged by collection and document class """
+
+import math
+import threading
+import timeit
+from contextlib import contextmanager
+
+
+class Instrumentation(object):
+	""" Receives measurements from sessions (see config.Session). This
+	one discards them; subclass it to send them somewhere, or use Metrics
+	to aggregate them in memory.
+	Metrics are named: latencies in seconds are recorded as the name of
+	the phase timed ('tpc_begin', 'tpc_vote', 'tpc_finish', 'tpc_abort',
+	'validate', 'save', 'retrieve', 'load_many', 'fault', 'prehook',
+	'posthook'), and counts as 'round_trips', 'bytes_encoded',
+	'documents' (per transaction), 'conflicts' and 'aborts'. Each is
+	tagged by collection name and by the class of the document (e.g.
+	'MongoDocument', or the MongoObject subclass) where those apply.
+	"""
+
+	def record(self, metric, value, collection=None, kind=None):
+		""" Record a value (a latency or a count) of the metric """
+		pass
+
+	def timed(self, phase, collection=None, kind=None):
+		""" Context manager recording the time spent in the phase """
+		return _untimed
+
+	def count(self, metric, value=1, collection=None, kind=None):
+		self.record(metric, value, collection, kind)
+
+class _Untimed(object):
+	def __enter__(self):
+		pass
+
+	def __exit__(self, *exc_info):
+		return False
+
+_untimed = _Untimed()
+
+class _Timed(object):
+	def __init__(self, instrumentation, phase, collection, kind):
+		self.instrumentation = instrumentation
+		self.tags = (phase, collection, kind)
+
+	def __enter__(self):
+		self.start = timeit.default_timer()
+
+	def __exit__(self, *exc_info):
+		phase, collection, kind = self.tags
+		self.instrumentation.record(phase,
+		                            timeit.default_timer() - self.start,
+		                            collection, kind)
+		return False
+
+class Histogram(object):
+	""" Summary of the values recorded for a metric: count, total, min,
+	max, and counts per power-of-two bucket, from which percentiles are
+	estimated.
+	"""
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0
+		self.min = None
+		self.max = None
+		self.buckets = {} # exponent e -> count of values in [2**(e-1), 2**e)
+
+	def add(self, value):
+		self.count += 1
+		self.total += value
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+		exponent = math.frexp(value)[1] if value > 0 else None
+		self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+	def merge(self, other):
+		for exponent, count in other.buckets.items():
+			self.buckets[exponent] = self.buckets.get(exponent, 0) + count
+		self.count += other.count
+		self.total += other.total
+		for value in (other.min, other.max):
+			if value is not None:
+				if self.min is None or value < self.min:
+					self.min = value
+				if self.max is None or value > self.max:
+					self.max = value
+
+	def mean(self):
+		if not self.count:
+			return None
+		return float(self.total) / self.count
+
+	def percentile(self, p):
+		""" Upper bound of the bucket holding the p-th percentile (within
+		a factor of two of the actual value, and never above max)
+		"""
+		if not self.count:
+			return None
+		rank = math.ceil(self.count * p / 100.0)
+		seen = 0
+		for exponent in sorted(self.buckets, key=lambda e: (e is not None, e)):
+			seen += self.buckets[exponent]
+			if seen >= rank:
+				if exponent is None:
+					return 0
+				return min(math.ldexp(1, exponent), self.max)
+		return self.max
+
+	def __repr__(self):
+		return '<Histogram count=%d mean=%r max=%r>' % (self.count,
+		                                                self.mean(),
+		                                                self.max)
+
+class Metrics(Instrumentation):
+	""" Aggregates measurements in memory, as a histogram per metric,
+	collection and class of document.
+	"""
+
+	def __init__(self):
+		self.histograms = {} # (metric, collection, kind) -> Histogram
+		self._lock = threading.Lock() # commit phases may run in threads
+
+	def record(self, metric, value, collection=None, kind=None):
+		key = (metric, collection, kind)
+		with self._lock:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				histogram = self.histograms[key] = Histogram()
+			histogram.add(value)
+
+	def timed(self, phase, collection=None, kind=None):
+		return _Timed(self, phase, collection, kind)
+
+	def histogram(self, metric, collection=None, kind=None):
+		""" The histogram of the metric, over all collections and
+		classes of document unless they're given
+		"""
+		summary = Histogram()
+		with self._lock:
+			for key, histogram in self.histograms.items():
+				if (key[0] == metric and
+				        collection in (None, key[1]) and
+				        kind in (None, key[2])):
+					summary.merge(histogram)
+		return summary
+
+	def total(self, metric, collection=None, kind=None):
+		return self.histogram(metric, collection, kind).total
+
+	def clear(self):
+		with self._lock:
+			self.histograms.clear()
+
+null = Instrumentation()
+
+def get(session):
+	""" The session's instrumentation (which discards measurements unless
+	the session was given one)
+	"""
+	return getattr(session, 'instrumentation', None) or null
+
+@contextmanager
+def capture(session):
+	""" Collect the measurements made by the session within the block in
+	a fresh Metrics, e.g. to check the cost of one transaction in a test:
+
+		with capture(session) as metrics:
+			...
+			transaction.commit()
+		metrics.total('round_trips')
+	"""
+	metrics = Metrics()
+	previous = getattr(session, 'instrumentation', None)
+	session.instrumentation = metrics
+	try:
+		yield metrics
+	finally:
+		session.instrumentation = previous
@@ -1,29 +1,114 @@
+from bson import BSON
 from datamanager import MongoDocument
+from validation import always_compatible, bson_compatible, valid_key
 from mongomorphism.exceptions import ORMValidationError
+import copy
 import logging
 
 logger = logging.getLogger(__name__)
 
+def compile_validator(requiredfields, fields):
+	""" A function validating the changes to a document (or the whole
+	document) in a single pass: required fields, keys, and the types of
+	the values of declared fields (fields maps keys to a type or a tuple
+	of types). Values are checked as stored, so objects that aren't
+	BSON types should be declared as the strings they're serialized to.
+	"""
+	checks = {} # key -> (types, whether values also need a BSON check)
+	for key, types in fields.items():
+		if not isinstance(types, tuple):
+			types = (types,)
+		checks[key] = (types, not all(map(always_compatible, types)))
+
+	def validator(doc, values, whole):
+		""" Validate the values to be written: the whole document, or
+		the changed keys unless whole is set (documents written as a
+		whole are checked for BSON compatibility separately, by encoding
+		them).
+		"""
+		overlay = doc.uncommitted
+		for field in requiredfields:
+			if field not in overlay and doc._loaded(field):
+				raise ORMValidationError('Required field missing: ' + field)
+		for key, value in values.iteritems():
+			if not valid_key(key):
+				raise Exception('Invalid key: Documents must'
+				                ' have only string or unicode keys!')
+			check = checks.get(key)
+			if check is not None:
+				if not isinstance(value, check[0]):
+					raise ORMValidationError(
+					    'Invalid value for field %s: %r' % (key, value))
+				if not check[1]:
+					continue
+			if not whole and not bson_compatible(value):
+				BSON.encode({key: value}) # raises the reason why not
+	return validator
+
+class Schema(type):
+	""" Compiles the schema declared by a MongoObject class (and the classes
+	it derives from) once, when the class is created: __requiredfields__,
+	__fields__ (key -> type or tuple of types) and __defaults__ (key ->
+	default value for new objects, or a callable returning it).
+	"""
+
+	def __init__(cls, name, bases, namespace):
+		super(Schema, cls).__init__(name, bases, namespace)
+		fields = {}
+		defaults = {}
+		for klass in reversed(cls.__mro__):
+			fields.update(klass.__dict__.get('__fields__', {}))
+			defaults.update(klass.__dict__.get('__defaults__', {}))
+		cls._validator = staticmethod(compile_validator(cls.__requiredfields__,
+		                                                fields))
+		cls._defaults = defaults
+
 class MongoObject(MongoDocument):
+	__metaclass__ = Schema
+	__slots__ = ()
 	__requiredfields__ = ()
 	__collection__ = None
+	__fields__ = {}
+	__defaults__ = {}
 
-	def __init__(self, session, retrieve=None):
-		self.session = session
-		super(MongoObject, self).__init__(self.session,
-		                                  self.__collection__,
-		                                  retrieve)
+	def __new__(cls, session, retrieve=None, fields=None):
+		return super(MongoObject, cls).__new__(cls, session,
+		                                       cls.__collection__,
+		                                       retrieve, fields)
+
+	def __init__(self, session, retrieve=None, fields=None):
+		super(MongoObject, self).__init__(session, self.__collection__,
+		                                  retrieve, fields)
+		if retrieve is None:
+			# defaults don't make a new object join the transaction
+			for key, default in self._defaults.items():
+				if callable(default):
+					self.uncommitted[key] = default()
+				else:
+					self.uncommitted[key] = copy.deepcopy(default)
+
+	@classmethod
+	def load_many(cls, session, specs, fields=None):
+		return super(MongoObject, cls).load_many(session,
+		                                         cls.__collection__,
+		                                         specs, fields)
+
+	@classmethod
+	def find(cls, session, spec=None, projection=None, batch_size=None):
+		return super(MongoObject, cls).find(session, cls.__collection__,
+		                                    spec, projection, batch_size)
 
 	def validate(self):
-		if self.uncommitted:
-			for field in self.__requiredfields__:
-				if not self.has_key(field):
-					raise ORMValidationError(
-					    'Required field missing: ' + field)
+		overlay = self.uncommitted
+		if overlay:
+			if overlay.replaced or not self.committed:
+				self._check(overlay.copy(), True)
+			else:
+				self._check(overlay.changes, False)
 
-	def tpc_vote(self, transaction):
-		self.validate()
-		super(MongoObject, self).tpc_vote(transaction)
+	def _check(self, values, whole):
+		# called in tpc_vote too
+		self._validator(self, values, whole)
 
 	def save(self):
 		if not self.session.transactional:
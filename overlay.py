@@ -0,0 +1,206 @@
+""" Copy-on-write document state """
+
+from collections import Mapping, MutableMapping
+from mongomorphism.exceptions import MergeConflictError
+
+
+class _Unchanged(dict):
+	""" An empty, read-only layer of changes, shared by all overlays until
+	they are changed (most loaded documents never are)
+	"""
+	__slots__ = ()
+
+	def _read_only(self, *args, **kwargs):
+		raise TypeError('The layer of changes is read-only')
+
+	__setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+	    update = _read_only
+
+_UNCHANGED = _Unchanged()
+_UNDELETED = frozenset()
+
+class DocumentOverlay(MutableMapping):
+	""" A dict-like, copy-on-write view of a document: a base document plus
+	a layer of changes (keys set and keys deleted) on top of it. The base
+	is not copied and is not modified through the overlay, so creating an
+	overlay or a snapshot of one costs time and memory proportional to
+	the number of changed keys rather than to the size of the document.
+	If `replaced` is set, the base is a document that replaced the stored
+	one as a whole (see MongoDocument.set()). Keys can be deleted that
+	aren't in the base, if it is a partially loaded document (see merge()).
+	Keys changed only through update operators (see apply()) also have the
+	operator recorded in `operators`, as key -> (operator, argument).
+	The containers of the layer are only allocated once something is
+	recorded in them.
+	"""
+
+	def __init__(self, base, changes=None, deleted=None, replaced=False,
+	             operators=None):
+		self.base = base
+		self.changes = changes or _UNCHANGED
+		self.deleted = deleted or _UNDELETED
+		self.replaced = replaced
+		self.operators = operators or _UNCHANGED
+
+	def __getitem__(self, key):
+		if key in self.changes:
+			return self.changes[key]
+		if key in self.deleted:
+			raise KeyError(key)
+		return self.base[key]
+
+	def __setitem__(self, key, value):
+		if self.changes is _UNCHANGED:
+			self.changes = {}
+		self.changes[key] = value
+		if key in self.deleted:
+			self.deleted.discard(key)
+		if key in self.operators:
+			del self.operators[key]
+
+	def __delitem__(self, key):
+		if key not in self:
+			raise KeyError(key)
+		if key in self.changes:
+			del self.changes[key]
+		if key in self.operators:
+			del self.operators[key]
+		if key in self.base:
+			if self.deleted is _UNDELETED:
+				self.deleted = set()
+			self.deleted.add(key)
+
+	def __contains__(self, key):
+		return (key in self.changes or
+		        (key not in self.deleted and key in self.base))
+
+	def has_key(self, key):
+		return key in self
+
+	def __iter__(self):
+		for key in self.base:
+			if key not in self.deleted and key not in self.changes:
+				yield key
+		for key in self.changes:
+			yield key
+
+	def __len__(self):
+		added = len([key for key in self.changes if key not in self.base])
+		removed = len([key for key in self.deleted if key in self.base])
+		return len(self.base) - removed + added
+
+	def __eq__(self, other):
+		if isinstance(other, DocumentOverlay):
+			other = other.copy()
+		elif not isinstance(other, Mapping):
+			return False
+		return self.copy() == other
+
+	def __ne__(self, other):
+		return not self == other
+
+	__hash__ = None
+
+	def __repr__(self):
+		return repr(self.copy())
+
+	def copy(self):
+		""" A regular dict with the contents of the document """
+		doc = dict(self.base)
+		for key in self.deleted:
+			doc.pop(key, None)
+		doc.update(self.changes)
+		return doc
+
+	def snapshot(self):
+		""" An independent overlay over the same base with a copy of the
+		current layer of changes.
+		"""
+		return DocumentOverlay(self.base, self.changes.copy(),
+		                       self.deleted.copy(), self.replaced,
+		                       self.operators.copy())
+
+	def apply(self, operator, key, value, record=True):
+		""" Apply an update operator ('$inc', '$push' or '$addToSet') with
+		the given value to the key. Unless the key was otherwise changed
+		(or the base replaced), the operator is recorded too, combined with
+		any earlier one of the same kind on the key, so that it can be sent
+		to the database as such rather than as the resulting value; record
+		should only be set if the base is stored in the database.
+		"""
+		current = self.get(key)
+		pending = self.operators.get(key)
+		if pending is not None and pending[0] != operator:
+			# can't send two operators for one key: send the result
+			record = False
+			pending = None
+		if operator == '$inc':
+			result = (current or 0) + value
+			argument = (pending[1] if pending else 0) + value
+		elif operator in ('$push', '$addToSet'):
+			if current is not None and not isinstance(current, list):
+				raise TypeError('Cannot apply %s to a %s' %
+				                (operator, type(current).__name__))
+			result = list(current or [])
+			argument = list(pending[1]) if pending else []
+			if operator == '$push' or value not in result:
+				result.append(value)
+			if operator == '$push' or value not in argument:
+				argument.append(value)
+		else:
+			raise ValueError('Unsupported operator: ' + operator)
+		record = record and not self.replaced and (
+		    pending is not None or
+		    (key not in self.changes and key not in self.deleted))
+		self[key] = result
+		if record:
+			if self.operators is _UNCHANGED:
+				self.operators = {}
+			self.operators[key] = (operator, argument)
+
+	def merge(self, other):
+		""" Fold the layer of changes of another overlay, over a copy of
+		the same stored document, into this one. Keys changed in only one
+		of them are taken as they are, as are keys set to equal values in
+		both; keys updated with the same operator in both have the
+		operator applied again with the other's argument. Raises
+		MergeConflictError if any key was changed differently in both.
+		Neither overlay may be replaced.
+		"""
+		for key, value in other.changes.items():
+			operator = other.operators.get(key)
+			if key in self.changes or key in self.deleted:
+				pending = self.operators.get(key)
+				if (operator is not None and pending is not None and
+				        operator[0] == pending[0]):
+					if operator[0] == '$inc':
+						self.apply('$inc', key, operator[1])
+					else:
+						for item in operator[1]:
+							self.apply(operator[0], key, item)
+				elif (operator is not None or pending is not None or
+				        key in self.deleted or self.changes[key] != value):
+					raise MergeConflictError(
+					    'Conflicting changes to key: %s' % key)
+				continue
+			self[key] = value
+			if operator is not None:
+				if self.operators is _UNCHANGED:
+					self.operators = {}
+				self.operators[key] = operator
+		for key in other.deleted:
+			if key in self.changes:
+				raise MergeConflictError(
+				    'Conflicting changes to key: %s' % key)
+			if self.deleted is _UNDELETED:
+				self.deleted = set()
+			self.deleted.add(key)
+
+	def commit(self):
+		""" Fold the layer of changes into the base document, in place.
+		The overlay should not be used afterwards.
+		"""
+		for key in self.deleted:
+			self.base.pop(key, None)
+		self.base.update(self.changes)
+		return self.base
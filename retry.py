@@ -0,0 +1,82 @@
+""" Retrying units of work that fail on transient conflicts """
+
+import functools
+import logging
+import random
+import time
+import transaction
+from transaction.interfaces import TransientError
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConflictStats(object):
+	""" Per-collection counts of the conflicts met by retried units of work,
+	and of the retries they led to. Conflicts whose collection isn't known
+	are counted under None.
+	"""
+
+	def __init__(self):
+		self.conflicts = {} # collection name -> count
+		self.retries = {} # collection name -> count
+		self.failures = 0 # units of work that ran out of attempts
+
+	def _count(self, counts, collection):
+		counts[collection] = counts.get(collection, 0) + 1
+
+	def conflict(self, collection, retrying):
+		self._count(self.conflicts, collection)
+		if retrying:
+			self._count(self.retries, collection)
+		else:
+			self.failures += 1
+
+def backoff_delay(attempt, backoff, max_backoff):
+	""" Delay before retrying after the given (1-based) attempt: a random
+	time up to an exponentially growing bound ("full jitter"), so that
+	transactions that conflicted with each other don't retry in lockstep.
+	"""
+	return random.uniform(0, min(max_backoff, backoff * 2 ** (attempt - 1)))
+
+def run(work, attempts=5, backoff=0.01, max_backoff=1.0, stats=None):
+	""" Run the unit of work (a callable taking no arguments) in a
+	transaction of its own and commit it, running it again in a new
+	transaction if the commit fails with a TransientError (such as a
+	concurrent modification), at most `attempts` times in all. Returns
+	the result of the unit of work. Any other error, or a TransientError
+	on the last attempt, aborts the transaction and is raised.
+	The unit of work should load the documents it changes itself, since
+	documents loaded before a conflict are out of date.
+	"""
+	for attempt in range(1, attempts + 1):
+		transaction.begin()
+		try:
+			result = work()
+			transaction.commit()
+			return result
+		except TransientError, e:
+			transaction.abort()
+			retrying = attempt < attempts
+			if stats is not None:
+				stats.conflict(getattr(e, 'collection', None), retrying)
+			if not retrying:
+				raise
+			delay = backoff_delay(attempt, backoff, max_backoff)
+			logger.debug('conflict (%s), retrying in %.3fs', e, delay)
+			time.sleep(delay)
+		except:
+			transaction.abort()
+			raise
+
+def retrying(attempts=5, backoff=0.01, max_backoff=1.0, stats=None):
+	""" Decorator running the decorated function as a unit of work with
+	run(), with the given arguments.
+	"""
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			return run(functools.partial(func, *args, **kwargs),
+			           attempts, backoff, max_backoff, stats)
+		return wrapper
+	return decorator
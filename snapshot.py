@@ -0,0 +1,115 @@
+""" Read-only documents """
+
+from bson.dbref import DBRef
+from datamanager import _decode, _included, _load_projection, _retrieve
+from mongomorphism.exceptions import (
+		PartialDocumentError,
+		ReadOnlyDocumentError,
+		)
+
+
+def _read_only(*args, **kwargs):
+	raise ReadOnlyDocumentError('Snapshots cannot be changed')
+
+
+class MongoSnapshot(object):
+	""" A read-only view of a document as it was loaded from mongodb, for
+	read-mostly code that doesn't need transactions: unlike a MongoDocument
+	it holds nothing but the loaded document (no copies, overlays or
+	transaction state), never joins a transaction, and raises
+	ReadOnlyDocumentError if it is changed. The values are shared with the
+	loaded document and shouldn't be modified in place either.
+	Serialized values are decoded, and references are loaded (as
+	snapshots), when they are first read.
+	"""
+
+	__slots__ = ('session', 'colname', 'fields', '_doc', '_decoded')
+
+	def __init__(self, session, colname, retrieve, fields=None):
+		fields = _load_projection(session, fields)
+		self._init(session, colname,
+		           _retrieve(session.db[colname], retrieve, fields), fields)
+
+	def _init(self, session, colname, doc, fields):
+		self.session = session
+		self.colname = colname
+		self.fields = fields # projection, if only partially loaded
+		self._doc = doc
+		self._decoded = None # key -> decoded value, once there are any
+
+	@classmethod
+	def _from_document(cls, session, colname, doc, fields=None):
+		snapshot = object.__new__(cls)
+		snapshot._init(session, colname, doc, fields)
+		return snapshot
+
+	@classmethod
+	def find(cls, session, colname, spec=None, projection=None,
+	         batch_size=None):
+		""" Iterate over snapshots of the documents matching the spec,
+		like MongoDocument.find()
+		"""
+		fields = _load_projection(session, projection)
+		cursor = session.db[colname].find(spec, fields)
+		if batch_size is not None:
+			cursor = cursor.batch_size(batch_size)
+		for doc in cursor:
+			yield cls._from_document(session, colname, doc, fields)
+
+	def __getitem__(self, name):
+		if self._decoded is not None and self._decoded.has_key(name):
+			return self._decoded[name]
+		try:
+			raw = self._doc[name]
+		except KeyError:
+			if not _included(self.fields, name):
+				raise PartialDocumentError('Key not loaded: ' + name)
+			raise
+		if isinstance(raw, DBRef):
+			value = MongoSnapshot(self.session, raw.collection,
+			                      {'_id': raw.id})
+		elif isinstance(raw, basestring):
+			value = _decode(raw)
+			if value is raw:
+				return raw
+		else:
+			return raw
+		if self._decoded is None:
+			self._decoded = {}
+		self._decoded[name] = value
+		return value
+
+	def get(self, name, default=None):
+		if self._doc.has_key(name):
+			return self[name]
+		return default
+
+	def has_key(self, name):
+		return self._doc.has_key(name)
+
+	__contains__ = has_key
+
+	def keys(self):
+		return self._doc.keys()
+
+	def __iter__(self):
+		return iter(self._doc)
+
+	def __len__(self):
+		return len(self._doc)
+
+	def values(self):
+		return [self[key] for key in self._doc]
+
+	def items(self):
+		return [(key, self[key]) for key in self._doc]
+
+	def copy(self):
+		""" The document as stored (values not decoded) """
+		return self._doc.copy()
+
+	def __repr__(self):
+		return repr(self._doc)
+
+	__setitem__ = __delitem__ = set = delete = save = _read_only
+	inc = push = add_to_set = _read_only
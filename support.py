@@ -5,6 +5,7 @@ import platform
 from hashlib import sha256
 import functools
 import logging
+import weakref
 from mongomorphism.exceptions import SessionNotInitializedError
 
 
@@ -27,11 +28,76 @@ def gen_transaction_id(txn):
                      # return the same ID - should be called
 	                 # only to generate a unique ID
 
+# in versioned sessions, the key holding the number of times a document
+# has been written
+VERSION_KEY = '_v'
+
 class ActiveTransaction(object):
 	""" Handle to the active transaction
 	"""
 	transaction_id = None
 
+class TransactionRegistry(object):
+	""" Index of the mongo data managers that have joined a transaction,
+	by data manager identity and by (collection name, _id) of the
+	document, so that membership checks and lookups of live documents
+	don't have to scan the transaction's resources.
+	"""
+
+	def __init__(self):
+		self.datamanagers = [] # in the order they joined
+		self.members = set() # id's of the data managers
+		self.documents = {} # (collection name, doc_id) -> data manager
+		self.duplicates = [] # (collection name, doc_id) of documents
+		                     # with more than one data manager
+		self.sessions = set() # sessions whose commit hooks have been added
+
+	def __contains__(self, dm):
+		return id(dm) in self.members
+
+	def __len__(self):
+		return len(self.datamanagers)
+
+	def add(self, dm):
+		self.datamanagers.append(dm)
+		self.members.add(id(dm))
+		self.index(dm)
+
+	def index(self, dm):
+		""" Index the data manager by its document, if it has an _id """
+		if dm.doc_id:
+			key = (dm.collection.name, dm.doc_id)
+			if self.documents.has_key(key):
+				self.duplicates.append(key)
+			else:
+				self.documents[key] = dm
+
+	def duplicated(self, session):
+		""" The (collection name, doc_id) of documents with more than one
+		data manager, at least one of which belongs to the session.
+		"""
+		if not self.duplicates:
+			return []
+		keys = set(self.duplicates)
+		return [(dm.collection.name, dm.doc_id) for dm in self.datamanagers
+		        if dm.session is session and dm.doc_id
+		        and (dm.collection.name, dm.doc_id) in keys]
+
+	def lookup(self, colname, _id):
+		""" The data manager in the transaction for the document with
+		the given _id, if any.
+		"""
+		return self.documents.get((colname, str(_id)))
+
+_registries = weakref.WeakKeyDictionary()
+
+def get_registry(txn):
+	""" The registry of mongo data managers in the given transaction """
+	registry = _registries.get(txn)
+	if registry is None:
+		registry = _registries[txn] = TransactionRegistry()
+	return registry
+
 def mutative_operation(func):
 	""" For any operation that changes the document, join current transaction
 	if in transactional mode.
@@ -0,0 +1,56 @@
+""" Unit tests """
+
+import unittest
+from connection import ClientRegistry
+
+class ClientStub(object):
+	def __init__(self, host, port, **options):
+		self.host = host
+		self.port = port
+		self.options = options
+		self.closed = False
+
+	def close(self):
+		self.closed = True
+
+class GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		self.registry = ClientRegistry(ClientStub)
+
+	def test_same_parameters_should_share_client(self):
+		client = self.registry.get('localhost', 27017, maxPoolSize=10)
+		self.assertIs(self.registry.get('localhost', 27017, maxPoolSize=10),
+		              client)
+		self.assertEqual(len(self.registry), 1)
+
+	def test_different_parameters_should_not_share_client(self):
+		client = self.registry.get('localhost', 27017)
+		self.assertIsNot(self.registry.get('localhost', 27018), client)
+		self.assertIsNot(self.registry.get('localhost', 27017, connect=False),
+		                 client)
+		self.assertEqual(len(self.registry), 3)
+
+	def test_options_should_be_passed_to_client(self):
+		client = self.registry.get('localhost', 27017, maxPoolSize=10,
+		                           connectTimeoutMS=2000, connect=False)
+		self.assertEqual(client.options, {'maxPoolSize': 10,
+		                                  'connectTimeoutMS': 2000,
+		                                  'connect': False})
+
+	def test_shutdown_should_close_clients(self):
+		client = self.registry.get('localhost', 27017)
+		self.registry.shutdown()
+		self.assertTrue(client.closed)
+		self.assertEqual(len(self.registry), 0)
+		self.assertIsNot(self.registry.get('localhost', 27017), client)
+
+class EdgeCases(unittest.TestCase):
+
+	def test_clients_should_not_be_shared_after_fork(self):
+		registry = ClientRegistry(ClientStub)
+		client = registry.get('localhost', 27017)
+		registry.pid = -1 # as if the registry had been inherited on fork
+		self.assertIsNot(registry.get('localhost', 27017), client)
+		self.assertFalse(client.closed)
+		self.assertEqual(len(registry), 1)
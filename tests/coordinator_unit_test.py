@@ -0,0 +1,367 @@
+""" Unit/Integration tests """
+
+import unittest
+from multiprocessing.pool import ThreadPool
+from bson.objectid import ObjectId
+from transaction.interfaces import TransientError
+from datamanager import MongoDocument
+from coordinator import TransactionCoordinator
+import transaction
+
+colname = 'test_collection'
+
+class BulkStub(object):
+	def __init__(self, collection):
+		self.collection = collection
+		self.ops = []
+
+	def find(self, spec):
+		bulk = self
+		class Selector(object):
+			def replace_one(self, doc):
+				bulk.ops.append(('replace', spec, doc))
+			def update_one(self, doc):
+				bulk.ops.append(('update', spec, doc))
+			def remove_one(self):
+				bulk.ops.append(('remove', spec))
+		return Selector()
+
+	def insert(self, doc):
+		self.ops.append(('insert', doc))
+
+	def execute(self):
+		self.collection.calls.append(('bulk', self.ops))
+
+class CollectionStub(object):
+	def __init__(self, name, docs=()):
+		self.name = name
+		self.docs = list(docs)
+		self.calls = []
+
+	def update(self, spec, document, multi=False):
+		self.calls.append(('update', spec, document, multi))
+
+	def find(self, spec, projection=None):
+		self.calls.append(('find', spec, projection))
+		matches = [doc.copy() for doc in self.docs
+		           if doc['_id'] in spec['_id']['$in']]
+		if projection is not None:
+			matches = [dict((key, value) for key, value in doc.items()
+			                if key == '_id' or projection.has_key(key))
+			           for doc in matches]
+		return iter(matches)
+
+	def initialize_ordered_bulk_op(self):
+		return BulkStub(self)
+
+class SessionStub(object):
+	transactional = True
+	active = True
+	coordinator = None
+
+	def __init__(self):
+		self.db = {colname: CollectionStub(colname)}
+
+class FailingCollectionStub(CollectionStub):
+	def initialize_ordered_bulk_op(self):
+		raise IOError('connection reset')
+
+class PooledSessionStub(SessionStub):
+	commit_pool = ThreadPool(2)
+
+	def __init__(self, failing=False):
+		self.db = {colname: CollectionStub(colname),
+		           'other': (FailingCollectionStub if failing
+		                     else CollectionStub)('other')}
+
+def make_docs(session, n, name=colname):
+	docs = []
+	for i in range(n):
+		doc = MongoDocument(session, name)
+		doc.committed = {'_id': ObjectId(), 'name': 'Saruman' + str(i)}
+		doc.uncommitted = doc.committed.copy()
+		docs.append(doc)
+	session.db[name].docs = [doc.committed.copy() for doc in docs]
+	return docs
+
+class GoodInput(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_begin_should_use_one_round_trip_per_collection(self):
+		session = SessionStub()
+		docs = make_docs(session, 5)
+		txn = transaction.get()
+		coordinator = TransactionCoordinator(session, docs, txn)
+		for doc in docs:
+			coordinator.tpc_begin()
+		calls = session.db[colname].calls
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(len(calls[0][1]['_id']['$in']), 5)
+		self.assertTrue(calls[0][3]) # multi
+
+	def test_vote_read_back_should_use_one_round_trip_per_collection(self):
+		session = SessionStub()
+		docs = make_docs(session, 5)
+		txn = transaction.get()
+		coordinator = TransactionCoordinator(session, docs, txn)
+		for doc in docs:
+			self.assertEqual(coordinator.fetch(doc), doc.committed)
+		self.assertEqual(len(session.db[colname].calls), 1)
+
+	def test_partial_documents_should_be_read_back_in_part(self):
+		session = SessionStub()
+		docs = make_docs(session, 4)
+		for doc in session.db[colname].docs:
+			doc['biography'] = 'x' * 100
+		for doc in docs[2:]:
+			doc.fields = {'name': 1}
+		txn = transaction.get()
+		coordinator = TransactionCoordinator(session, docs, txn)
+		for doc in docs[2:]:
+			self.assertEqual(coordinator.fetch(doc), doc.committed)
+		projections = [call[2] for call in session.db[colname].calls]
+		self.assertEqual(sorted(projections),
+		                 [None, {'name': 1, 'pending_transactions': 1}])
+
+	def test_finish_should_write_all_documents_in_one_bulk_operation(self):
+		session = SessionStub()
+		docs = make_docs(session, 3)
+		docs[0]['name'] = 'Gandalf'
+		docs[1].delete()
+		newdoc = MongoDocument(session, colname)
+		newdoc['name'] = 'Radagast'
+		txn = transaction.get()
+		coordinator = TransactionCoordinator(session, docs + [newdoc], txn)
+		coordinator.tpc_finish()
+		coordinator.tpc_finish()
+		calls = session.db[colname].calls
+		self.assertEqual(len(calls), 1)
+		ops = calls[0][1]
+		self.assertEqual([op[0] for op in ops],
+		                 ['update', 'remove', 'update', 'insert'])
+		self.assertEqual(ops[0][2],
+		                 {'$set': {'name': 'Gandalf'},
+		                  '$unset': {'pending_transactions': 1}})
+		self.assertEqual(ops[2][2], {'$unset': {'pending_transactions': 1}})
+		self.assertEqual(docs[0].committed['name'], 'Gandalf')
+		self.assertEqual(docs[1].committed, {})
+		self.assertIn('_id', newdoc.committed)
+
+	def test_finish_should_replace_documents_swapped_using_set(self):
+		session = SessionStub()
+		docs = make_docs(session, 1)
+		docs[0].set({'_id': docs[0].committed['_id'], 'name': 'Gandalf'})
+		txn = transaction.get()
+		coordinator = TransactionCoordinator(session, docs, txn)
+		coordinator.tpc_finish()
+		op = session.db[colname].calls[0][1][0]
+		self.assertEqual(op[0], 'replace')
+		self.assertEqual(op[2]['name'], 'Gandalf')
+
+	def test_abort_should_release_pending_transaction_in_bulk(self):
+		session = SessionStub()
+		docs = make_docs(session, 5)
+		txn = transaction.get()
+		coordinator = TransactionCoordinator(session, docs, txn)
+		coordinator.tpc_abort()
+		coordinator.tpc_abort()
+		calls = session.db[colname].calls
+		self.assertEqual(len(calls), 2)
+		self.assertIn('$pull', calls[0][2])
+		self.assertIn('$unset', calls[1][2])
+
+	def test_document_should_use_session_coordinator_if_it_manages_it(self):
+		session = SessionStub()
+		docs = make_docs(session, 2)
+		txn = transaction.get()
+		session.coordinator = TransactionCoordinator(session, docs, txn)
+		self.assertIs(docs[0]._coordinator(txn), session.coordinator)
+		self.assertIs(docs[1]._coordinator(txn), session.coordinator)
+
+class EdgeCases(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_unmanaged_document_should_fall_back_to_own_coordinator(self):
+		session = SessionStub()
+		docs = make_docs(session, 2)
+		txn = transaction.get()
+		session.coordinator = TransactionCoordinator(session, docs[:1], txn)
+		coordinator = docs[1]._coordinator(txn)
+		self.assertIsNot(coordinator, session.coordinator)
+		self.assertTrue(coordinator.manages(docs[1], txn))
+		self.assertIs(docs[1]._coordinator(txn), coordinator)
+
+	def test_documents_only_updated_with_operators_should_not_be_locked(self):
+		session = SessionStub()
+		docs = make_docs(session, 2)
+		docs[0].inc('visits')
+		docs[1].inc('visits')
+		docs[1]['name'] = 'Gandalf'
+		txn = transaction.get()
+		coordinator = TransactionCoordinator(session, docs, txn)
+		coordinator.tpc_begin()
+		coordinator.tpc_finish()
+		calls = session.db[colname].calls
+		self.assertEqual(calls[0][1], {'_id': {'$in': [docs[1].committed['_id']]}})
+		ops = calls[1][1]
+		self.assertEqual(ops[0][2], {'$inc': {'visits': 1}})
+		self.assertIn('$unset', ops[1][2])
+
+	def test_new_documents_should_not_be_locked_or_read_back(self):
+		session = SessionStub()
+		doc = MongoDocument(session, colname)
+		doc['name'] = 'Saruman'
+		txn = transaction.get()
+		coordinator = TransactionCoordinator(session, [doc], txn)
+		coordinator.tpc_begin()
+		coordinator.tpc_abort()
+		self.assertEqual(session.db[colname].calls, [])
+
+class Pooled_GoodInput(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_phases_should_cover_all_collections(self):
+		session = PooledSessionStub()
+		docs = make_docs(session, 2) + make_docs(session, 2, 'other')
+		for doc in docs:
+			doc['profession'] = 'wizard'
+		coordinator = TransactionCoordinator(session, docs, transaction.get())
+		coordinator.tpc_begin()
+		for doc in docs:
+			self.assertEqual(coordinator.fetch(doc), doc.committed)
+		coordinator.tpc_finish()
+		for name in (colname, 'other'):
+			calls = session.db[name].calls
+			self.assertEqual([call[0] for call in calls],
+			                 ['update', 'find', 'bulk'])
+		for doc in docs:
+			self.assertEqual(doc.committed['profession'], 'wizard')
+
+class Pooled_BadInput(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_error_should_be_raised_after_all_collections_are_written(self):
+		session = PooledSessionStub(failing=True)
+		docs = make_docs(session, 1) + make_docs(session, 1, 'other')
+		for doc in docs:
+			doc['profession'] = 'wizard'
+		coordinator = TransactionCoordinator(session, docs, transaction.get())
+		self.assertRaises(IOError, coordinator.tpc_finish)
+		self.assertEqual(len(session.db[colname].calls), 1)
+		self.assertEqual(docs[0].committed['profession'], 'wizard')
+		self.assertNotIn('profession', docs[1].committed)
+
+class VersionedCollectionStub(CollectionStub):
+	""" Applies conditional writes to the stored documents """
+
+	def _matching(self, spec):
+		return [doc for doc in self.docs
+		        if doc['_id'] == spec['_id'] and doc.get('_v') == spec['_v']]
+
+	def update(self, spec, document, multi=False):
+		self.calls.append(('update', spec, document, multi))
+		matches = self._matching(spec)
+		for doc in matches:
+			if filter(lambda f: f.startswith('$'), document.keys()):
+				doc.update(document.get('$set', {}))
+				for key in document.get('$unset', {}):
+					doc.pop(key, None)
+			else:
+				doc.clear()
+				doc.update(document)
+		return {'n': len(matches)}
+
+	def remove(self, spec):
+		self.calls.append(('remove', spec))
+		matches = self._matching(spec)
+		for doc in matches:
+			self.docs.remove(doc)
+		return {'n': len(matches)}
+
+	def insert(self, document):
+		self.calls.append(('insert', document))
+		self.docs.append(dict(document))
+
+class VersionedSessionStub(SessionStub):
+	versioned = True
+
+	def __init__(self):
+		self.db = {colname: VersionedCollectionStub(colname)}
+
+def vote(session, docs):
+	txn = transaction.get()
+	session.coordinator = TransactionCoordinator(session, docs, txn)
+	session.coordinator.tpc_begin()
+	for doc in docs:
+		doc.tpc_vote(txn)
+	return session.coordinator
+
+class Versioned_GoodInput(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_documents_should_be_written_once_all_have_voted(self):
+		session = VersionedSessionStub()
+		docs = make_docs(session, 2)
+		docs[0]['name'] = 'Gandalf'
+		newdoc = MongoDocument(session, colname)
+		newdoc['name'] = 'Radagast'
+		coordinator = vote(session, docs + [newdoc])
+		calls = session.db[colname].calls
+		self.assertEqual([call[0] for call in calls],
+		                 ['update', 'update', 'insert'])
+		self.assertEqual(calls[0][1], {'_id': docs[0]['_id'], '_v': None})
+		self.assertEqual(calls[0][2], {'$set': {'name': 'Gandalf', '_v': 1}})
+		self.assertEqual(calls[2][1]['_v'], 1)
+		coordinator.tpc_finish()
+		self.assertEqual(len(calls), 3)
+		self.assertEqual(docs[0].committed['_v'], 1)
+		self.assertEqual(session.db[colname].docs[0]['name'], 'Gandalf')
+
+	def test_version_should_be_checked_against_version_loaded(self):
+		session = VersionedSessionStub()
+		docs = make_docs(session, 1)
+		session.db[colname].docs[0]['_v'] = 4
+		docs[0].committed['_v'] = 4
+		docs[0]['name'] = 'Gandalf'
+		vote(session, docs)
+		self.assertEqual(session.db[colname].docs[0]['_v'], 5)
+
+class Versioned_BadInput(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_concurrent_modification_should_raise_error(self):
+		session = VersionedSessionStub()
+		docs = make_docs(session, 2)
+		session.db[colname].docs[1]['_v'] = 1 # written by someone else
+		for doc in docs:
+			doc['profession'] = 'wizard'
+		self.assertRaises(TransientError, vote, session, docs)
+
+	def test_abort_should_undo_writes_made_in_vote(self):
+		session = VersionedSessionStub()
+		docs = make_docs(session, 2)
+		stored = session.db[colname].docs
+		original = [doc.copy() for doc in stored]
+		stored[1]['_v'] = 1
+		docs[0]['profession'] = 'wizard'
+		docs[1].delete()
+		newdoc = MongoDocument(session, colname)
+		newdoc['name'] = 'Radagast'
+		self.assertRaises(TransientError, vote, session,
+		                  docs + [newdoc])
+		self.assertEqual(stored[0]['profession'], 'wizard')
+		for doc in docs:
+			doc.tpc_abort(transaction.get())
+		self.assertEqual(stored, [original[0], dict(original[1], _v=1)])
@@ -1,17 +1,45 @@
+import re
 import unittest
-from datamanager import MongoDocument
+from bson.regex import Regex
+from datamanager import MongoDocument, prefetch
 from mongomorphism.exceptions import (
+		ConcurrentModificationError,
 		DocumentMatchNotUniqueError,
 		DocumentNotFoundError,
 		DuplicateDataManagersError,
+		MergeConflictError,
+		PartialCommitError,
 		)
 from config import Session
+import instrumentation
+import threadpools
 from pymongo import MongoClient
 import transaction
 
 dbname = '_test_db'
 colname = '_test_col'
 
+class LockingResource(object):
+	""" Another transaction locking a document after the mongo data
+	managers voted (it votes after them) and before they finish
+	"""
+	def __init__(self, spec):
+		self.spec = spec
+		self.transaction_manager = transaction.manager
+
+	def sortKey(self):
+		return 'zzzlocker'
+
+	def tpc_vote(self, txn):
+		MongoClient()[dbname][colname].update(
+		    self.spec, {'$push': {'pending_transactions': 'other'}})
+
+	def tpc_begin(self, txn): pass
+	def commit(self, txn): pass
+	def tpc_finish(self, txn): pass
+	def tpc_abort(self, txn): pass
+	def abort(self, txn): pass
+
 class Transactional_GoodInput(unittest.TestCase):
 
 	def setUp(self):
@@ -69,6 +97,194 @@ class Transactional_GoodInput(unittest.TestCase):
 		                  MongoDocument,
 		                  self.session, colname, retrieve={'name':'Saruman'})
 
+	def test_repeated_loads_by_id_should_return_same_instance(self):
+		session = Session(dbname, identity_map=True)
+		self.doc['name'] = 'Saruman'
+		transaction.commit()
+		doc2 = MongoDocument(session, colname, retrieve={'name':'Saruman'})
+		doc3 = MongoDocument(session, colname,
+		                     retrieve={'_id':doc2['_id']})
+		self.assertIs(doc2, doc3)
+		self.assertEqual(session.identity_map.hits, 1)
+		doc3['profession'] = 'wizard'
+		transaction.commit()
+		doc4 = MongoDocument(session, colname,
+		                     retrieve={'_id':doc2['_id']})
+		self.assertIsNot(doc4, doc2)
+		self.assertEqual(doc4['profession'], 'wizard')
+
+	def test_referenced_documents_should_be_dereferenced(self):
+		self.doc['name'] = 'Saruman'
+		transaction.commit()
+		docs = []
+		for name in ('Gandalf', 'Radagast'):
+			doc = MongoDocument(self.session, colname)
+			doc['name'] = name
+			doc['friend'] = self.doc
+			docs.append(doc)
+		transaction.commit()
+		prefetch(docs, 'friend')
+		for doc in docs:
+			self.assertEqual(doc['friend']['name'], 'Saruman')
+		docs[0]['friend']['profession'] = 'wizard'
+		transaction.commit()
+		doc2 = MongoDocument(self.session,
+		                     colname,
+		                     retrieve={'name':'Saruman'})
+		self.assertEqual(doc2['profession'], 'wizard')
+
+	def test_references_between_new_documents_should_be_written_inline(self):
+		docs = []
+		for name in ('Gandalf', 'Radagast', 'Saruman'):
+			doc = MongoDocument(self.session, colname)
+			doc['name'] = name
+			docs.append(doc)
+		for i, doc in enumerate(docs):
+			doc['friend'] = docs[(i + 1) % len(docs)]
+		transaction.commit()
+		stored = MongoClient()[dbname][colname].find_one({'name': 'Gandalf'})
+		self.assertEqual(stored['friend'].id, docs[1]['_id'])
+		doc2 = MongoDocument(self.session, colname,
+		                     retrieve={'name':'Saruman'})
+		self.assertEqual(doc2['friend']['friend']['name'], 'Radagast')
+
+	def test_commit_pool_should_persist_documents_in_all_collections(self):
+		session = Session(dbname, commit_threads=2)
+		doc1 = MongoDocument(session, colname)
+		doc1['name'] = 'Saruman'
+		doc2 = MongoDocument(session, colname + '2')
+		doc2['name'] = 'Gandalf'
+		transaction.commit()
+		doc1['profession'] = 'wizard'
+		doc2['profession'] = 'wizard'
+		transaction.commit()
+		for name in (colname, colname + '2'):
+			doc = MongoDocument(session, name, retrieve={'profession':'wizard'})
+			self.assertNotIn('pending_transactions', doc.committed)
+		self.assertIs(Session(dbname, commit_threads=2).commit_pool,
+		              session.commit_pool)
+
+	def test_commit_pool_should_be_replaced_after_shutdown(self):
+		session = Session(dbname, commit_threads=2)
+		pool = session.commit_pool
+		threadpools.shutdown()
+		doc1 = MongoDocument(session, colname)
+		doc1['name'] = 'Saruman'
+		doc2 = MongoDocument(session, colname + '2')
+		doc2['name'] = 'Gandalf'
+		transaction.commit()
+		self.assertIsNot(session.commit_pool, pool)
+		self.assertEqual(MongoClient()[dbname][colname + '2'].find_one()['name'],
+		                 'Gandalf')
+
+	def test_versioned_session_should_count_writes(self):
+		session = Session(dbname, versioned=True)
+		doc = MongoDocument(session, colname)
+		doc['name'] = 'Saruman'
+		transaction.commit()
+		doc['profession'] = 'wizard'
+		transaction.commit()
+		doc2 = MongoDocument(session, colname, retrieve={'name':'Saruman'})
+		self.assertEqual(doc2.committed['_v'], 2)
+		self.assertEqual(doc2['profession'], 'wizard')
+		self.assertEqual(doc.committed, doc2.committed)
+
+	def test_find_should_stream_documents_and_write_only_changed_ones(self):
+		for name in ('Gandalf', 'Radagast', 'Saruman'):
+			doc = MongoDocument(self.session, colname)
+			doc['name'] = name
+			doc['profession'] = 'wizard'
+		transaction.commit()
+		docs = MongoDocument.find(self.session, colname,
+		                          {'profession': 'wizard'}, batch_size=2)
+		for doc in docs:
+			if doc['name'] == 'Saruman':
+				doc['color'] = 'white'
+		self.assertEqual(len(transaction.get()._resources), 1)
+		transaction.commit()
+		doc2 = MongoDocument(self.session, colname,
+		                     retrieve={'color':'white'})
+		self.assertEqual(doc2['name'], 'Saruman')
+
+	def test_partial_documents_should_keep_keys_not_loaded(self):
+		self.doc['name'] = 'Saruman'
+		self.doc['biography'] = 'x' * 1000
+		transaction.commit()
+		doc2 = MongoDocument.find(self.session, colname,
+		                          projection={'biography': 0}).next()
+		self.assertNotIn('biography', doc2.committed)
+		doc2['profession'] = 'wizard'
+		transaction.commit()
+		doc3 = MongoDocument(self.session, colname,
+		                     retrieve={'name':'Saruman'})
+		self.assertEqual(doc3['profession'], 'wizard')
+		self.assertEqual(len(doc3['biography']), 1000)
+
+	def test_partial_document_should_ignore_changes_to_keys_not_loaded(self):
+		self.doc['name'] = 'Saruman'
+		self.doc['visits'] = 1
+		self.doc['log'] = ['arrived']
+		transaction.commit()
+		doc2 = MongoDocument(self.session, colname,
+		                     retrieve={'name':'Saruman'}, fields=['visits'])
+		MongoClient()[dbname][colname].update({'name': 'Saruman'},
+		                                      {'$push': {'log': 'left'}})
+		doc2['visits'] += 1
+		transaction.commit()
+		doc3 = MongoDocument(self.session, colname,
+		                     retrieve={'name':'Saruman'})
+		self.assertEqual(doc3['visits'], 2)
+		self.assertEqual(doc3['log'], ['arrived', 'left'])
+
+	def test_operators_should_not_conflict_with_concurrent_updates(self):
+		self.doc['name'] = 'Saruman'
+		self.doc['visits'] = 1
+		transaction.commit()
+		collection = MongoClient()[dbname][colname]
+		self.doc.inc('visits')
+		self.doc.push('log', 'arrived')
+		# another client increments the counter in the meantime
+		collection.update({'name': 'Saruman'}, {'$inc': {'visits': 5}})
+		transaction.commit()
+		stored = collection.find_one({'name': 'Saruman'})
+		self.assertEqual(stored['visits'], 7)
+		self.assertEqual(stored['log'], ['arrived'])
+		self.assertNotIn('pending_transactions', stored)
+		self.assertEqual(self.doc['visits'], 7)
+
+	def test_operators_should_conflict_with_locking_transaction(self):
+		self.doc['name'] = 'Saruman'
+		self.doc['visits'] = 1
+		transaction.commit()
+		collection = MongoClient()[dbname][colname]
+		self.doc.inc('visits')
+		# another transaction has the document locked, and would overwrite
+		# the increment when it finishes
+		collection.update({'name': 'Saruman'},
+		                  {'$push': {'pending_transactions': 'other'}})
+		self.assertRaises(ConcurrentModificationError, transaction.commit)
+		transaction.abort()
+		stored = collection.find_one({'name': 'Saruman'})
+		self.assertEqual(stored['visits'], 1)
+		self.assertEqual(stored['pending_transactions'], ['other'])
+
+	def test_commit_should_be_measured(self):
+		self.doc['name'] = 'Saruman'
+		transaction.commit()
+		with instrumentation.capture(self.session) as metrics:
+			self.doc['profession'] = 'wizard'
+			doc2 = MongoDocument(self.session, colname + '2')
+			doc2['name'] = 'Gandalf'
+			transaction.commit()
+		self.assertEqual(metrics.histogram('documents').total, 2)
+		# lock, read back and write the existing document, insert the new
+		# one, and record the transaction
+		self.assertEqual(metrics.total('round_trips', colname), 3)
+		self.assertEqual(metrics.total('round_trips', colname + '2'), 1)
+		self.assertEqual(metrics.total('round_trips', 'transactions'), 2)
+		self.assertEqual(metrics.histogram('tpc_finish').count, 2)
+		self.assertTrue(metrics.total('bytes_encoded', colname + '2') > 0)
+
 class Transactional_BadInput(unittest.TestCase):
 
 	def setUp(self):
@@ -93,6 +309,82 @@ class Transactional_BadInput(unittest.TestCase):
 		doc3['profession'] = 'warlock'
 		self.assertRaises(DuplicateDataManagersError, transaction.commit)
 
+	def test_concurrent_modification_should_fail_commit(self):
+		self.doc['name'] = 'Saruman'
+		transaction.commit()
+		MongoClient()[dbname][colname].update({'name': 'Saruman'},
+		                                      {'$set': {'color': 'white'}})
+		self.doc['profession'] = 'wizard'
+		with instrumentation.capture(self.session) as metrics:
+			self.assertRaises(ConcurrentModificationError, transaction.commit)
+		self.assertEqual(metrics.total('conflicts', colname), 1)
+		self.assertEqual(metrics.total('aborts', colname), 1)
+		transaction.abort()
+		# the session can still be used
+		doc2 = MongoDocument(self.session, colname,
+		                     retrieve={'name':'Saruman'})
+		doc2['profession'] = 'wizard'
+		transaction.commit()
+		self.assertEqual(doc2.committed['color'], 'white')
+
+	def test_concurrent_modification_of_loaded_key_should_fail_commit(self):
+		self.doc['name'] = 'Saruman'
+		self.doc['visits'] = 1
+		transaction.commit()
+		doc2 = MongoDocument(self.session, colname,
+		                     retrieve={'name':'Saruman'}, fields=['visits'])
+		MongoClient()[dbname][colname].update({'name': 'Saruman'},
+		                                      {'$inc': {'visits': 1}})
+		doc2['visits'] += 1
+		self.assertRaises(ConcurrentModificationError, transaction.commit)
+
+	def test_conflicting_unit_of_work_should_be_retried(self):
+		self.doc['name'] = 'Saruman'
+		transaction.commit()
+		attempts = []
+		def work():
+			doc = MongoDocument(self.session, colname,
+			                    retrieve={'name':'Saruman'})
+			doc['profession'] = 'wizard'
+			if not attempts: # someone else writes in the meantime
+				MongoClient()[dbname][colname].update(
+				    {'name': 'Saruman'}, {'$set': {'color': 'white'}})
+			attempts.append(doc)
+		self.session.run(work, backoff=0)
+		self.assertEqual(len(attempts), 2)
+		self.assertEqual(self.session.conflict_stats.conflicts, {colname: 1})
+		self.assertEqual(self.session.conflict_stats.retries, {colname: 1})
+		doc2 = MongoDocument(self.session, colname,
+		                     retrieve={'name':'Saruman'})
+		self.assertEqual(doc2['profession'], 'wizard')
+		self.assertEqual(doc2['color'], 'white')
+
+	def test_document_locked_after_vote_should_not_be_retried(self):
+		self.doc['name'] = 'Saruman'
+		self.doc['visits'] = 0
+		doc2 = MongoDocument(self.session, colname)
+		doc2['name'] = 'Gandalf'
+		doc2['visits'] = 0
+		transaction.commit()
+		attempts = []
+		def work():
+			doc = MongoDocument(self.session, colname,
+			                    retrieve={'name':'Saruman'})
+			doc2 = MongoDocument(self.session, colname,
+			                     retrieve={'name':'Gandalf'})
+			doc.inc('visits')
+			doc2.inc('visits')
+			if not attempts:
+				transaction.get().join(LockingResource({'name': 'Gandalf'}))
+			attempts.append(doc)
+		self.assertRaises(PartialCommitError, self.session.run, work,
+		                  backoff=0)
+		self.assertEqual(len(attempts), 1)
+		self.assertEqual(self.session.conflict_stats.conflicts, {})
+		collection = MongoClient()[dbname][colname]
+		self.assertEqual(collection.find_one({'name': 'Saruman'})['visits'], 1)
+		self.assertEqual(collection.find_one({'name': 'Gandalf'})['visits'], 0)
+
 class Transactional_EdgeCases(unittest.TestCase):
 
 	def setUp(self):
@@ -141,6 +433,162 @@ class Transactional_EdgeCases(unittest.TestCase):
 		self.assertEqual(self.doc.committed, doc3.committed)
 		self.assertEqual(doc2.committed, doc4.committed)
 
+	def test_serialized_values_should_survive_reload(self):
+		self.doc['name'] = 'Saruman'
+		self.doc['age'] = 2**70
+		self.doc['tags'] = set(['istar'])
+		self.doc['code'] = '123'
+		transaction.commit()
+		doc2 = MongoDocument(Session(dbname), colname,
+		                     retrieve={'name':'Saruman'})
+		self.assertEqual(doc2['age'], 2**70)
+		self.assertEqual(doc2['tags'], set(['istar']))
+		self.assertEqual(doc2['code'], '123')
+
+	def test_aborted_versioned_writes_should_keep_keys_not_loaded(self):
+		session = Session(dbname, versioned=True)
+		collection = MongoClient()[dbname][colname]
+		collection.insert({'name': 'Saruman', 'blob': 'x' * 100,
+		                   'other': 1, '_v': 1})
+		collection.insert({'name': 'Gandalf', 'blob': 'y', '_v': 1})
+		collection.insert({'name': 'Radagast', '_v': 1})
+		doc1 = MongoDocument(session, colname, retrieve={'name':'Saruman'},
+		                     fields=['name'])
+		doc2 = MongoDocument(session, colname, retrieve={'name':'Gandalf'},
+		                     fields=['name'])
+		doc3 = MongoDocument(session, colname, retrieve={'name':'Radagast'})
+		doc1['name'] = 'Saruman the White'
+		doc1['blob'] = 'z'
+		doc2.delete()
+		doc3['profession'] = 'wizard'
+		collection.update({'name': 'Radagast'}, {'$set': {'_v': 2}})
+		self.assertRaises(ConcurrentModificationError, transaction.commit)
+		transaction.abort()
+		stored = collection.find_one({'name': 'Saruman'}, {'_id': 0})
+		self.assertEqual(stored, {'name': 'Saruman', 'blob': 'x' * 100,
+		                          'other': 1, '_v': 1})
+		stored = collection.find_one({'name': 'Gandalf'}, {'_id': 0})
+		self.assertEqual(stored, {'name': 'Gandalf', 'blob': 'y', '_v': 1})
+
+class Merge_GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		self.session = Session(dbname, merge=True)
+		doc = MongoDocument(self.session, colname)
+		doc['name'] = 'Saruman'
+		doc['visits'] = 1
+		transaction.commit()
+
+	def tearDown(self):
+		transaction.abort()
+		conn = MongoClient()
+		conn.drop_database(dbname)
+
+	def load(self, session=None, **kws):
+		return MongoDocument(session or self.session, colname,
+		                     retrieve={'name':'Saruman'}, **kws)
+
+	def test_changes_to_different_keys_should_be_written_once(self):
+		doc1, doc2 = self.load(), self.load()
+		doc1['profession'] = 'wizard'
+		doc2['color'] = 'white'
+		with instrumentation.capture(self.session) as metrics:
+			transaction.commit()
+		# lock, read back and write the document once
+		self.assertEqual(metrics.total('round_trips', colname), 3)
+		stored = MongoClient()[dbname][colname].find_one()
+		self.assertEqual(stored['profession'], 'wizard')
+		self.assertEqual(stored['color'], 'white')
+		self.assertNotIn('pending_transactions', stored)
+		self.assertEqual(doc1.committed, doc2.committed)
+		doc2['color'] = 'grey'
+		transaction.commit()
+		self.assertEqual(self.load()['color'], 'grey')
+
+	def test_operators_on_a_key_should_be_combined(self):
+		doc1, doc2 = self.load(), self.load()
+		doc1.inc('visits')
+		doc2.inc('visits', 2)
+		doc2.push('log', 'arrived')
+		transaction.commit()
+		doc3 = self.load()
+		self.assertEqual(doc3['visits'], 4)
+		self.assertEqual(doc3['log'], ['arrived'])
+
+	def test_partial_documents_should_be_merged(self):
+		doc1 = self.load(fields=['visits'])
+		doc2 = self.load(fields=['name'])
+		doc1['visits'] += 1
+		doc2['profession'] = 'wizard'
+		transaction.commit()
+		doc3 = self.load()
+		self.assertEqual(doc3['visits'], 2)
+		self.assertEqual(doc3['profession'], 'wizard')
+
+	def test_versioned_documents_should_be_written_once(self):
+		session = Session(dbname, versioned=True, merge=True)
+		doc1, doc2 = self.load(session), self.load(session)
+		doc1['profession'] = 'wizard'
+		doc2['color'] = 'white'
+		transaction.commit()
+		doc3 = self.load(session)
+		self.assertEqual(doc3.committed['_v'], 1)
+		self.assertEqual(doc3['color'], 'white')
+		self.assertEqual(doc3['profession'], 'wizard')
+
+	def test_other_sessions_should_not_fail_on_merged_documents(self):
+		session = Session(dbname)
+		doc1, doc2 = self.load(), self.load()
+		doc3 = MongoDocument(session, colname)
+		doc1['profession'] = 'wizard'
+		doc2['color'] = 'white'
+		doc3['name'] = 'Gandalf'
+		transaction.commit()
+		self.assertEqual(self.load()['color'], 'white')
+		self.assertEqual(MongoDocument(session, colname,
+		                               retrieve={'name':'Gandalf'})['name'],
+		                 'Gandalf')
+
+class Merge_BadInput(unittest.TestCase):
+
+	def setUp(self):
+		self.session = Session(dbname, merge=True)
+		doc = MongoDocument(self.session, colname)
+		doc['name'] = 'Saruman'
+		transaction.commit()
+
+	def tearDown(self):
+		transaction.abort()
+		conn = MongoClient()
+		conn.drop_database(dbname)
+
+	def load(self):
+		return MongoDocument(self.session, colname,
+		                     retrieve={'name':'Saruman'})
+
+	def test_conflicting_changes_to_a_key_should_fail_commit(self):
+		doc1, doc2 = self.load(), self.load()
+		doc1['profession'] = 'wizard'
+		doc2['profession'] = 'warlock'
+		self.assertRaises(MergeConflictError, transaction.commit)
+		transaction.abort()
+		self.assertFalse(self.load().has_key('profession'))
+
+	def test_deleting_a_changed_document_should_fail_commit(self):
+		doc1, doc2 = self.load(), self.load()
+		doc1['profession'] = 'wizard'
+		doc2.delete()
+		self.assertRaises(MergeConflictError, transaction.commit)
+
+	def test_stale_data_manager_should_fail_commit(self):
+		doc1 = self.load()
+		MongoClient()[dbname][colname].update({'name': 'Saruman'},
+		                                      {'$set': {'color': 'white'}})
+		doc2 = self.load()
+		doc1['profession'] = 'wizard'
+		doc2['visits'] = 1
+		self.assertRaises(ConcurrentModificationError, transaction.commit)
+
 class NonTransactional_GoodInput(unittest.TestCase):
 
 	def setUp(self):
@@ -178,6 +626,39 @@ class NonTransactional_GoodInput(unittest.TestCase):
 		                  MongoDocument,
 		                  self.session, colname, retrieve={'name':'Saruman'})
 
+	def test_load_many_should_retrieve_documents_in_order_of_specs(self):
+		self.doc['name'] = 'Saruman'
+		self.doc.save()
+		doc2 = MongoDocument(self.session, colname)
+		doc2['name'] = 'Gandalf'
+		doc2['color'] = 'grey'
+		doc2.save()
+		docs = MongoDocument.load_many(self.session, colname,
+		                               [{'name': 'Gandalf'},
+		                                {'_id': self.doc['_id']},
+		                                {'color': {'$in': ['grey']}}])
+		self.assertEqual([doc.committed for doc in docs],
+		                 [doc2.committed, self.doc.committed, doc2.committed])
+		docs = MongoDocument.load_many(self.session, colname,
+		                               [{'_id': doc2['_id']},
+		                                {'_id': self.doc['_id']}])
+		self.assertEqual([doc.committed for doc in docs],
+		                 [doc2.committed, self.doc.committed])
+
+	def test_load_many_should_match_regular_expressions(self):
+		self.doc['name'] = 'Saruman'
+		self.doc.save()
+		doc2 = MongoDocument(self.session, colname)
+		doc2['name'] = 'Gandalf'
+		doc2.save()
+		docs = MongoDocument.load_many(self.session, colname,
+		                               [{'name': re.compile('^Sar')},
+		                                {'name': Regex('^Gan')},
+		                                {'name': 'Saruman'}])
+		self.assertEqual([doc.committed for doc in docs],
+		                 [self.doc.committed, doc2.committed,
+		                  self.doc.committed])
+
 class NonTransactional_BadInput(unittest.TestCase):
 
 	def setUp(self):
@@ -205,6 +686,14 @@ class NonTransactional_BadInput(unittest.TestCase):
 		                  MongoDocument,
 		                  self.session, colname, retrieve={'firstname':'Saruman'})
 
+	def test_load_many_should_raise_error_if_a_spec_does_not_find_document(self):
+		self.doc['firstname'] = 'Saruman'
+		self.doc.save()
+		self.assertRaises(DocumentNotFoundError,
+		                  MongoDocument.load_many,
+		                  self.session, colname, [{'firstname':'Saruman'},
+		                                          {'firstname':'Gandalf'}])
+
 class NonTransactional_EdgeCases(unittest.TestCase):
 
 	def setUp(self):
@@ -228,3 +717,17 @@ class NonTransactional_EdgeCases(unittest.TestCase):
 		self.assertEqual(self.doc.uncommitted, {})
 		self.assertEqual(self.doc.committed, {})
 
+	def test_save_should_only_write_changed_keys(self):
+		self.doc['name'] = 'Saruman'
+		self.doc.save()
+		conn = MongoClient()
+		conn[dbname][colname].update({'name': 'Saruman'},
+		                             {'$set': {'color': 'white'}})
+		self.doc['profession'] = 'wizard'
+		self.doc.save()
+		doc2 = MongoDocument(self.session,
+		                     colname,
+		                     retrieve={'name':'Saruman'})
+		self.assertEqual(doc2['color'], 'white')
+		self.assertEqual(doc2['profession'], 'wizard')
+
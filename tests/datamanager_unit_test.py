@@ -1,17 +1,97 @@
 """ Unit/Integration tests """
 
 import unittest
-from datamanager import MongoDocument
-from mongomorphism.exceptions import SessionNotInitializedError
+from bson.dbref import DBRef
+from bson.errors import InvalidDocument
+from bson.raw_bson import RawBSONDocument
+from coordinator import TransactionCoordinator
+from datamanager import MongoDocument, DocumentReference, prefetch
+from datamanager import _include, _included, _project
+from mongomorphism.exceptions import (
+		DocumentMatchNotUniqueError,
+		DocumentNotFoundError,
+		PartialDocumentError,
+		SessionNotInitializedError,
+		)
 import transaction
 
 colname = 'test_collection'
 
+class NameStub(object):
+	""" A collection that is never queried """
+	name = colname
+
 class SessionStub(object):
-	db = {colname: None}
+	db = {colname: NameStub()}
 	transactional = True
 	active = True
 
+def project(doc, projection):
+	""" The document as mongodb returns it for the projection """
+	if filter(None, [value for key, value in projection.items()
+	                 if key != '_id']):
+		return dict((key, value) for key, value in doc.items()
+		            if key == '_id' or projection.get(key))
+	return dict((key, value) for key, value in doc.items()
+	            if projection.get(key, 1))
+
+class CursorStub(object):
+	def __init__(self, collection, docs):
+		self.collection = collection
+		self.docs = docs
+
+	def limit(self, n):
+		self.collection.calls.append(('limit', n))
+		return iter(self.docs[:n])
+
+	def batch_size(self, n):
+		self.collection.calls.append(('batch_size', n))
+		return self
+
+	def __iter__(self):
+		return iter(self.docs)
+
+class CollectionStub(object):
+	name = colname
+
+	def __init__(self, docs):
+		self.docs = docs
+		self.calls = []
+
+	def find(self, spec, projection=None):
+		if projection is not None:
+			self.calls.append(('find', spec, projection))
+		else:
+			self.calls.append(('find', spec))
+		if spec is None:
+			matches = self.docs
+		elif spec.has_key('_id'):
+			matches = [doc for doc in self.docs
+			           if doc['_id'] in spec['_id']['$in']]
+		elif spec.has_key('$or'):
+			matches = self.docs
+		else:
+			matches = [doc for doc in self.docs
+			           if doc['name'] == spec['name']]
+		if projection is not None:
+			matches = [project(doc, projection) for doc in matches]
+		return CursorStub(self, matches)
+
+	def find_one(self, spec, projection=None):
+		if projection is not None:
+			self.calls.append(('find_one', spec, projection))
+		else:
+			self.calls.append(('find_one', spec))
+		for doc in self.docs:
+			if doc['_id'] == spec['_id']:
+				if projection is not None:
+					return project(doc, projection)
+				return doc
+
+class QueryingSessionStub(SessionStub):
+	def __init__(self, docs):
+		self.db = {colname: CollectionStub(docs)}
+
 class Transactional_GoodInput(unittest.TestCase):
 
 	def tearDown(self):
@@ -63,7 +143,509 @@ class Transactional_BadInput(unittest.TestCase):
 		self.assertRaises(SessionNotInitializedError, doc.__setitem__, 'name', 'Saruman')
 
 class Transactional_EdgeCases(unittest.TestCase):
-	pass
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_savepoint_rollback_should_restore_changed_keys(self):
+		session = SessionStub()
+		doc = MongoDocument(session, colname)
+		doc.committed = {'_id': 1, 'name': 'Saruman'}
+		doc.uncommitted = doc.committed.copy()
+		doc['profession'] = 'wizard'
+		savepoint = transaction.savepoint()
+		doc['name'] = 'Gandalf'
+		savepoint.rollback()
+		self.assertEqual(doc.diff(), {'$set': {'profession': 'wizard'}})
+
+	def test_savepoints_and_abort_should_not_copy_the_document(self):
+		session = SessionStub()
+		doc = MongoDocument(session, colname)
+		doc.committed = {'_id': 1, 'name': 'Saruman'}
+		doc.abort(transaction.get())
+		doc['profession'] = 'wizard'
+		savepoint = doc.savepoint()
+		self.assertIs(savepoint.saved_changes.base, doc.committed)
+		self.assertEqual(savepoint.saved_changes.changes,
+		                 {'profession': 'wizard'})
+		transaction.abort()
+		self.assertIs(doc.uncommitted.base, doc.committed)
+		self.assertEqual(doc.uncommitted, {'_id': 1, 'name': 'Saruman'})
+
+class Layout_GoodInput(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_document_should_have_no_instance_dict(self):
+		doc = MongoDocument(SessionStub(), colname)
+		self.assertFalse(hasattr(doc, '__dict__'))
+
+	def test_doc_id_should_follow_the_id(self):
+		doc = MongoDocument(SessionStub(), colname)
+		self.assertEqual(doc.doc_id, None)
+		doc._generate_id()
+		self.assertEqual(doc.doc_id, str(doc['_id']))
+		doc.committed = {'_id': 1}
+		doc.abort(None)
+		self.assertEqual(doc.doc_id, '1')
+
+class Diff_GoodInput(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def setUp(self):
+		self.session = SessionStub()
+		self.doc = MongoDocument(self.session, colname)
+		self.doc.committed = {'_id': 1, 'name': 'Saruman', 'profession': 'wizard'}
+		self.doc.uncommitted = self.doc.committed.copy()
+
+	def test_diff_should_be_empty_when_nothing_changed(self):
+		self.assertEqual(self.doc.diff(), {})
+
+	def test_diff_should_set_only_changed_keys(self):
+		self.doc['name'] = 'Gandalf'
+		self.doc['color'] = 'grey'
+		self.assertEqual(self.doc.diff(),
+		                 {'$set': {'name': 'Gandalf', 'color': 'grey'}})
+
+	def test_diff_should_unset_deleted_keys(self):
+		del self.doc['profession']
+		self.assertEqual(self.doc.diff(), {'$unset': {'profession': 1}})
+
+	def test_diff_should_ignore_keys_added_and_deleted_again(self):
+		self.doc['color'] = 'grey'
+		del self.doc['color']
+		self.assertEqual(self.doc.diff(), {})
+
+	def test_diff_should_be_whole_document_when_set(self):
+		self.doc.set({'_id': 1, 'name': 'Gandalf'})
+		self.assertEqual(self.doc.diff(), {'_id': 1, 'name': 'Gandalf'})
+
+	def test_diff_should_be_reset_on_abort(self):
+		self.doc['name'] = 'Gandalf'
+		transaction.abort()
+		self.assertEqual(self.doc.diff(), {})
+
+class Operators_GoodInput(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def setUp(self):
+		self.session = SessionStub()
+		self.doc = MongoDocument(self.session, colname)
+		self.doc.committed = {'_id': 1, 'name': 'Saruman', 'visits': 1,
+		                      'log': []}
+		self.doc.uncommitted = self.doc.committed.copy()
+
+	def test_operators_should_be_sent_as_such(self):
+		self.doc.inc('visits')
+		self.doc.push('log', 'arrived')
+		self.doc.add_to_set('tags', 'istar')
+		self.assertEqual(self.doc['visits'], 2)
+		self.assertIn(self.doc, transaction.get()._resources)
+		self.assertEqual(self.doc.diff(),
+		                 {'$inc': {'visits': 1},
+		                  '$push': {'log': {'$each': ['arrived']}},
+		                  '$addToSet': {'tags': {'$each': ['istar']}}})
+		self.assertTrue(self.doc._commutative())
+
+	def test_other_changes_should_need_the_document_locked(self):
+		self.doc.inc('visits')
+		self.doc['name'] = 'Gandalf'
+		self.assertEqual(self.doc.diff(), {'$inc': {'visits': 1},
+		                                   '$set': {'name': 'Gandalf'}})
+		self.assertFalse(self.doc._commutative())
+
+	def test_keys_updated_with_operators_should_be_reloaded_after_commit(self):
+		self.doc.inc('visits')
+		self.doc._saved()
+		self.assertEqual(self.doc.committed,
+		                 {'_id': 1, 'name': 'Saruman', 'log': []})
+		self.assertFalse(self.doc._loaded('visits'))
+		self.assertEqual(self.doc.diff(), {})
+
+	def test_document_should_stay_whole_after_commit(self):
+		self.doc.inc('visits')
+		self.doc._saved()
+		self.assertIsNone(self.doc.fields)
+		self.doc.set({'_id': 1, 'name': 'Gandalf'})
+		self.doc._saved()
+		self.assertTrue(self.doc._loaded('visits'))
+		self.assertEqual(self.doc.committed, {'_id': 1, 'name': 'Gandalf'})
+
+class Operators_EdgeCases(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_operators_on_new_document_should_just_set_values(self):
+		doc = MongoDocument(SessionStub(), colname)
+		doc.inc('visits', 2)
+		doc.push('log', 'arrived')
+		self.assertEqual(doc.diff(), {'visits': 2, 'log': ['arrived']})
+		self.assertFalse(doc._commutative())
+
+	def test_rollback_should_restore_operators(self):
+		doc = MongoDocument(SessionStub(), colname)
+		doc.committed = {'_id': 1, 'visits': 1}
+		doc.uncommitted = doc.committed.copy()
+		doc.inc('visits')
+		savepoint = transaction.savepoint()
+		doc.inc('visits')
+		savepoint.rollback()
+		self.assertEqual(doc.diff(), {'$inc': {'visits': 1}})
+
+class Retrieve_GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		self.session = QueryingSessionStub(
+		    [{'_id': 1, 'name': 'Saruman'},
+		     {'_id': 2, 'name': 'Gandalf'},
+		     {'_id': 3, 'name': 'Gandalf'}])
+		self.calls = self.session.db[colname].calls
+
+	def test_retrieve_should_fetch_at_most_two_matches_in_one_query(self):
+		doc = MongoDocument(self.session, colname,
+		                    retrieve={'name': 'Saruman'})
+		self.assertEqual(doc.committed['_id'], 1)
+		self.assertEqual(self.calls, [('find', {'name': 'Saruman'}),
+		                              ('limit', 2)])
+
+	def test_retrieve_by_id_should_use_find_one(self):
+		doc = MongoDocument(self.session, colname, retrieve={'_id': 2})
+		self.assertEqual(doc.committed['_id'], 2)
+		self.assertEqual(self.calls, [('find_one', {'_id': 2})])
+
+	def test_load_many_should_use_one_query(self):
+		docs = MongoDocument.load_many(self.session, colname,
+		                               [{'_id': 2}, {'_id': 1}])
+		self.assertEqual([doc['_id'] for doc in docs], [2, 1])
+		self.assertEqual(self.calls, [('find', {'_id': {'$in': [2, 1]}})])
+
+	def test_load_many_should_return_one_instance_per_document(self):
+		docs = MongoDocument.load_many(self.session, colname,
+		                               [{'name': 'Saruman'},
+		                                {'_id': 1, 'name': 'Saruman'}])
+		self.assertIs(docs[0], docs[1])
+		self.assertEqual(len(self.calls), 1)
+		self.assertIn('$or', self.calls[0][1])
+
+class Find_GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		self.session = QueryingSessionStub(
+		    [{'_id': 1, 'name': 'Saruman', 'profession': 'wizard'},
+		     {'_id': 2, 'name': 'Gandalf', 'profession': 'wizard'}])
+		self.calls = self.session.db[colname].calls
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_find_should_query_only_when_iterated(self):
+		docs = MongoDocument.find(self.session, colname, batch_size=100)
+		self.assertEqual(self.calls, [])
+		self.assertEqual([doc['name'] for doc in docs], ['Saruman', 'Gandalf'])
+		self.assertEqual(self.calls, [('find', None), ('batch_size', 100)])
+
+	def test_found_documents_should_join_transaction_only_when_changed(self):
+		docs = list(MongoDocument.find(self.session, colname))
+		self.assertEqual(transaction.get()._resources, [])
+		docs[1]['profession'] = 'istar'
+		self.assertEqual(transaction.get()._resources, [docs[1]])
+
+	def test_partial_document_should_only_be_compared_on_loaded_keys(self):
+		doc = MongoDocument.find(self.session, colname, {'name': 'Gandalf'},
+		                         projection=['name']).next()
+		self.assertEqual(self.calls[0][2], {'name': 1})
+		self.assertEqual(doc.committed, {'_id': 2, 'name': 'Gandalf'})
+		doc['color'] = 'grey'
+		self.assertEqual(doc.diff(), {'$set': {'color': 'grey'}})
+		dbcommitted = dict(self.session.db[colname].docs[1], color='grey')
+		self.assertEqual(_project(dbcommitted, doc.fields),
+		                 {'_id': 2, 'name': 'Gandalf'})
+		doc._saved()
+		self.assertEqual(_project(dbcommitted, doc.fields), doc.committed)
+
+	def test_projection_should_tell_which_keys_are_loaded(self):
+		self.assertTrue(_included({'name': 1}, 'name'))
+		self.assertFalse(_included({'name': 1}, 'profession'))
+		self.assertTrue(_included({'blob': 0}, 'name'))
+		self.assertFalse(_included({'blob': 0}, 'blob'))
+		self.assertFalse(_included({'_id': 1}, 'name'))
+		self.assertEqual(_include({'blob': 0, 'log': 0}, ['blob']), {'log': 0})
+		self.assertIsNone(_include({'blob': 0}, ['blob']))
+
+class Projection_GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		self.session = QueryingSessionStub(
+		    [{'_id': 1, 'name': 'Saruman', 'biography': 'x' * 100},
+		     {'_id': 2, 'name': 'Gandalf', 'biography': 'y' * 100}])
+		self.calls = self.session.db[colname].calls
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_retrieve_should_load_only_selected_fields(self):
+		doc = MongoDocument(self.session, colname, retrieve={'_id': 1},
+		                    fields=['name'])
+		self.assertEqual(doc.committed, {'_id': 1, 'name': 'Saruman'})
+		self.assertEqual(self.calls, [('find_one', {'_id': 1}, {'name': 1})])
+
+	def test_unloaded_key_should_be_loaded_when_read(self):
+		doc = MongoDocument(self.session, colname, retrieve={'name': 'Saruman'},
+		                    fields={'biography': 0})
+		self.assertNotIn('biography', doc.keys())
+		self.assertEqual(len(doc['biography']), 100)
+		self.assertEqual(self.calls[-1], ('find_one', {'_id': 1},
+		                                  {'biography': 1}))
+		self.assertIsNone(doc.fields)
+		self.assertEqual(doc.diff(), {})
+
+	def test_unloaded_key_should_not_be_loaded_when_set(self):
+		doc = MongoDocument(self.session, colname, retrieve={'_id': 1},
+		                    fields=['name'])
+		doc['biography'] = 'z'
+		self.assertEqual(doc['biography'], 'z')
+		self.assertEqual(len(self.calls), 1)
+		self.assertEqual(doc.diff(), {'$set': {'biography': 'z'}})
+
+	def test_unloaded_key_should_be_unset_when_deleted(self):
+		doc = MongoDocument(self.session, colname, retrieve={'_id': 1},
+		                    fields=['name'])
+		del doc['biography']
+		self.assertEqual(doc.diff(), {'$unset': {'biography': 1}})
+
+	def test_load_many_should_load_keys_needed_to_match_specs(self):
+		docs = MongoDocument.load_many(self.session, colname,
+		                               [{'name': 'Gandalf'}, {'name': 'Saruman'}],
+		                               fields={'biography': 0, 'name': 0})
+		self.assertEqual([doc['name'] for doc in docs], ['Gandalf', 'Saruman'])
+		self.assertEqual(self.calls[0][2], {'biography': 0})
+
+class Projection_BadInput(unittest.TestCase):
+
+	def setUp(self):
+		self.session = QueryingSessionStub([{'_id': 1, 'name': 'Saruman'}])
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_missing_key_should_raise_key_error_once_loaded(self):
+		doc = MongoDocument(self.session, colname, retrieve={'_id': 1},
+		                    fields=['name'])
+		self.assertRaises(KeyError, doc.__getitem__, 'biography')
+		self.assertFalse(doc.has_key('biography'))
+		self.assertEqual(len(self.session.db[colname].calls), 2)
+
+	def test_document_removed_before_key_is_loaded_should_raise_error(self):
+		doc = MongoDocument(self.session, colname, retrieve={'_id': 1},
+		                    fields=['name'])
+		self.session.db[colname].docs = []
+		self.assertRaises(DocumentNotFoundError, doc.__getitem__, 'biography')
+
+class Find_BadInput(unittest.TestCase):
+
+	def setUp(self):
+		self.session = QueryingSessionStub([{'_id': 1, 'name': 'Saruman'}])
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_partial_document_should_not_be_replaced(self):
+		doc = MongoDocument.find(self.session, colname,
+		                         projection={'name': 1}).next()
+		self.assertRaises(PartialDocumentError, doc.set, {'name': 'Saruman'})
+
+	def test_projection_should_select_top_level_keys_and_id(self):
+		for projection in (['staff.color'], {'_id': 0, 'name': 1}):
+			self.assertRaises(PartialDocumentError, list,
+			                  MongoDocument.find(self.session, colname,
+			                                     projection=projection))
+
+class Retrieve_BadInput(unittest.TestCase):
+
+	def test_retrieve_should_raise_error_if_match_not_unique(self):
+		session = QueryingSessionStub([{'_id': 2, 'name': 'Gandalf'},
+		                               {'_id': 3, 'name': 'Gandalf'}])
+		self.assertRaises(DocumentMatchNotUniqueError,
+		                  MongoDocument,
+		                  session, colname, retrieve={'name': 'Gandalf'})
+		self.assertRaises(DocumentMatchNotUniqueError,
+		                  MongoDocument.load_many,
+		                  session, colname, [{'name': 'Gandalf'}])
+
+class References_GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		self.session = QueryingSessionStub(
+		    [{'_id': 1, 'name': 'Saruman'},
+		     {'_id': 2, 'name': 'Gandalf'},
+		     {'_id': 3, 'name': 'Radagast'}])
+		self.calls = self.session.db[colname].calls
+		self.docs = []
+		for i in (1, 2, 3):
+			doc = MongoDocument(self.session, colname)
+			doc.uncommitted['friend'] = DBRef(colname, i)
+			self.docs.append(doc)
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_referenced_document_should_be_loaded_when_first_used(self):
+		friend = self.docs[0]['friend']
+		self.assertIsInstance(friend, DocumentReference)
+		self.assertEqual(self.calls, [])
+		self.assertEqual(friend['name'], 'Saruman')
+		self.assertEqual(friend.committed['_id'], 1)
+		self.assertEqual(self.calls, [('find_one', {'_id': 1})])
+		self.assertIs(self.docs[0]['friend'], friend._doc)
+		self.assertEqual(len(self.calls), 1)
+
+	def test_prefetch_should_load_references_in_one_query(self):
+		prefetch(self.docs, 'friend')
+		self.assertEqual(len(self.calls), 1)
+		self.assertEqual(sorted(self.calls[0][1]['_id']['$in']), [1, 2, 3])
+		names = [doc['friend']['name'] for doc in self.docs]
+		self.assertEqual(names, ['Saruman', 'Gandalf', 'Radagast'])
+		self.assertEqual(len(self.calls), 1)
+
+	def test_prefetched_references_should_not_outlive_transaction(self):
+		prefetch(self.docs, 'friend')
+		transaction.abort()
+		self.assertIsInstance(self.docs[0]['friend'], DocumentReference)
+
+	def test_assigning_a_reference_should_not_load_it(self):
+		doc = MongoDocument(self.session, colname)
+		doc['friend'] = self.docs[1]['friend']
+		self.assertEqual(doc.uncommitted['friend'], DBRef(colname, 2))
+		self.assertEqual(self.calls, [])
+
+	def test_referring_to_new_document_should_give_it_an_id(self):
+		doc = MongoDocument(self.session, colname)
+		newdoc = MongoDocument(self.session, colname)
+		newdoc['name'] = 'Alatar'
+		doc['friend'] = newdoc
+		self.assertEqual(doc.uncommitted['friend'],
+		                 DBRef(colname, newdoc['_id']))
+		self.assertIs(doc['friend'], newdoc)
+
+class Wizard(object):
+	def __init__(self, name):
+		self.name = name
+
+class Decoding_GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		self.doc = MongoDocument(SessionStub(), colname)
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_serialized_values_should_be_decoded_once(self):
+		self.doc['wizard'] = Wizard('Saruman')
+		wizard = self.doc['wizard']
+		self.assertEqual(wizard.name, 'Saruman')
+		self.assertIs(self.doc['wizard'], wizard)
+
+	def test_native_strings_should_not_be_decoded(self):
+		self.doc['name'] = '["Saruman"]'
+		self.assertEqual(self.doc['name'], '["Saruman"]')
+
+	def test_cached_value_should_be_invalidated_on_mutation(self):
+		self.doc['wizard'] = Wizard('Saruman')
+		self.doc['wizard']
+		self.doc['wizard'] = Wizard('Gandalf')
+		self.assertEqual(self.doc['wizard'].name, 'Gandalf')
+		del self.doc['wizard']
+		self.assertRaises(KeyError, self.doc.__getitem__, 'wizard')
+
+	def test_loaded_serialized_values_should_be_decoded(self):
+		self.doc['wizard'] = Wizard('Saruman')
+		self.doc.committed = self.doc.copy() # as if loaded from the db
+		self.doc.uncommitted = self.doc.committed.copy()
+		self.doc._decoded = {}
+		self.assertEqual(self.doc['wizard'].name, 'Saruman')
+
+	def test_loaded_large_integers_should_be_decoded(self):
+		self.doc['big'] = 2**70
+		self.doc['small'] = -2**70
+		self.doc['number'] = '123'
+		self.doc.committed = self.doc.copy() # as if loaded from the db
+		self.doc.uncommitted = self.doc.committed.copy()
+		self.doc._decoded = {}
+		self.assertEqual(self.doc['big'], 2**70)
+		self.assertEqual(self.doc['small'], -2**70)
+		self.assertEqual(self.doc['number'], '123')
+
+	def test_rolled_back_value_should_not_use_stale_cache(self):
+		self.doc['wizard'] = Wizard('Saruman')
+		savepoint = transaction.savepoint()
+		self.doc['wizard'] = 'Gandalf'
+		self.assertEqual(self.doc['wizard'], 'Gandalf')
+		savepoint.rollback()
+		self.assertEqual(self.doc['wizard'].name, 'Saruman')
+
+class Validation_GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		self.doc = MongoDocument(SessionStub(), colname)
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_new_document_should_be_encoded_once_on_vote(self):
+		self.doc['name'] = 'Saruman'
+		self.doc.tpc_vote(transaction.get())
+		self.assertIsInstance(self.doc._encoded, RawBSONDocument)
+		self.assertEqual(self.doc._encoded['name'], 'Saruman')
+		self.assertEqual(self.doc._encoded['_id'], self.doc.uncommitted['_id'])
+		coordinator = TransactionCoordinator(self.doc.session, [])
+		self.assertIs(coordinator._document(self.doc), self.doc._encoded)
+
+	def test_updated_document_should_not_be_encoded(self):
+		self.doc.committed = {'_id': 1, 'name': 'Saruman'}
+		self.doc.uncommitted = self.doc.committed
+		self.doc['profession'] = 'wizard'
+		self.doc._validate()
+		self.assertIsNone(self.doc._encoded)
+
+	def test_encoded_document_should_be_dropped_on_abort(self):
+		self.doc['name'] = 'Saruman'
+		self.doc.tpc_vote(transaction.get())
+		self.doc.abort(transaction.get())
+		self.assertIsNone(self.doc._encoded)
+
+class Validation_BadInput(unittest.TestCase):
+
+	def setUp(self):
+		self.doc = MongoDocument(SessionStub(), colname)
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_incompatible_changed_value_should_raise_error(self):
+		self.doc.committed = {'_id': 1, 'name': 'Saruman'}
+		self.doc.uncommitted = self.doc.committed
+		self.doc.uncommitted['colors'] = set(['white'])
+		self.assertRaises(InvalidDocument, self.doc._validate)
+
+	def test_invalid_key_should_raise_error(self):
+		self.doc['name'] = 'Saruman'
+		self.doc.uncommitted[1] = 'wizard'
+		self.assertRaises(Exception, self.doc.tpc_vote, transaction.get())
+
+	def test_updated_path_key_should_raise_error(self):
+		self.doc.committed = {'_id': 1, 'name': 'Saruman'}
+		self.doc.abort(None)
+		self.doc['staff.color'] = 'white'
+		self.assertRaisesRegexp(Exception, 'Invalid key', self.doc._validate)
+		self.doc.abort(None)
+		self.doc['$color'] = 'white'
+		self.assertRaisesRegexp(Exception, 'Invalid key', self.doc._validate)
 
 class NonTransactional_GoodInput(unittest.TestCase):
 	pass
@@ -0,0 +1,71 @@
+""" Unit tests """
+
+import unittest
+import transaction
+from identitymap import IdentityMap
+
+colname = 'test_collection'
+
+class CollectionStub(object):
+	name = colname
+
+class DocumentStub(object):
+	collection = CollectionStub()
+
+	def __init__(self, _id):
+		self.doc_id = str(_id)
+
+class GoodInput(unittest.TestCase):
+
+	def test_should_return_added_document(self):
+		identity_map = IdentityMap()
+		doc = DocumentStub(1)
+		identity_map.add(doc)
+		self.assertIs(identity_map.get(colname, 1, DocumentStub), doc)
+		self.assertIsNone(identity_map.get(colname, 2, DocumentStub))
+		self.assertIsNone(identity_map.get('other_collection', 1, DocumentStub))
+		self.assertEqual((identity_map.hits, identity_map.misses), (1, 2))
+
+	def test_should_only_return_instances_of_the_given_class(self):
+		identity_map = IdentityMap()
+		doc = DocumentStub(1)
+		identity_map.add(doc)
+		self.assertIsNone(identity_map.get(colname, 1, object))
+		self.assertIs(identity_map.get(colname, 1, DocumentStub), doc)
+
+	def test_should_evict_least_recently_used_documents(self):
+		identity_map = IdentityMap(2)
+		docs = [DocumentStub(i) for i in range(3)]
+		identity_map.add(docs[0])
+		identity_map.add(docs[1])
+		identity_map.get(colname, 0, DocumentStub)
+		identity_map.add(docs[2])
+		self.assertEqual(len(identity_map), 2)
+		self.assertEqual(identity_map.evictions, 1)
+		self.assertIs(identity_map.get(colname, 0, DocumentStub), docs[0])
+		self.assertIsNone(identity_map.get(colname, 1, DocumentStub))
+
+	def test_should_discard_only_the_instance_held(self):
+		identity_map = IdentityMap()
+		doc = DocumentStub(1)
+		identity_map.add(doc)
+		identity_map.discard(DocumentStub(1))
+		self.assertIs(identity_map.get(colname, 1, DocumentStub), doc)
+		identity_map.discard(doc)
+		self.assertIsNone(identity_map.get(colname, 1, DocumentStub))
+
+	def test_should_be_unbounded_without_size(self):
+		identity_map = IdentityMap(None)
+		for i in range(100):
+			identity_map.add(DocumentStub(i))
+		self.assertEqual(len(identity_map), 100)
+
+	def test_should_only_hold_documents_of_current_transaction(self):
+		identity_map = IdentityMap()
+		identity_map.scope(transaction.get())
+		identity_map.add(DocumentStub(1))
+		identity_map.scope(transaction.get())
+		self.assertEqual(len(identity_map), 1)
+		transaction.abort()
+		identity_map.scope(transaction.get())
+		self.assertEqual(len(identity_map), 0)
@@ -0,0 +1,59 @@
+""" Unit tests """
+
+import unittest
+import instrumentation
+from instrumentation import Histogram, Metrics
+
+class SessionStub(object):
+	pass
+
+class GoodInput(unittest.TestCase):
+
+	def test_histogram_should_summarize_values(self):
+		histogram = Histogram()
+		for value in (0.001, 0.002, 0.003, 0.1):
+			histogram.add(value)
+		self.assertEqual(histogram.count, 4)
+		self.assertAlmostEqual(histogram.mean(), 0.0265)
+		self.assertEqual((histogram.min, histogram.max), (0.001, 0.1))
+		self.assertTrue(0.003 <= histogram.percentile(75) < 0.006)
+		self.assertEqual(histogram.percentile(100), 0.1)
+
+	def test_metrics_should_be_tagged(self):
+		metrics = Metrics()
+		metrics.count('round_trips', 1, 'wizards', 'Wizard')
+		metrics.count('round_trips', 2, 'hobbits', 'Hobbit')
+		with metrics.timed('tpc_vote', 'wizards'):
+			pass
+		self.assertEqual(metrics.total('round_trips'), 3)
+		self.assertEqual(metrics.total('round_trips', 'hobbits'), 2)
+		self.assertEqual(metrics.total('round_trips', kind='Wizard'), 1)
+		self.assertEqual(metrics.histogram('tpc_vote', 'wizards').count, 1)
+
+	def test_capture_should_install_metrics_for_block(self):
+		session = SessionStub()
+		with instrumentation.capture(session) as metrics:
+			instrumentation.get(session).count('conflicts', 1, 'wizards')
+		self.assertEqual(metrics.total('conflicts'), 1)
+		self.assertIs(instrumentation.get(session), instrumentation.null)
+
+class EdgeCases(unittest.TestCase):
+
+	def test_default_should_discard_measurements(self):
+		measure = instrumentation.get(SessionStub())
+		with measure.timed('tpc_begin'):
+			measure.count('round_trips')
+		self.assertIs(measure, instrumentation.null)
+
+	def test_empty_histogram_should_have_no_statistics(self):
+		histogram = Metrics().histogram('tpc_finish')
+		self.assertEqual(histogram.count, 0)
+		self.assertIsNone(histogram.mean())
+		self.assertIsNone(histogram.percentile(99))
+
+	def test_zero_values_should_be_counted(self):
+		histogram = Histogram()
+		histogram.add(0)
+		histogram.add(4)
+		self.assertEqual(histogram.percentile(50), 0)
+		self.assertEqual(histogram.percentile(100), 4)
@@ -2,6 +2,8 @@
 TODO: mirror datamanager functional tests
 """
 import unittest
+import transaction
+from datamanager import MongoDocument
 from orm import MongoObject
 from mongomorphism.exceptions import ORMValidationError
 from config import Session
@@ -21,7 +23,21 @@ class Transactional_BadInput(unittest.TestCase):
 	pass
 
 class Transactional_EdgeCases(unittest.TestCase):
-	pass
+
+	def tearDown(self):
+		transaction.abort()
+		conn = MongoClient()
+		conn.drop_database(dbname)
+
+	def test_identity_map_should_not_return_plain_document_for_object(self):
+		session = Session(dbname, identity_map=True)
+		_id = MongoClient()[dbname][colname].insert({'field1': 'something'})
+		doc = MongoDocument(session, colname, retrieve={'_id': _id})
+		obj = Sample(session, retrieve={'_id': _id})
+		self.assertIsInstance(obj, Sample)
+		self.assertIs(Sample(session, retrieve={'_id': _id}), obj)
+		self.assertIs(MongoDocument(session, colname,
+		                            retrieve={'_id': _id}), doc)
 
 class NonTransactional_GoodInput(unittest.TestCase):
 
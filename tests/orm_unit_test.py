@@ -11,6 +11,20 @@ class Sample(MongoObject):
 	__collection__ = colname
 	__requiredfields__ = ('field1', 'field2')
 
+class Typed(MongoObject):
+	__collection__ = colname
+	__requiredfields__ = ('name',)
+	__fields__ = {'name': basestring, 'age': (int, long)}
+	__defaults__ = {'age': 0, 'friends': list}
+
+class TypedSubclass(Typed):
+	__fields__ = {'color': basestring}
+
+class Compact(MongoObject):
+	__slots__ = ()
+	__collection__ = colname
+	__defaults__ = {'age': 0}
+
 class SessionStub(object):
 	db = {colname: None}
 	transactional = True
@@ -31,8 +45,57 @@ class GoodInput(unittest.TestCase):
 		obj['field2'] = 'something else'
 		self.assertIsNone(obj.validate()) # no exception should be raised here
 
+	def test_validation_should_skip_fields_not_loaded(self):
+		session = SessionStub()
+		session.transactional = False
+		obj = Sample(session)
+		obj._load({'_id': 1, 'field1': 'something'}, {'field1': 1})
+		self.assertIsNone(obj.validate())
+
+	def test_defaults_should_be_set_on_new_objects(self):
+		obj = Typed(SessionStub())
+		obj2 = Typed(SessionStub())
+		self.assertEqual(obj.copy(), {'age': 0, 'friends': []})
+		self.assertIsNot(obj['friends'], obj2['friends'])
+		self.assertNotIn(obj, transaction.get()._resources)
+
+	def test_update_should_only_check_changed_fields(self):
+		session = SessionStub()
+		session.transactional = False
+		obj = Typed(session)
+		obj._load({'_id': 1, 'name': 'Saruman', 'age': 'unknown'})
+		obj['color'] = 'white'
+		self.assertIsNone(obj.validate())
+
+	def test_fields_should_be_inherited(self):
+		obj = TypedSubclass(SessionStub())
+		obj['name'] = 'Saruman'
+		obj['age'] = 100
+		obj['color'] = 'white'
+		self.assertIsNone(obj.validate())
+
+	def test_subclass_with_empty_slots_should_have_no_instance_dict(self):
+		obj = Compact(SessionStub())
+		self.assertFalse(hasattr(obj, '__dict__'))
+		self.assertEqual(obj['age'], 0)
+
 class BadInput(unittest.TestCase):
 
+	def test_validation_should_fail_on_value_of_wrong_type(self):
+		obj = TypedSubclass(SessionStub())
+		obj['name'] = 'Saruman'
+		obj['color'] = 0xffffff
+		self.assertRaises(ORMValidationError, obj.validate)
+		obj['color'] = 'white'
+		obj['age'] = 'old'
+		self.assertRaises(ORMValidationError, obj.validate)
+
+	def test_validation_should_fail_on_invalid_key(self):
+		obj = Typed(SessionStub())
+		obj['name'] = 'Saruman'
+		obj[1] = 'one'
+		self.assertRaises(Exception, obj.validate)
+
 	def tearDown(self):
 		transaction.abort()
 
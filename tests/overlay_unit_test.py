@@ -0,0 +1,143 @@
+""" Unit tests """
+
+import unittest
+from overlay import DocumentOverlay
+from mongomorphism.exceptions import MergeConflictError
+
+class GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		self.base = {'name': 'Saruman', 'profession': 'wizard'}
+		self.overlay = DocumentOverlay(self.base)
+
+	def test_should_read_through_to_base(self):
+		self.assertEqual(self.overlay['name'], 'Saruman')
+		self.assertEqual(self.overlay, self.base)
+		self.assertEqual(len(self.overlay), 2)
+
+	def test_changes_should_not_modify_base(self):
+		self.overlay['name'] = 'Gandalf'
+		self.overlay['color'] = 'grey'
+		del self.overlay['profession']
+		self.assertEqual(self.overlay, {'name': 'Gandalf', 'color': 'grey'})
+		self.assertEqual(self.base, {'name': 'Saruman', 'profession': 'wizard'})
+		self.assertEqual(len(self.overlay), 2)
+		self.assertFalse(self.overlay.has_key('profession'))
+		self.assertEqual(sorted(self.overlay.keys()), ['color', 'name'])
+
+	def test_changes_should_only_record_changed_keys(self):
+		self.overlay['color'] = 'grey'
+		del self.overlay['color']
+		del self.overlay['profession']
+		self.assertEqual(self.overlay.changes, {})
+		self.assertEqual(self.overlay.deleted, set(['profession']))
+
+	def test_snapshot_should_be_independent(self):
+		self.overlay['name'] = 'Gandalf'
+		snapshot = self.overlay.snapshot()
+		self.overlay['name'] = 'Radagast'
+		del self.overlay['profession']
+		self.assertEqual(snapshot, {'name': 'Gandalf', 'profession': 'wizard'})
+		self.assertIs(snapshot.base, self.base)
+
+	def test_commit_should_fold_changes_into_base(self):
+		self.overlay['name'] = 'Gandalf'
+		del self.overlay['profession']
+		self.assertIs(self.overlay.commit(), self.base)
+		self.assertEqual(self.base, {'name': 'Gandalf'})
+
+	def test_operators_should_be_applied_and_combined(self):
+		self.overlay.apply('$inc', 'visits', 2)
+		self.overlay.apply('$inc', 'visits', 3)
+		self.overlay.apply('$push', 'log', 'arrived')
+		self.overlay.apply('$push', 'log', 'arrived')
+		self.overlay.apply('$addToSet', 'tags', 'istar')
+		self.overlay.apply('$addToSet', 'tags', 'istar')
+		self.assertEqual(self.overlay['visits'], 5)
+		self.assertEqual(self.overlay['log'], ['arrived', 'arrived'])
+		self.assertEqual(self.overlay['tags'], ['istar'])
+		self.assertEqual(self.overlay.operators,
+		                 {'visits': ('$inc', 5),
+		                  'log': ('$push', ['arrived', 'arrived']),
+		                  'tags': ('$addToSet', ['istar'])})
+
+	def test_assignment_should_replace_operator(self):
+		self.overlay.apply('$inc', 'visits', 1)
+		snapshot = self.overlay.snapshot()
+		self.overlay['visits'] = 10
+		self.overlay.apply('$inc', 'visits', 1)
+		self.assertEqual(self.overlay['visits'], 11)
+		self.assertEqual(self.overlay.operators, {})
+		self.assertEqual(snapshot.operators, {'visits': ('$inc', 1)})
+
+	def test_merge_should_combine_changes_to_different_keys(self):
+		other = DocumentOverlay(dict(self.base))
+		self.overlay['color'] = 'white'
+		self.overlay.apply('$inc', 'visits', 1)
+		other['age'] = 1000
+		other.apply('$inc', 'visits', 2)
+		del other['profession']
+		self.overlay.merge(other)
+		self.assertEqual(self.overlay.copy(), {'name': 'Saruman',
+		                                       'color': 'white', 'age': 1000,
+		                                       'visits': 3})
+		self.assertEqual(self.overlay.operators, {'visits': ('$inc', 3)})
+
+class BadInput(unittest.TestCase):
+
+	def test_unsupported_operator_should_raise_error(self):
+		overlay = DocumentOverlay({'name': 'Saruman'})
+		self.assertRaises(ValueError, overlay.apply, '$mul', 'visits', 2)
+
+	def test_appending_to_non_list_should_raise_error(self):
+		overlay = DocumentOverlay({'name': 'Saruman'})
+		self.assertRaises(TypeError, overlay.apply, '$push', 'name', 'the White')
+
+	def test_deleting_missing_key_should_raise_error(self):
+		overlay = DocumentOverlay({'name': 'Saruman'})
+		del overlay['name']
+		self.assertRaises(KeyError, overlay.__delitem__, 'name')
+		self.assertRaises(KeyError, overlay.__getitem__, 'name')
+
+	def test_merging_conflicting_changes_should_raise_error(self):
+		overlay = DocumentOverlay({'name': 'Saruman', 'visits': 1})
+		overlay['name'] = 'Saruman the White'
+		other = DocumentOverlay({'name': 'Saruman', 'visits': 1})
+		other['name'] = 'Saruman of Many Colours'
+		self.assertRaises(MergeConflictError, overlay.merge, other)
+		overlay.apply('$inc', 'visits', 1)
+		other = DocumentOverlay({'name': 'Saruman', 'visits': 1})
+		other['visits'] = 5
+		self.assertRaises(MergeConflictError, overlay.merge, other)
+
+class EdgeCases(unittest.TestCase):
+
+	def test_different_operators_on_a_key_should_not_be_recorded(self):
+		overlay = DocumentOverlay({'log': []})
+		overlay.apply('$push', 'log', 'arrived')
+		overlay.apply('$addToSet', 'log', 'left')
+		self.assertEqual(overlay['log'], ['arrived', 'left'])
+		self.assertEqual(overlay.operators, {})
+		self.assertEqual(overlay.changes, {'log': ['arrived', 'left']})
+
+	def test_operators_on_replaced_document_should_not_be_recorded(self):
+		overlay = DocumentOverlay({'visits': 1}, replaced=True)
+		overlay.apply('$inc', 'visits', 1)
+		self.assertEqual(overlay['visits'], 2)
+		self.assertEqual(overlay.operators, {})
+
+	def test_unchanged_overlays_should_share_their_layer(self):
+		overlay, other = DocumentOverlay({}), DocumentOverlay({})
+		self.assertTrue(overlay.changes is other.changes)
+		snapshot = overlay.snapshot()
+		overlay['name'] = 'Saruman'
+		overlay.apply('$inc', 'visits', 1)
+		del overlay['name']
+		self.assertEqual(other.changes, {})
+		self.assertEqual(other.operators, {})
+		self.assertEqual(snapshot.changes, {})
+		self.assertEqual(overlay.changes, {'visits': 1})
+
+	def test_should_not_equal_non_mappings(self):
+		self.assertNotEqual(DocumentOverlay({}), None)
+		self.assertFalse(DocumentOverlay({}) == None)
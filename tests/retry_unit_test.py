@@ -0,0 +1,76 @@
+""" Unit tests """
+
+import unittest
+from transaction.interfaces import TransientError
+from mongomorphism.exceptions import ConcurrentModificationError
+import retry
+
+class Work(object):
+	""" Unit of work that conflicts a given number of times """
+
+	def __init__(self, conflicts, collection='wizards'):
+		self.conflicts = conflicts
+		self.collection = collection
+		self.calls = 0
+
+	def __call__(self):
+		self.calls += 1
+		if self.calls <= self.conflicts:
+			raise ConcurrentModificationError('conflict', self.collection)
+		return 'done'
+
+class GoodInput(unittest.TestCase):
+
+	def test_should_retry_until_work_succeeds(self):
+		stats = retry.ConflictStats()
+		work = Work(2)
+		self.assertEqual(retry.run(work, attempts=3, backoff=0, stats=stats),
+		                 'done')
+		self.assertEqual(work.calls, 3)
+		self.assertEqual(stats.conflicts, {'wizards': 2})
+		self.assertEqual(stats.retries, {'wizards': 2})
+		self.assertEqual(stats.failures, 0)
+
+	def test_decorator_should_pass_arguments(self):
+		calls = []
+		@retry.retrying(backoff=0)
+		def work(name, profession=None):
+			calls.append((name, profession))
+			if len(calls) < 2:
+				raise TransientError('conflict')
+		work('Saruman', profession='wizard')
+		self.assertEqual(calls, [('Saruman', 'wizard')] * 2)
+
+	def test_backoff_should_grow_up_to_bound(self):
+		for attempt in range(1, 10):
+			delay = retry.backoff_delay(attempt, 0.01, 0.05)
+			self.assertTrue(0 <= delay <= min(0.05, 0.01 * 2 ** (attempt - 1)))
+
+class BadInput(unittest.TestCase):
+
+	def test_should_give_up_after_last_attempt(self):
+		stats = retry.ConflictStats()
+		work = Work(5)
+		self.assertRaises(ConcurrentModificationError,
+		                  retry.run, work, attempts=3, backoff=0, stats=stats)
+		self.assertEqual(work.calls, 3)
+		self.assertEqual(stats.conflicts, {'wizards': 3})
+		self.assertEqual(stats.retries, {'wizards': 2})
+		self.assertEqual(stats.failures, 1)
+
+	def test_other_errors_should_not_be_retried(self):
+		def work():
+			raise KeyError('name')
+		self.assertRaises(KeyError, retry.run, work, backoff=0)
+
+class EdgeCases(unittest.TestCase):
+
+	def test_conflicts_without_collection_should_be_counted(self):
+		stats = retry.ConflictStats()
+		calls = []
+		def work():
+			calls.append(1)
+			if len(calls) == 1:
+				raise TransientError('conflict')
+		retry.run(work, backoff=0, stats=stats)
+		self.assertEqual(stats.conflicts, {None: 1})
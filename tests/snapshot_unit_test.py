@@ -0,0 +1,126 @@
+""" Unit tests """
+
+import unittest
+import jsonpickle
+from bson.dbref import DBRef
+from snapshot import MongoSnapshot
+from mongomorphism.exceptions import (
+		PartialDocumentError,
+		ReadOnlyDocumentError,
+		)
+import transaction
+
+colname = 'test_collection'
+
+class Wizard(object):
+	def __init__(self, name):
+		self.name = name
+
+class CollectionStub(object):
+	name = colname
+
+	def __init__(self, docs):
+		self.docs = docs
+		self.calls = []
+
+	def find_one(self, spec, projection=None):
+		self.calls.append(('find_one', spec, projection))
+		for doc in self.docs:
+			if doc['_id'] == spec['_id']:
+				if projection is not None:
+					return dict((key, value) for key, value in doc.items()
+					            if key == '_id' or projection.get(key))
+				return doc
+
+	def find(self, spec, projection=None):
+		self.calls.append(('find', spec, projection))
+		return iter(self.docs)
+
+class SessionStub(object):
+	transactional = True
+	active = True
+
+	def __init__(self, docs):
+		self.db = {colname: CollectionStub(docs)}
+
+class GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		self.session = SessionStub(
+		    [{'_id': 1, 'name': 'Saruman',
+		      'wizard': jsonpickle.encode(Wizard('Saruman')),
+		      'friend': DBRef(colname, 2)},
+		     {'_id': 2, 'name': 'Gandalf'}])
+		self.calls = self.session.db[colname].calls
+
+	def test_snapshot_should_read_like_a_document(self):
+		snapshot = MongoSnapshot(self.session, colname, {'_id': 1})
+		self.assertEqual(snapshot['name'], 'Saruman')
+		self.assertEqual(sorted(snapshot.keys()),
+		                 ['_id', 'friend', 'name', 'wizard'])
+		self.assertTrue(snapshot.has_key('name'))
+		self.assertIsNone(snapshot.get('color'))
+		self.assertEqual(len(snapshot), 4)
+
+	def test_values_should_be_decoded_once_when_read(self):
+		snapshot = MongoSnapshot(self.session, colname, {'_id': 1})
+		self.assertIsNone(snapshot._decoded)
+		wizard = snapshot['wizard']
+		self.assertEqual(wizard.name, 'Saruman')
+		self.assertIs(snapshot['wizard'], wizard)
+
+	def test_references_should_be_loaded_as_snapshots(self):
+		snapshot = MongoSnapshot(self.session, colname, {'_id': 1})
+		friend = snapshot['friend']
+		self.assertIsInstance(friend, MongoSnapshot)
+		self.assertEqual(friend['name'], 'Gandalf')
+		self.assertIs(snapshot['friend'], friend)
+		self.assertEqual(len(self.calls), 2)
+
+	def test_find_should_yield_snapshots(self):
+		names = [snapshot['name'] for snapshot in
+		         MongoSnapshot.find(self.session, colname)]
+		self.assertEqual(names, ['Saruman', 'Gandalf'])
+
+	def test_snapshot_should_be_compact(self):
+		snapshot = MongoSnapshot(self.session, colname, {'_id': 2})
+		self.assertFalse(hasattr(snapshot, '__dict__'))
+
+class BadInput(unittest.TestCase):
+
+	def setUp(self):
+		self.session = SessionStub([{'_id': 1, 'name': 'Saruman',
+		                             'profession': 'wizard'}])
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_changes_should_raise_error(self):
+		snapshot = MongoSnapshot(self.session, colname, {'_id': 1})
+		self.assertRaises(ReadOnlyDocumentError,
+		                  snapshot.__setitem__, 'name', 'Gandalf')
+		self.assertRaises(ReadOnlyDocumentError,
+		                  snapshot.__delitem__, 'name')
+		self.assertRaises(ReadOnlyDocumentError, snapshot.inc, 'visits')
+		self.assertRaises(ReadOnlyDocumentError, snapshot.delete)
+		self.assertEqual(snapshot['name'], 'Saruman')
+		self.assertEqual(transaction.get()._resources, [])
+
+	def test_keys_not_loaded_should_raise_error(self):
+		snapshot = MongoSnapshot(self.session, colname, {'_id': 1},
+		                         fields=['name'])
+		self.assertRaises(PartialDocumentError,
+		                  snapshot.__getitem__, 'profession')
+		snapshot = MongoSnapshot(self.session, colname, {'_id': 1},
+		                         fields={'profession': 0})
+		self.assertRaises(KeyError, snapshot.__getitem__, 'color')
+
+class EdgeCases(unittest.TestCase):
+
+	def test_values_should_be_decoded_like_documents(self):
+		session = SessionStub([{'_id': 1, 'age': jsonpickle.encode(2**70),
+		                        'code': '123', 'note': '{not json'}])
+		snapshot = MongoSnapshot(session, colname, {'_id': 1})
+		self.assertEqual(snapshot['age'], 2**70)
+		self.assertEqual(snapshot['code'], '123')
+		self.assertEqual(snapshot['note'], '{not json')
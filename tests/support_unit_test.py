@@ -0,0 +1,98 @@
+""" Unit tests """
+
+import unittest
+from datamanager import MongoDocument
+import support
+import transaction
+
+colname = 'test_collection'
+
+class CollectionStub(object):
+	name = colname
+
+class SessionStub(object):
+	db = {colname: CollectionStub()}
+	transactional = True
+	active = True
+
+def make_doc(_id=None):
+	doc = MongoDocument(SessionStub(), colname)
+	if _id is not None:
+		doc.committed = {'_id': _id}
+		doc.abort(None)
+	return doc
+
+class Registry_GoodInput(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_documents_should_be_registered_when_joining(self):
+		doc = make_doc(1)
+		doc['name'] = 'Saruman'
+		doc['profession'] = 'wizard'
+		registry = support.get_registry(transaction.get())
+		self.assertIn(doc, registry)
+		self.assertEqual(registry.datamanagers, [doc])
+		self.assertEqual(transaction.get()._resources, [doc])
+
+	def test_live_documents_should_be_found_by_collection_and_id(self):
+		doc = make_doc(1)
+		doc['name'] = 'Saruman'
+		registry = support.get_registry(transaction.get())
+		self.assertIs(registry.lookup(colname, 1), doc)
+		self.assertIsNone(registry.lookup(colname, 2))
+		self.assertIsNone(registry.lookup('other_collection', 1))
+
+	def test_registry_should_be_per_transaction(self):
+		doc = make_doc(1)
+		doc['name'] = 'Saruman'
+		registry = support.get_registry(transaction.get())
+		transaction.abort()
+		self.assertIsNot(support.get_registry(transaction.get()), registry)
+		self.assertNotIn(doc, support.get_registry(transaction.get()))
+
+	def test_dereferencing_live_document_should_return_its_data_manager(self):
+		doc = make_doc(1)
+		doc2 = make_doc(2)
+		doc2['name'] = 'Gandalf'
+		doc['friend'] = doc2
+		self.assertIs(doc['friend'], doc2)
+
+class Registry_BadInput(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_duplicate_data_managers_should_be_recorded(self):
+		doc = make_doc(1)
+		doc2 = make_doc(1)
+		doc['name'] = 'Saruman'
+		self.assertEqual(support.get_registry(transaction.get()).duplicates,
+		                 [])
+		doc2['name'] = 'Gandalf'
+		self.assertEqual(support.get_registry(transaction.get()).duplicates,
+		                 [(colname, '1')])
+
+	def test_duplicates_should_be_found_by_session(self):
+		doc = make_doc(1)
+		doc2 = make_doc(1)
+		doc3 = make_doc(2)
+		doc['name'] = 'Saruman'
+		doc2['name'] = 'Gandalf'
+		doc3['name'] = 'Radagast'
+		registry = support.get_registry(transaction.get())
+		self.assertEqual(registry.duplicated(doc2.session), [(colname, '1')])
+		self.assertEqual(registry.duplicated(doc3.session), [])
+
+class Registry_EdgeCases(unittest.TestCase):
+
+	def tearDown(self):
+		transaction.abort()
+
+	def test_new_documents_should_only_be_registered_by_identity(self):
+		doc = make_doc()
+		doc['name'] = 'Saruman'
+		registry = support.get_registry(transaction.get())
+		self.assertIn(doc, registry)
+		self.assertEqual(registry.documents, {})
@@ -0,0 +1,45 @@
+""" Unit tests """
+
+import unittest
+from threadpools import ThreadPoolRegistry
+
+class PoolStub(object):
+	def __init__(self, size):
+		self.size = size
+		self.terminated = False
+
+	def terminate(self):
+		self.terminated = True
+
+class GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		self.registry = ThreadPoolRegistry(PoolStub)
+
+	def test_same_size_should_share_pool(self):
+		pool = self.registry.get(4)
+		self.assertIs(self.registry.get(4), pool)
+		self.assertEqual(pool.size, 4)
+		self.assertEqual(len(self.registry), 1)
+
+	def test_different_sizes_should_not_share_pool(self):
+		pool = self.registry.get(4)
+		self.assertIsNot(self.registry.get(2), pool)
+		self.assertEqual(len(self.registry), 2)
+
+	def test_shutdown_should_terminate_pools(self):
+		pool = self.registry.get(4)
+		self.registry.shutdown()
+		self.assertTrue(pool.terminated)
+		self.assertEqual(len(self.registry), 0)
+		self.assertIsNot(self.registry.get(4), pool)
+
+class EdgeCases(unittest.TestCase):
+
+	def test_pools_should_not_be_shared_after_fork(self):
+		registry = ThreadPoolRegistry(PoolStub)
+		pool = registry.get(4)
+		registry.pid = -1 # as if the registry had been inherited on fork
+		self.assertIsNot(registry.get(4), pool)
+		self.assertFalse(pool.terminated)
+		self.assertEqual(len(registry), 1)
@@ -0,0 +1,104 @@
+import datetime
+import unittest
+from datamanager import MongoDocument
+from config import Session
+from coordinator import TransactionCoordinator
+from mongomorphism.exceptions import ConcurrentModificationError
+from pymongo import MongoClient
+from pymongo.errors import AutoReconnect
+import transaction
+import txnlog
+
+dbname = '_test_db'
+colname = '_test_col'
+
+class GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		txnlog._indexed.clear()
+		self.session = Session(dbname)
+		self.doc = MongoDocument(self.session, colname)
+
+	def tearDown(self):
+		transaction.abort()
+		conn = MongoClient()
+		conn.drop_database(dbname)
+
+	def test_transactions_should_be_indexed_on_first_commit(self):
+		self.assertEqual(self.session.db.transactions.index_information(), {})
+		self.doc['name'] = 'Saruman'
+		transaction.commit()
+		indexes = self.session.db.transactions.index_information()
+		keys = [index['key'] for index in indexes.values()]
+		self.assertIn([('tid', 1)], keys)
+		self.assertIn([('state', 1), ('date_modified', 1)], keys)
+		self.assertIn([('date_finished', 1)], keys)
+
+	def test_finished_transaction_should_be_recorded(self):
+		self.doc['name'] = 'Saruman'
+		transaction.commit()
+		record = self.session.db.transactions.find_one()
+		self.assertEqual(record['state'], 'done')
+		self.assertEqual(record['collections'], [colname])
+		self.assertIn('date_finished', record)
+
+	def test_sweep_should_release_locks_of_abandoned_transactions(self):
+		self.doc['name'] = 'Saruman'
+		transaction.commit()
+		db = self.session.db
+		an_hour_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+		db.transactions.insert({'tid': 'abandoned', 'state': 'pending',
+		                        'collections': [colname],
+		                        'date_created': an_hour_ago,
+		                        'date_modified': an_hour_ago})
+		db[colname].update({'name': 'Saruman'},
+		                   {'$push': {'pending_transactions': 'abandoned'}})
+		self.assertEqual(txnlog.sweep(db), ['abandoned'])
+		self.assertNotIn('pending_transactions',
+		                 db[colname].find_one({'name': 'Saruman'}))
+		self.assertEqual(db.transactions.find_one({'tid': 'abandoned'})['state'],
+		                 'failed')
+		# the document can be written again
+		self.doc['profession'] = 'wizard'
+		transaction.commit()
+		self.assertEqual(db[colname].find_one()['profession'], 'wizard')
+
+	def test_transaction_failing_to_release_documents_should_be_swept(self):
+		self.doc['name'] = 'Saruman'
+		transaction.commit()
+		db = self.session.db
+		self.doc['profession'] = 'wizard'
+		db[colname].update({'name': 'Saruman'}, {'$set': {'color': 'white'}})
+		def _abort(self, group):
+			raise AutoReconnect('connection reset')
+		release = TransactionCoordinator._abort
+		TransactionCoordinator._abort = _abort
+		try:
+			self.assertRaises(ConcurrentModificationError, transaction.commit)
+		finally:
+			TransactionCoordinator._abort = release
+		transaction.abort()
+		locked = db[colname].find_one({'name': 'Saruman'})
+		record = db.transactions.find_one({'state': 'pending'})
+		self.assertEqual(locked['pending_transactions'], [record['tid']])
+		self.assertEqual(txnlog.sweep(db, older_than=datetime.timedelta(0)),
+		                 [record['tid']])
+		self.assertNotIn('pending_transactions',
+		                 db[colname].find_one({'name': 'Saruman'}))
+
+class EdgeCases(unittest.TestCase):
+
+	def setUp(self):
+		self.session = Session(dbname)
+
+	def tearDown(self):
+		conn = MongoClient()
+		conn.drop_database(dbname)
+
+	def test_sweep_should_leave_recent_transactions_alone(self):
+		db = self.session.db
+		db.transactions.insert({'tid': 'committing', 'state': 'pending',
+		                        'collections': [colname],
+		                        'date_created': datetime.datetime.utcnow(),
+		                        'date_modified': datetime.datetime.utcnow()})
+		self.assertEqual(txnlog.sweep(db), [])
@@ -0,0 +1,69 @@
+""" Unit tests """
+
+import unittest
+from pymongo.errors import OperationFailure
+import txnlog
+
+class CollectionStub(object):
+	def __init__(self, existing_ttl=None):
+		self.indexes = []
+		self.existing_ttl = existing_ttl
+
+	def create_index(self, keys, **options):
+		ttl = options.get('expireAfterSeconds')
+		if (ttl is not None and self.existing_ttl is not None
+		    and ttl != self.existing_ttl):
+			raise OperationFailure('Index with name: date_finished_1 already'
+			                       ' exists with different options', 85)
+		self.indexes.append((keys, options))
+
+class DatabaseStub(object):
+	name = 'test_db'
+
+	def __init__(self, existing_ttl=None):
+		self.transactions = CollectionStub(existing_ttl)
+		self.commands = []
+
+	def command(self, *args, **kwargs):
+		self.commands.append((args, kwargs))
+
+class GoodInput(unittest.TestCase):
+
+	def setUp(self):
+		txnlog._indexed.clear()
+
+	def test_indexes_should_be_created_once_per_database(self):
+		db = DatabaseStub()
+		connection = object()
+		txnlog.ensure_indexes(connection, db, 3600)
+		txnlog.ensure_indexes(connection, db, 3600)
+		self.assertEqual(len(db.transactions.indexes), 3)
+		self.assertEqual(db.transactions.indexes[2],
+		                 ([('date_finished', 1)], {'expireAfterSeconds': 3600}))
+
+	def test_finished_records_should_be_kept_without_ttl(self):
+		db = DatabaseStub()
+		txnlog.ensure_indexes(object(), db)
+		self.assertEqual(len(db.transactions.indexes), 2)
+
+	def test_changed_ttl_should_update_existing_index(self):
+		db = DatabaseStub(existing_ttl=86400)
+		txnlog.ensure_indexes(object(), db, 3600)
+		self.assertEqual(db.commands,
+		                 [(('collMod', 'transactions'),
+		                   {'index': {'keyPattern': {'date_finished': 1},
+		                              'expireAfterSeconds': 3600}})])
+
+class BadInput(unittest.TestCase):
+
+	def setUp(self):
+		txnlog._indexed.clear()
+
+	def test_other_index_failures_should_be_raised(self):
+		db = DatabaseStub()
+		def create_index(keys, **options):
+			raise OperationFailure('not authorized', 13)
+		db.transactions.create_index = create_index
+		self.assertRaises(OperationFailure, txnlog.ensure_indexes,
+		                  object(), db, 3600)
+		self.assertEqual(db.commands, [])
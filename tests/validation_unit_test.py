@@ -0,0 +1,56 @@
+""" Unit tests """
+
+import datetime
+import unittest
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+from validation import bson_compatible, valid_key
+
+class GoodInput(unittest.TestCase):
+
+	def test_common_types_should_be_compatible(self):
+		for value in (None, True, 1, 2L, 1.5, 'Saruman', u'Saruman',
+		              datetime.datetime.now(), ObjectId(),
+		              DBRef('wizards', ObjectId())):
+			self.assertTrue(bson_compatible(value))
+
+	def test_containers_should_be_checked_recursively(self):
+		self.assertTrue(bson_compatible({'name': 'Saruman',
+		                                 'staff': {'color': ['white']}}))
+		self.assertTrue(bson_compatible(('grey', ['white', 1])))
+
+	def test_string_keys_should_be_valid(self):
+		self.assertTrue(valid_key('name'))
+		self.assertTrue(valid_key(u'name'))
+
+class BadInput(unittest.TestCase):
+
+	def test_unknown_types_should_not_be_compatible(self):
+		self.assertFalse(bson_compatible(set(['white'])))
+		self.assertFalse(bson_compatible(object()))
+		self.assertFalse(bson_compatible({'colors': [set(['white'])]}))
+
+	def test_non_string_keys_should_be_invalid(self):
+		self.assertFalse(valid_key(1))
+		self.assertFalse(valid_key(None))
+		self.assertFalse(bson_compatible({1: 'Saruman'}))
+
+class EdgeCases(unittest.TestCase):
+
+	def test_integers_should_fit_in_64_bits(self):
+		self.assertTrue(bson_compatible(2 ** 63 - 1))
+		self.assertTrue(bson_compatible(-2 ** 63))
+		self.assertFalse(bson_compatible(2 ** 63))
+
+	def test_strings_should_be_utf8(self):
+		self.assertFalse(bson_compatible('\xff'))
+		self.assertFalse(valid_key('\xff'))
+
+	def test_keys_should_not_contain_nul(self):
+		self.assertFalse(valid_key('na\x00me'))
+		self.assertFalse(valid_key(u'na\x00me'))
+
+	def test_keys_should_not_be_paths_or_operators(self):
+		self.assertFalse(valid_key('staff.color'))
+		self.assertFalse(valid_key(u'$set'))
+		self.assertTrue(valid_key('cost$'))
@@ -0,0 +1,63 @@
+""" Process-wide registry of the thread pools used for concurrent commits """
+
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+class ThreadPoolRegistry(object):
+	""" Hands out one thread pool per size, so that sessions with the same
+	commit_threads share their threads instead of each starting (and
+	never stopping) its own. Like clients (see connection.ClientRegistry),
+	pools are not carried over into a forked process, whose copy of a
+	pool has no threads: the first request for a pool after a fork
+	discards the parent's pools and starts afresh.
+	"""
+
+	def __init__(self, pool_class=ThreadPool):
+		self.pool_class = pool_class
+		self.pools = {}
+		self.lock = threading.Lock()
+		self.pid = os.getpid()
+
+	def _check_fork(self):
+		if self.pid != os.getpid():
+			self.pools = {}
+			self.lock = threading.Lock()
+			self.pid = os.getpid()
+
+	def get(self, size):
+		""" The shared pool of the given number of threads, started on
+		first use.
+		"""
+		self._check_fork()
+		with self.lock:
+			pool = self.pools.get(size)
+			if pool is None:
+				pool = self.pool_class(size)
+				self.pools[size] = pool
+			return pool
+
+	def __len__(self):
+		return len(self.pools)
+
+	def shutdown(self):
+		""" Stop the threads of all pools. Pools requested afterwards are
+		started anew.
+		"""
+		self._check_fork()
+		with self.lock:
+			pools = self.pools.values()
+			self.pools = {}
+		for pool in pools:
+			pool.terminate()
+
+
+registry = ThreadPoolRegistry()
+
+def get_pool(size):
+	return registry.get(size)
+
+def shutdown():
+	""" Stop all shared thread pools, e.g. when the process exits """
+	registry.shutdown()
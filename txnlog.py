@@ -0,0 +1,90 @@
+""" The transactions collection: indexes, expiry of finished transaction
+records, and recovery of the locks of abandoned transactions """
+
+import datetime
+import logging
+import sys
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+
+logger = logging.getLogger(__name__)
+
+_indexed = set() # (client id, database name) with indexes ensured
+
+INDEX_OPTIONS_CONFLICT = 85 # server error code
+
+
+def ensure_indexes(connection, db, ttl=None):
+	""" Index the transactions collection by tid (used to update a
+	transaction's record as it finishes) and by state and modification date
+	(used by sweep()). If ttl is given, finished (done or failed) records
+	expire that many seconds after the transaction finished; pending ones
+	are kept until they finish or are swept. If the expiry index already
+	exists with a different ttl, it is changed to the new one. Without a
+	ttl an existing expiry index is left as it is (drop it to keep the
+	records). This only talks to the database the first time it is called
+	for a database in the process; sessions call it as their first
+	transaction commits, so creating a session needs no round trip.
+	"""
+	key = (id(connection), db.name)
+	if key in _indexed:
+		return
+	db.transactions.create_index([('tid', ASCENDING)], unique=True)
+	db.transactions.create_index([('state', ASCENDING),
+	                              ('date_modified', ASCENDING)])
+	if ttl is not None:
+		try:
+			db.transactions.create_index([('date_finished', ASCENDING)],
+			                             expireAfterSeconds=ttl)
+		except OperationFailure, e:
+			if e.code != INDEX_OPTIONS_CONFLICT:
+				raise
+			db.command('collMod', 'transactions',
+			           index={'keyPattern': {'date_finished': ASCENDING},
+			                  'expireAfterSeconds': ttl})
+	_indexed.add(key)
+
+def sweep(db, older_than=datetime.timedelta(minutes=10)):
+	""" Release the documents locked (marked as pending) by transactions
+	that have been pending for longer than older_than, presumably because
+	the process committing them died, and mark those transactions as
+	failed. Returns the tids of the transactions swept.
+	"""
+	now = datetime.datetime.utcnow()
+	swept = []
+	for record in db.transactions.find({'state': 'pending',
+	                                    'date_modified':
+	                                    {'$lt': now - older_than}}):
+		tid = record['tid']
+		for colname in record.get('collections', ()):
+			collection = db[colname]
+			ids = [doc['_id'] for doc in
+			       collection.find({'pending_transactions': tid}, {'_id': 1})]
+			if not ids:
+				continue
+			collection.update({'_id': {'$in': ids}},
+			                  {'$pull': {'pending_transactions': tid}},
+			                  multi=True)
+			collection.update({'_id': {'$in': ids},
+			                   'pending_transactions': {'$size': 0}},
+			                  {'$unset': {'pending_transactions': 1}},
+			                  multi=True)
+			logger.info('released %d documents in %s locked by abandoned'
+			            ' transaction %s', len(ids), colname, tid)
+		db.transactions.update({'tid': tid, 'state': 'pending'},
+		                       {'$set': {'state': 'failed',
+		                                 'date_modified': now,
+		                                 'date_finished': now}})
+		swept.append(tid)
+	return swept
+
+if __name__ == '__main__':
+	# e.g. run periodically: python txnlog.py my_db [host [port]]
+	from connection import get_client
+	logging.basicConfig()
+	logger.setLevel(logging.INFO)
+	dbname = sys.argv[1]
+	host = sys.argv[2] if len(sys.argv) > 2 else None
+	port = int(sys.argv[3]) if len(sys.argv) > 3 else None
+	print 'swept: ' + str(sweep(get_client(host, port)[dbname]))
@@ -0,0 +1,78 @@
+""" Fast checks that keys and values can be stored in mongodb """
+
+import datetime
+import re
+from bson import BSON
+from bson.binary import Binary
+from bson.code import Code
+from bson.dbref import DBRef
+from bson.int64 import Int64
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from bson.timestamp import Timestamp
+
+
+# types that are always BSON-compatible, whatever their value
+_ATOMIC_TYPES = frozenset([type(None), bool, float, unicode,
+                           datetime.datetime, ObjectId, DBRef, Binary, Code,
+                           Int64, Regex, Timestamp, MinKey, MaxKey,
+                           type(re.compile(''))])
+_MAX_INT64 = 2 ** 63 - 1
+_MIN_INT64 = -2 ** 63
+
+
+def _valid_utf8(value):
+	try:
+		value.decode('utf-8')
+	except UnicodeDecodeError:
+		return False
+	return True
+
+def _encodable_key(key):
+	""" Whether the value can be encoded as a key in BSON """
+	keytype = type(key)
+	if keytype is str:
+		return '\x00' not in key and _valid_utf8(key)
+	return keytype is unicode and u'\x00' not in key
+
+def valid_key(key):
+	""" Whether the value can be used as a key in a mongo document. Keys
+	containing '.' or starting with '$' can't: in an update they would be
+	taken as a path or an operator.
+	"""
+	return (_encodable_key(key) and '.' not in key and
+	        not key.startswith('$'))
+
+def always_compatible(valuetype):
+	""" Whether all values of the type are BSON-compatible """
+	return valuetype in _ATOMIC_TYPES
+
+def bson_compatible(value):
+	""" Whether the value can be encoded as BSON. Common types are checked
+	by type (and range or encoding where that matters), and only values of
+	other types are actually encoded to find out.
+	"""
+	valuetype = type(value)
+	if valuetype in _ATOMIC_TYPES:
+		return True
+	if valuetype is str:
+		return _valid_utf8(value)
+	if valuetype is int or valuetype is long:
+		return _MIN_INT64 <= value <= _MAX_INT64
+	if valuetype is dict:
+		for key, item in value.iteritems():
+			if not _encodable_key(key) or not bson_compatible(item):
+				return False
+		return True
+	if valuetype is list or valuetype is tuple:
+		for item in value:
+			if not bson_compatible(item):
+				return False
+		return True
+	try:
+		BSON.encode({'value': value})
+	except Exception:
+		return False
+	return True